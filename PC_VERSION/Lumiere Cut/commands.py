@@ -0,0 +1,185 @@
+# commands.py
+import sys
+from collections import deque
+
+HISTORY_BUDGET = 64 * 1024 * 1024  # Approximate bytes of commands kept before the oldest are forgotten
+
+
+# Every edit is a command that can apply and revert itself on the editor's tracks and timeline index.
+# Commands only hold the clips they touch, which stay shared with the timeline.
+class Command:
+    name = "Edit"
+
+    def do(self, editor):
+        raise NotImplementedError
+
+    def undo(self, editor):
+        raise NotImplementedError
+
+    def records(self, editor, undone=False):
+        # Autosave journal records describing the change just applied (or reverted when undone)
+        return []
+
+    def size(self):
+        return sys.getsizeof(self) + sum(sys.getsizeof(value) for value in vars(self).values())
+
+
+class AddClip(Command):
+    name = "Add clip"
+
+    def __init__(self, track_idx, clip_idx, clip):
+        self.track_idx = track_idx
+        self.clip_idx = clip_idx
+        self.clip = clip
+
+    def do(self, editor):
+        editor.tracks[self.track_idx].insert(self.clip_idx, self.clip)
+        editor.timeline.add(self.track_idx, self.clip)
+
+    def undo(self, editor):
+        editor.tracks[self.track_idx].pop(self.clip_idx)
+        editor.timeline.remove(self.clip)
+
+    def records(self, editor, undone=False):
+        if undone:
+            return [{"op": "remove", "track": self.track_idx, "index": self.clip_idx}]
+        return [{"op": "add", "track": self.track_idx, "index": self.clip_idx, "clip": editor.clip_data(self.clip)}]
+
+
+class RemoveClip(AddClip):
+    name = "Remove clip"
+
+    def do(self, editor):
+        AddClip.undo(self, editor)
+
+    def undo(self, editor):
+        AddClip.do(self, editor)
+
+    def records(self, editor, undone=False):
+        return AddClip.records(self, editor, not undone)
+
+
+class SetClipFields(Command):
+    # Trim, move or any other change of plain clip attributes
+    name = "Change clip"
+
+    def __init__(self, clip, changes, name=None):
+        self.clip = clip
+        self.after = dict(changes)
+        self.before = {field: getattr(clip, field) for field in changes}
+        if name:
+            self.name = name
+
+    def apply(self, editor, values):
+        for field, value in values.items():
+            setattr(self.clip, field, value)
+        editor.timeline.update(self.clip)
+
+    def do(self, editor):
+        self.apply(editor, self.after)
+
+    def undo(self, editor):
+        self.apply(editor, self.before)
+
+    def records(self, editor, undone=False):
+        track_idx, index = editor.locate(self.clip)
+        return [{"op": "set", "track": track_idx, "index": index, "fields": self.before if undone else self.after}]
+
+
+class SplitClip(Command):
+    name = "Split clip"
+
+    def __init__(self, track_idx, clip_idx, clip, new_clip):
+        self.track_idx = track_idx
+        self.clip_idx = clip_idx
+        self.clip = clip
+        self.new_clip = new_clip
+        self.old_end = clip.end_frame
+
+    def do(self, editor):
+        self.clip.end_frame = self.new_clip.start_frame
+        editor.timeline.update(self.clip)
+        editor.tracks[self.track_idx].insert(self.clip_idx + 1, self.new_clip)
+        editor.timeline.add(self.track_idx, self.new_clip)
+
+    def undo(self, editor):
+        editor.tracks[self.track_idx].pop(self.clip_idx + 1)
+        editor.timeline.remove(self.new_clip)
+        self.clip.end_frame = self.old_end
+        editor.timeline.update(self.clip)
+
+    def records(self, editor, undone=False):
+        if undone:
+            return [{"op": "remove", "track": self.track_idx, "index": self.clip_idx + 1},
+                    {"op": "set", "track": self.track_idx, "index": self.clip_idx,
+                     "fields": {"end_frame": self.old_end}}]
+        return [{"op": "set", "track": self.track_idx, "index": self.clip_idx,
+                 "fields": {"end_frame": self.clip.end_frame}},
+                {"op": "add", "track": self.track_idx, "index": self.clip_idx + 1,
+                 "clip": editor.clip_data(self.new_clip)}]
+
+
+class AppendItem(Command):
+    # Adds an effect or transition to one of the clip's lists
+    def __init__(self, clip, attribute, item, name):
+        self.clip = clip
+        self.attribute = attribute
+        self.item = item
+        self.name = name
+
+    def do(self, editor):
+        getattr(self.clip, self.attribute).append(self.item)
+
+    def undo(self, editor):
+        getattr(self.clip, self.attribute).pop()
+
+    def records(self, editor, undone=False):
+        track_idx, index = editor.locate(self.clip)
+        if undone:
+            return [{"op": "pop", "track": track_idx, "index": index, "attribute": self.attribute}]
+        return [{"op": "append", "track": track_idx, "index": index, "attribute": self.attribute,
+                 "item": self.item}]
+
+
+class CommandHistory:
+    # Unbounded in length, only the memory budget drops the oldest commands
+    def __init__(self, memory_budget=HISTORY_BUDGET):
+        self.memory_budget = memory_budget
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.memory = 0
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack = []
+        self.memory = 0
+
+    def execute(self, editor, command):
+        command.do(editor)
+        self.push(command)
+
+    def push(self, command):
+        command.memory = command.size()
+        self.undo_stack.append(command)
+        self.memory += command.memory
+        for old in self.redo_stack:
+            self.memory -= old.memory
+        self.redo_stack = []
+        while self.memory > self.memory_budget and len(self.undo_stack) > 1:
+            self.memory -= self.undo_stack.popleft().memory
+
+    def undo(self, editor):
+        if not self.undo_stack:
+            return None
+        command = self.undo_stack.pop()
+        command.undo(editor)
+        self.redo_stack.append(command)
+        return command
+
+    def redo(self, editor):
+        if not self.redo_stack:
+            return None
+        command = self.redo_stack.pop()
+        command.do(editor)
+        self.undo_stack.append(command)
+        return command
@@ -0,0 +1,165 @@
+# decoder.py
+import cv2
+import threading
+import queue
+from collections import OrderedDict
+
+
+# LRU cache of decoded frames keyed by (path, frame), bounded by total bytes
+class FrameCache:
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.frames = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            frame = self.frames.get(key)
+            if frame is not None:
+                self.frames.move_to_end(key)
+            return frame
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.frames
+
+    def put(self, key, frame):
+        # Cached frames are shared between callers, so they are made read-only
+        frame.flags.writeable = False
+        with self.lock:
+            old = self.frames.pop(key, None)
+            if old is not None:
+                self.used_bytes -= old.nbytes
+            self.frames[key] = frame
+            self.used_bytes += frame.nbytes
+            while self.used_bytes > self.max_bytes and len(self.frames) > 1:
+                _, evicted = self.frames.popitem(last=False)
+                self.used_bytes -= evicted.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.used_bytes = 0
+
+
+# One open capture per source file that remembers where its read position is
+class SourceDecoder:
+    # Reading forward through this many frames is cheaper than a keyframe seek
+    MAX_SKIP = 48
+
+    def __init__(self, path):
+        self.path = path
+        self.capture = cv2.VideoCapture(path)
+        self.next_frame = 0
+        self.lock = threading.Lock()
+
+    def is_opened(self):
+        return self.capture.isOpened()
+
+    def read(self, frame_num):
+        # Callers must hold self.lock
+        gap = frame_num - self.next_frame
+        if gap < 0 or gap > self.MAX_SKIP:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
+        else:
+            for _ in range(gap):
+                if not self.capture.grab():
+                    break
+        ret, frame = self.capture.read()
+        self.next_frame = frame_num + 1 if ret else -1
+        return frame if ret else None
+
+    def release(self):
+        with self.lock:
+            self.capture.release()
+
+
+# Keeps decoders open per source, caches decoded frames and reads ahead in the background
+class DecoderPool:
+    def __init__(self, max_decoders=8, cache_bytes=512 * 1024 * 1024, read_ahead=15):
+        self.max_decoders = max_decoders
+        self.read_ahead = read_ahead
+        self.cache = FrameCache(cache_bytes)
+        self.decoders = OrderedDict()
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.closed = False
+        self.worker = threading.Thread(target=self._read_ahead_thread, daemon=True)
+        self.worker.start()
+
+    def get_decoder(self, path):
+        with self.lock:
+            if self.closed:
+                return None
+            decoder = self.decoders.get(path)
+            if decoder is None:
+                decoder = SourceDecoder(path)
+                self.decoders[path] = decoder
+                while len(self.decoders) > self.max_decoders:
+                    _, closed = self.decoders.popitem(last=False)
+                    closed.release()
+            else:
+                self.decoders.move_to_end(path)
+            return decoder
+
+    def read(self, path, frame_num, use_cache=True, prefetch=False):
+        frame_num = int(frame_num)
+        key = (path, frame_num)
+        if use_cache:
+            frame = self.cache.get(key)
+            if frame is not None:
+                if prefetch:
+                    self.prefetch(path, frame_num + 1)
+                return frame
+        decoder = self.get_decoder(path)
+        if decoder is None:
+            return None
+        with decoder.lock:
+            frame = decoder.read(frame_num)
+        if frame is not None and use_cache:
+            self.cache.put(key, frame)
+        if prefetch:
+            self.prefetch(path, frame_num + 1)
+        return frame
+
+    def prefetch(self, path, start, count=None):
+        if not self.closed:
+            self.requests.put((path, int(start), count or self.read_ahead))
+
+    def _read_ahead_thread(self):
+        while True:
+            request = self.requests.get()
+            # Only the newest request matters when the playhead has moved on; None from close() ends the thread
+            while request is not None and not self.requests.empty():
+                request = self.requests.get_nowait()
+            if request is None:
+                return
+            path, start, count = request
+            decoder = self.get_decoder(path)
+            if decoder is None:
+                return
+            for frame_num in range(start, start + count):
+                if (path, frame_num) in self.cache:
+                    continue
+                if not self.requests.empty():
+                    break
+                with decoder.lock:
+                    frame = decoder.read(frame_num)
+                if frame is None:
+                    break
+                self.cache.put((path, frame_num), frame)
+
+    def close(self):
+        # Has to run before the interpreter exits: a capture still decoding in the worker at exit aborts the process
+        with self.lock:
+            self.closed = True
+        self.requests.put(None)
+        self.worker.join()
+        with self.lock:
+            decoders = list(self.decoders.values())
+            self.decoders.clear()
+        for decoder in decoders:
+            # Waits for a read still running on the playback thread
+            decoder.release()
+        self.cache.clear()
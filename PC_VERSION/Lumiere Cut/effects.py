@@ -0,0 +1,86 @@
+# effects.py
+import functools
+import threading
+import cv2
+import numpy as np
+
+IDENTITY = np.arange(256, dtype=np.uint8)
+
+
+def scale_table(table, alpha):
+    # Same rounding and saturation as cv2.convertScaleAbs on the frame itself
+    return cv2.convertScaleAbs(table, alpha=alpha).reshape(-1)
+
+
+def saturation_table(table, factor):
+    return np.clip(np.rint(table * float(factor)), 0, 255).astype(np.uint8)
+
+
+# A clip's effect stack compiled once: the frame is scaled to the output size first, every run of point
+# effects becomes one table lookup and spatial filters work in place on the scaled frame
+class EffectPipeline:
+    def __init__(self, effects, resolution):
+        self.resolution = tuple(resolution)
+        self.stages = []  # (kind, parameter) in effect order, adjacent tables already merged
+        for kind, value in effects:
+            if kind in ("brightness", "contrast"):
+                self.add_scale(value)
+            elif kind == "saturation":
+                self.add_table("saturation", value, saturation_table)
+            elif kind == "blur":
+                size = max(1, int(value)) | 1
+                self.stages.append(("blur", (size, size)))
+        # Saturation scales only the S channel of the HSV frame, H and V go through unchanged
+        self.stages = [(kind, np.dstack([IDENTITY, table, IDENTITY]) if kind == "saturation" else table)
+                       for kind, table in self.stages]
+        self.scratch = threading.local()
+
+    def add_scale(self, alpha):
+        # A lone scale runs as convertScaleAbs, which is vectorised and beats a table lookup,
+        # two or more in a row are cheaper as one table
+        if self.stages and self.stages[-1][0] == "scale":
+            self.stages.append(("lut", scale_table(scale_table(IDENTITY, self.stages.pop()[1]), alpha)))
+        elif self.stages and self.stages[-1][0] == "lut":
+            self.stages.append(("lut", scale_table(self.stages.pop()[1], alpha)))
+        else:
+            self.stages.append(("scale", alpha))
+
+    def add_table(self, kind, value, build):
+        if self.stages and self.stages[-1][0] == kind:
+            table = self.stages.pop()[1]
+        else:
+            table = IDENTITY
+        self.stages.append((kind, build(table, value)))
+
+    def hsv_buffer(self, shape):
+        # One HSV frame per thread, reused for every frame of the same size
+        buffer = getattr(self.scratch, "hsv", None)
+        if buffer is None or buffer.shape != shape:
+            buffer = self.scratch.hsv = np.empty(shape, dtype=np.uint8)
+        return buffer
+
+    def apply(self, frame):
+        # Decoded frames may be shared and read-only, the result is always a new array unless nothing changes
+        out = None
+        if (frame.shape[1], frame.shape[0]) != self.resolution:
+            out = cv2.resize(frame, self.resolution)
+        for kind, parameter in self.stages:
+            source = frame if out is None else out
+            if kind == "scale":
+                out = cv2.convertScaleAbs(source, dst=out, alpha=parameter)
+            elif kind == "lut":
+                out = cv2.LUT(source, parameter, dst=out)
+            elif kind == "saturation":
+                hsv = self.hsv_buffer(source.shape)
+                cv2.cvtColor(source, cv2.COLOR_BGR2HSV, dst=hsv)
+                cv2.LUT(hsv, parameter, dst=hsv)
+                out = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR, dst=out)
+            elif kind == "blur":
+                out = cv2.GaussianBlur(source, parameter, 0, dst=out)
+        return frame if out is None else out
+
+
+@functools.lru_cache(maxsize=256)
+def compile_effects(effects, resolution):
+    # effects is a tuple of (type, value) pairs so equal stacks share one pipeline
+    return EffectPipeline(effects, resolution)
@@ -2,11 +2,17 @@
 import cv2
 import os
 import json
-import numpy as np
 from datetime import datetime
 from PIL import Image, ImageDraw, ImageFont, ImageTk
 import pygame
 from models import VideoClip, AudioClip, Project, Track
+from decoder import DecoderPool
+from render import TimelineRenderer, ExportCancelled, PlanLayer, composite, prepare_frame
+from timeline import TimelineIndex, clip_interval
+from proxy import ProxyManager
+from media_cache import MediaCache, probe_duration
+from commands import CommandHistory, AddClip, RemoveClip, SetClipFields, SplitClip, AppendItem
+from journal import ProjectJournal, autosave_paths, find_recovery, recover, write_atomic
 
 
 class VideoEditorFunctions:
@@ -15,12 +21,18 @@ class VideoEditorFunctions:
         self.current_clip = None
         self.current_frame = 0
         self.copied_clip = None
-        self.undo_stack = []
-        self.redo_stack = []
+        self.history = CommandHistory()
         self.video_clips = []
         self.audio_clips = []
         self.tracks = [[] for _ in range(5)]  # 5 video tracks
         self.audio_tracks = [[] for _ in range(3)]  # 3 audio tracks
+        self.clips_by_path = {}
+        self.timeline = TimelineIndex(self.tracks, self.project.fps)
+        self.decoders = DecoderPool()
+        self.proxies = ProxyManager()
+        self.media = MediaCache()
+        # Started by the GUI once it has offered to recover the previous session
+        self.journal = ProjectJournal()
 
     def new_project(self, name, resolution, fps):
         try:
@@ -31,8 +43,10 @@ class VideoEditorFunctions:
             self.audio_clips = []
             self.tracks = [[] for _ in range(5)]
             self.audio_tracks = [[] for _ in range(3)]
-            self.undo_stack = []
-            self.redo_stack = []
+            self.clips_by_path = {}
+            self.timeline.rebuild(self.tracks, fps)
+            self.history.clear()
+            self.start_journal()
             return True, f"Project '{name}' created successfully"
         except Exception as e:
             return False, f"Error creating project: {str(e)}"
@@ -42,39 +56,66 @@ class VideoEditorFunctions:
             with open(file_path, 'r') as f:
                 data = json.load(f)
 
-            self.project = Project(data['name'], tuple(data['resolution']), data['fps'])
-            self.project.file_path = file_path
-
-            # Load video clips
-            self.video_clips = []
-            for clip_data in data.get('video_clips', []):
-                clip = VideoClip(clip_data['path'])
-                clip.start_frame = clip_data['start_frame']
-                clip.end_frame = clip_data['end_frame']
-                clip.position = clip_data['position']
-                self.video_clips.append(clip)
-
-            # Load audio clips
-            self.audio_clips = []
-            for clip_data in data.get('audio_clips', []):
-                clip = AudioClip(clip_data['path'])
-                clip.start_time = clip_data['start_time']
-                clip.end_time = clip_data['end_time']
-                clip.position = clip_data['position']
-                self.audio_clips.append(clip)
-
-            # Load tracks
-            self.tracks = [[] for _ in range(5)]
-            for track_idx, track_data in enumerate(data.get('tracks', [])):
-                for clip_data in track_data:
-                    clip = next((c for c in self.video_clips if c.path == clip_data['path']), None)
-                    if clip:
-                        self.tracks[track_idx].append(clip)
+            self.load_data(data, file_path)
+            # Declining recovery drops the old autosave, the journal starts again from what was loaded
+            self.start_journal()
 
             return True, f"Project loaded from {file_path}"
         except Exception as e:
             return False, f"Error loading project: {str(e)}"
 
+    def recover_project(self, project_path=None, snapshot_path=None, journal_path=None):
+        # Rebuilds the last session from the autosave snapshot and replays the edits journaled after it
+        try:
+            data, applied = recover(project_path, snapshot_path, journal_path)
+            self.load_data(data, project_path)
+            self.start_journal(seq=data.get('journal_seq', 0), paths=snapshot_path and (snapshot_path, journal_path))
+            return True, f"Recovered project '{self.project.name}'"
+        except Exception as e:
+            return False, f"Error recovering project: {str(e)}"
+
+    def find_recovery(self, project_path=None):
+        return find_recovery(project_path)
+
+    def load_data(self, data, file_path=None):
+        self.project = Project(data['name'], tuple(data['resolution']), data['fps'])
+        self.project.file_path = file_path
+        if file_path:
+            self.set_cache_dirs()
+
+        # Load video clips
+        self.video_clips = []
+        self.clips_by_path = {}
+        for clip_data in data.get('video_clips', []):
+            clip = VideoClip(clip_data['path'])
+            clip.start_frame = clip_data['start_frame']
+            clip.end_frame = clip_data['end_frame']
+            clip.position = clip_data['position']
+            self.video_clips.append(clip)
+            self.clips_by_path.setdefault(clip.path, clip)
+            self.proxies.generate(clip.path)
+            self.media.build(clip.path)
+
+        # Load audio clips
+        self.audio_clips = []
+        for clip_data in data.get('audio_clips', []):
+            clip = AudioClip(clip_data['path'])
+            clip.start_time = clip_data['start_time']
+            clip.end_time = clip_data['end_time']
+            clip.position = clip_data['position']
+            self.audio_clips.append(clip)
+            self.media.build(clip.path, "audio")
+
+        # Load tracks
+        self.tracks = [[] for _ in range(5)]
+        for track_idx, track_data in enumerate(data.get('tracks', [])):
+            for clip_data in track_data:
+                clip = self.clips_by_path.get(clip_data['path'])
+                if clip:
+                    self.tracks[track_idx].append(self.make_timeline_clip(clip, clip_data))
+        self.timeline.rebuild(self.tracks, self.project.fps)
+        self.history.clear()
+
     def save_project(self, file_path=None):
         try:
             if file_path:
@@ -82,40 +123,68 @@ class VideoEditorFunctions:
 
             if not self.project.file_path:
                 return False, "No file path specified"
+            self.set_cache_dirs()
 
-            data = {
-                'name': self.project.name,
-                'resolution': self.project.resolution,
-                'fps': self.project.fps,
-                'video_clips': [{
-                    'path': clip.path,
-                    'start_frame': clip.start_frame,
-                    'end_frame': clip.end_frame,
-                    'position': clip.position
-                } for clip in self.video_clips],
-                'audio_clips': [{
-                    'path': clip.path,
-                    'start_time': clip.start_time,
-                    'end_time': clip.end_time,
-                    'position': clip.position
-                } for clip in self.audio_clips],
-                'tracks': [
-                    [{'path': clip.path, 'position': clip.position} for clip in track]
-                    for track in self.tracks
-                ]
-            }
-
-            with open(self.project.file_path, 'w') as f:
-                json.dump(data, f, indent=2)
+            write_atomic(self.project.file_path, self.project_data(), indent=2)
+            # Everything is in the project file now, the autosave starts over from it
+            self.start_journal(write_snapshot=False)
 
             return True, f"Project saved to {self.project.file_path}"
         except Exception as e:
             return False, f"Error saving project: {str(e)}"
 
+    def project_data(self):
+        return {
+            'name': self.project.name,
+            'resolution': self.project.resolution,
+            'fps': self.project.fps,
+            'video_clips': [{
+                'path': clip.path,
+                'start_frame': clip.start_frame,
+                'end_frame': clip.end_frame,
+                'position': clip.position
+            } for clip in self.video_clips],
+            'audio_clips': [self.audio_clip_data(clip) for clip in self.audio_clips],
+            'tracks': [[self.clip_data(clip) for clip in track] for track in self.tracks]
+        }
+
+    def clip_data(self, clip):
+        data = {'path': clip.path, 'position': clip.position,
+                'start_frame': clip.start_frame, 'end_frame': clip.end_frame}
+        # Copies, so journaled data never changes along with the clip
+        if clip.effects:
+            data['effects'] = [dict(effect) for effect in clip.effects]
+        if clip.transitions:
+            data['transitions'] = [dict(transition) for transition in clip.transitions]
+        return data
+
+    def audio_clip_data(self, clip):
+        return {'path': clip.path, 'start_time': clip.start_time, 'end_time': clip.end_time,
+                'position': clip.position}
+
+    def locate(self, clip):
+        # (track index, index in the track) of a timeline clip
+        track_idx = self.timeline.entries[id(clip)][0]
+        track = self.tracks[track_idx]
+        return track_idx, next(index for index, other in enumerate(track) if other is clip)
+
+    def start_journal(self, write_snapshot=True, seq=0, paths=None):
+        # Autosave from the current state on: edits are appended to the journal and folded into the
+        # snapshot on the journal's own thread
+        data = self.project_data()
+        data['journal_seq'] = seq
+        snapshot_path, journal_path = paths or autosave_paths(self.project.file_path, self.project.name)
+        self.journal.start(json.dumps(data), snapshot_path, journal_path, write_snapshot)
+
+    def set_cache_dirs(self):
+        # Proxies and timeline thumbnails/peaks live in a cache directory next to the project file
+        base, _ = os.path.splitext(self.project.file_path)
+        self.proxies.set_cache_dir(os.path.join(base + "_cache", "proxies"))
+        self.media.set_cache_dir(os.path.join(base + "_cache", "media"))
+
     def auto_save(self):
-        if self.project.file_path:
-            auto_save_path = self.project.file_path.replace('.lumiere', '_autosave.lumiere')
-            self.save_project(auto_save_path)
+        # Edits are already journaled as they happen, this only folds them into the snapshot
+        self.journal.checkpoint()
 
     def open_video(self, file_path):
         try:
@@ -146,8 +215,13 @@ class VideoEditorFunctions:
             clip.end_frame = total_frames
 
             self.video_clips.append(clip)
+            self.clips_by_path.setdefault(file_path, clip)
+            self.journal.record([{'op': 'video', 'clip': {'path': clip.path, 'start_frame': clip.start_frame,
+                                                          'end_frame': clip.end_frame, 'position': clip.position}}])
             self.current_clip = clip
             self.current_frame = 0
+            self.proxies.generate(file_path)
+            self.media.build(file_path)
 
             return True, os.path.basename(file_path), thumbnail
         except Exception as e:
@@ -155,18 +229,22 @@ class VideoEditorFunctions:
 
     def add_audio_clip(self, file_path):
         try:
-            # Initialize pygame mixer if not already initialized
-            if not pygame.mixer.get_init():
-                pygame.mixer.init()
+            duration = probe_duration(file_path)
+            if duration is None:
+                # Initialize pygame mixer if not already initialized
+                if not pygame.mixer.get_init():
+                    pygame.mixer.init()
 
-            sound = pygame.mixer.Sound(file_path)
-            duration = sound.get_length()
+                sound = pygame.mixer.Sound(file_path)
+                duration = sound.get_length()
 
             clip = AudioClip(file_path)
             clip.duration = duration
             clip.end_time = duration
 
             self.audio_clips.append(clip)
+            self.journal.record([{'op': 'audio', 'clip': self.audio_clip_data(clip)}])
+            self.media.build(file_path, "audio")
             return True, os.path.basename(file_path)
         except Exception as e:
             return False, f"Error adding audio: {str(e)}"
@@ -186,8 +264,7 @@ class VideoEditorFunctions:
             timeline_clip.duration = self.current_clip.duration
 
             if track_idx < len(self.tracks):
-                self.tracks[track_idx].append(timeline_clip)
-                self.push_undo_state()
+                self.execute(AddClip(track_idx, len(self.tracks[track_idx]), timeline_clip))
                 return True, "Clip added to timeline"
             else:
                 return False, "Invalid track index"
@@ -202,19 +279,45 @@ class VideoEditorFunctions:
             frame_num = self.current_frame
 
         try:
-            cap = cv2.VideoCapture(self.current_clip.path)
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
-            ret, frame = cap.read()
-            cap.release()
-
-            if ret:
-                return frame
-            else:
-                return None
+            # Cached frames are read-only, copy before modifying them in place
+            path = self.proxies.preview_path(self.current_clip.path)
+            return self.decoders.read(path, frame_num, prefetch=True)
         except Exception as e:
             print(f"Error getting frame: {str(e)}")
             return None
 
+    def get_timeline_frame(self, frame_num):
+        # Composites the timeline at frame_num for previews; only the clips under the topmost opaque one are read
+        fps = self.project.fps
+        layers = []
+        for track_idx, clip in self.timeline.active(frame_num):
+            start, _ = clip_interval(clip, fps)
+            source = clip.start_frame + int((frame_num - start) * (clip.fps or fps) / fps)
+            frame = self.get_frame_from_clip(clip, source)
+            if frame is not None:
+                layers.append((PlanLayer((clip,), clip.opacity), [frame]))
+                if clip.opacity >= 1:
+                    break
+        width, height = self.project.resolution
+        return composite(layers[::-1], width, height)
+
+    def prefetch_frames(self, frame_num, count):
+        # Decodes frames of the current clip ahead of playback
+        if self.current_clip:
+            self.decoders.prefetch(self.proxies.preview_path(self.current_clip.path), frame_num, count)
+
+    def prefetch_timeline(self, frame_num, count):
+        # Decodes ahead for the topmost clip at frame_num, the read-ahead thread only follows the newest request
+        active = self.timeline.active(frame_num)
+        if active:
+            fps = self.project.fps
+            _, clip = active[0]
+            start, _ = clip_interval(clip, fps)
+            source = clip.start_frame + int((frame_num - start) * (clip.fps or fps) / fps)
+            count = min(count, clip.end_frame - source)
+            if count > 0:
+                self.decoders.prefetch(self.proxies.preview_path(clip.path), source, count)
+
     def split_clip(self, track_idx, clip_idx, split_frame):
         try:
             if track_idx >= len(self.tracks) or clip_idx >= len(self.tracks[track_idx]):
@@ -229,16 +332,12 @@ class VideoEditorFunctions:
             new_clip = VideoClip(clip.path)
             new_clip.start_frame = split_frame
             new_clip.end_frame = clip.end_frame
-            new_clip.position = clip.position + (split_frame - clip.start_frame)
+            new_clip.position = clip.position + (split_frame - clip.start_frame) / (clip.fps or self.project.fps)
             new_clip.total_frames = clip.total_frames
             new_clip.fps = clip.fps
 
-            # Update original clip
-            clip.end_frame = split_frame
-
-            # Insert new clip after the original
-            self.tracks[track_idx].insert(clip_idx + 1, new_clip)
-            self.push_undo_state()
+            # Shorten the original and insert the new clip after it
+            self.execute(SplitClip(track_idx, clip_idx, clip, new_clip))
 
             return True, "Clip split successfully"
         except Exception as e:
@@ -254,9 +353,7 @@ class VideoEditorFunctions:
             if start_frame < 0 or end_frame > clip.total_frames or start_frame >= end_frame:
                 return False, "Invalid trim range"
 
-            clip.start_frame = start_frame
-            clip.end_frame = end_frame
-            self.push_undo_state()
+            self.execute(SetClipFields(clip, {'start_frame': start_frame, 'end_frame': end_frame}, "Trim clip"))
 
             return True, "Clip trimmed successfully"
         except Exception as e:
@@ -267,8 +364,7 @@ class VideoEditorFunctions:
             if track_idx >= len(self.tracks) or clip_idx >= len(self.tracks[track_idx]):
                 return False, "Invalid clip selection"
 
-            removed_clip = self.tracks[track_idx].pop(clip_idx)
-            self.push_undo_state()
+            self.execute(RemoveClip(track_idx, clip_idx, self.tracks[track_idx][clip_idx]))
 
             return True, "Clip removed successfully"
         except Exception as e:
@@ -298,8 +394,7 @@ class VideoEditorFunctions:
             new_clip.fps = self.copied_clip.fps
 
             if track_idx < len(self.tracks):
-                self.tracks[track_idx].append(new_clip)
-                self.push_undo_state()
+                self.execute(AddClip(track_idx, len(self.tracks[track_idx]), new_clip))
                 return True, "Clip pasted successfully"
             else:
                 return False, "Invalid track index"
@@ -314,14 +409,18 @@ class VideoEditorFunctions:
             clip = self.tracks[track_idx][clip_idx]
 
             # Apply effect (this would be more complex in a real implementation)
+            effect = None
             if effect_name == "Brightness":
-                clip.effects.append({"type": "brightness", "value": 1.2})
+                effect = {"type": "brightness", "value": 1.2}
             elif effect_name == "Contrast":
-                clip.effects.append({"type": "contrast", "value": 1.2})
+                effect = {"type": "contrast", "value": 1.2}
+            elif effect_name == "Saturation":
+                effect = {"type": "saturation", "value": 1.3}
             elif effect_name == "Blur":
-                clip.effects.append({"type": "blur", "value": 5})
+                effect = {"type": "blur", "value": 5}
 
-            self.push_undo_state()
+            if effect is not None:
+                self.execute(AppendItem(clip, 'effects', effect, f"{effect_name} effect"))
             return True, f"{effect_name} effect applied"
         except Exception as e:
             return False, f"Error applying effect: {str(e)}"
@@ -344,156 +443,66 @@ class VideoEditorFunctions:
 
             if not hasattr(prev_clip, 'transitions'):
                 prev_clip.transitions = []
-            prev_clip.transitions.append(transition)
+            self.execute(AppendItem(prev_clip, 'transitions', transition, f"{transition_type} transition"))
 
-            self.push_undo_state()
             return True, f"{transition_type} transition added"
         except Exception as e:
             return False, f"Error adding transition: {str(e)}"
 
-    def export_video(self, output_path, format_type, quality):
+    def export_video(self, output_path, format_type, quality, progress_callback=None, cancel=None, workers=1):
         try:
-            # This is a simplified export function
-            # In a real implementation, you would use OpenCV or FFmpeg to render the timeline
-
             if not self.tracks or not any(self.tracks):
                 return False, "No clips in timeline to export"
 
-            # Get the total duration
-            max_duration = 0
-            for track in self.tracks:
-                for clip in track:
-                    clip_end = clip.position + (clip.end_frame - clip.start_frame) / clip.fps
-                    max_duration = max(max_duration, clip_end)
-
-            # Create video writer
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            out = cv2.VideoWriter(output_path, fourcc, self.project.fps, self.project.resolution)
-
-            # Render each frame (simplified - would need to handle multiple tracks, effects, etc.)
-            for frame_num in range(int(max_duration * self.project.fps)):
-                frame = np.zeros((self.project.resolution[1], self.project.resolution[0], 3), dtype=np.uint8)
-
-                # Render tracks from bottom to top
-                for track in reversed(self.tracks):
-                    for clip in track:
-                        clip_start_frame = clip.position * clip.fps
-                        clip_end_frame = clip_start_frame + (clip.end_frame - clip.start_frame)
-
-                        if clip_start_frame <= frame_num < clip_end_frame:
-                            clip_frame_num = clip.start_frame + (frame_num - clip_start_frame)
-                            clip_frame = self.get_frame_from_clip(clip, clip_frame_num)
-                            if clip_frame is not None:
-                                # Simple overlay (would need proper compositing)
-                                frame = clip_frame
-
-                out.write(frame)
-
-            out.release()
+            renderer = TimelineRenderer(self.tracks, self.audio_tracks, self.project, self.process_clip_frame)
+            renderer.export(output_path, format_type, quality, progress_callback, cancel, workers)
             return True, f"Video exported to {output_path}"
+        except ExportCancelled:
+            return False, "Export cancelled"
         except Exception as e:
             return False, f"Error exporting video: {str(e)}"
 
-    def get_frame_from_clip(self, clip, frame_num):
+    def get_frame_from_clip(self, clip, frame_num, use_cache=True):
         try:
-            cap = cv2.VideoCapture(clip.path)
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
-            ret, frame = cap.read()
-            cap.release()
-
-            if ret:
-                # Apply effects (simplified)
-                for effect in getattr(clip, 'effects', []):
-                    if effect['type'] == 'brightness':
-                        frame = cv2.convertScaleAbs(frame, alpha=effect['value'], beta=0)
-                    elif effect['type'] == 'contrast':
-                        frame = cv2.convertScaleAbs(frame, alpha=effect['value'], beta=0)
-
-                # Resize to project resolution
-                frame = cv2.resize(frame, self.project.resolution)
-                return frame
+            # Previews go through the proxy once it exists, export reads the originals in render.py
+            path = self.proxies.preview_path(clip.path)
+            frame = self.decoders.read(path, frame_num, use_cache=use_cache, prefetch=use_cache)
+            if frame is not None:
+                return self.process_clip_frame(clip, frame)
             return None
         except Exception as e:
             print(f"Error getting frame from clip: {str(e)}")
             return None
 
-    def push_undo_state(self):
-        # Save current state to undo stack
-        state = {
-            'tracks': [[{
-                'path': clip.path,
-                'start_frame': clip.start_frame,
-                'end_frame': clip.end_frame,
-                'position': clip.position
-            } for clip in track] for track in self.tracks],
-            'current_frame': self.current_frame,
-            'current_clip_path': self.current_clip.path if self.current_clip else None
-        }
-        self.undo_stack.append(state)
-        self.redo_stack = []  # Clear redo stack when new action is performed
+    def process_clip_frame(self, clip, frame):
+        return prepare_frame(clip, frame, self.project.resolution)
+
+    def execute(self, command):
+        self.history.execute(self, command)
+        self.journal.record(command.records(self))
 
     def undo(self):
-        if not self.undo_stack:
+        command = self.history.undo(self)
+        if command is None:
             return False, "Nothing to undo"
-
-        # Save current state to redo stack
-        current_state = {
-            'tracks': [[{
-                'path': clip.path,
-                'start_frame': clip.start_frame,
-                'end_frame': clip.end_frame,
-                'position': clip.position
-            } for clip in track] for track in self.tracks],
-            'current_frame': self.current_frame,
-            'current_clip_path': self.current_clip.path if self.current_clip else None
-        }
-        self.redo_stack.append(current_state)
-
-        # Restore previous state
-        previous_state = self.undo_stack.pop()
-        self.restore_state(previous_state)
-
-        return True, "Undo successful"
+        self.journal.record(command.records(self, undone=True))
+        return True, f"Undo: {command.name}"
 
     def redo(self):
-        if not self.redo_stack:
+        command = self.history.redo(self)
+        if command is None:
             return False, "Nothing to redo"
-
-        # Save current state to undo stack
-        current_state = {
-            'tracks': [[{
-                'path': clip.path,
-                'start_frame': clip.start_frame,
-                'end_frame': clip.end_frame,
-                'position': clip.position
-            } for clip in track] for track in self.tracks],
-            'current_frame': self.current_frame,
-            'current_clip_path': self.current_clip.path if self.current_clip else None
-        }
-        self.undo_stack.append(current_state)
-
-        # Restore next state
-        next_state = self.redo_stack.pop()
-        self.restore_state(next_state)
-
-        return True, "Redo successful"
-
-    def restore_state(self, state):
-        # Restore tracks
-        self.tracks = [[] for _ in range(5)]
-        for track_idx, track_data in enumerate(state['tracks']):
-            for clip_data in track_data:
-                clip = next((c for c in self.video_clips if c.path == clip_data['path']), None)
-                if clip:
-                    new_clip = VideoClip(clip.path)
-                    new_clip.start_frame = clip_data['start_frame']
-                    new_clip.end_frame = clip_data['end_frame']
-                    new_clip.position = clip_data['position']
-                    new_clip.total_frames = clip.total_frames
-                    new_clip.fps = clip.fps
-                    self.tracks[track_idx].append(new_clip)
-
-        # Restore current frame and clip
-        self.current_frame = state['current_frame']
-        if state['current_clip_path']:
-            self.current_clip = next((c for c in self.video_clips if c.path == state['current_clip_path']), None)
\ No newline at end of file
+        self.journal.record(command.records(self))
+        return True, f"Redo: {command.name}"
+
+    def make_timeline_clip(self, clip, clip_data):
+        # Every placement on the timeline is its own object so the index can tell them apart
+        new_clip = VideoClip(clip.path)
+        new_clip.start_frame = clip_data.get('start_frame', clip.start_frame)
+        new_clip.end_frame = clip_data.get('end_frame', clip.end_frame)
+        new_clip.position = clip_data['position']
+        new_clip.total_frames = clip.total_frames
+        new_clip.fps = clip.fps
+        new_clip.effects = [dict(effect) for effect in clip_data.get('effects', [])]
+        new_clip.transitions = [dict(transition) for transition in clip_data.get('transitions', [])]
+        return new_clip
\ No newline at end of file
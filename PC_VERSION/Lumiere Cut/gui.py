@@ -12,6 +12,7 @@ import time
 import pygame
 from functions import VideoEditorFunctions
 from models import VideoClip, AudioClip
+from utils import ExportManager, VideoPlayer, AudioPlayer
 import webbrowser
 
 
@@ -54,6 +55,8 @@ class LumiereCutPro:
 
         # Инициализация функционала
         self.functions = VideoEditorFunctions()
+        self.functions.media.on_ready = lambda path: self.root.after(0, self.update_timeline)
+        self.export_manager = ExportManager(self.functions)
         self.current_frame_image = None
         self.preview_frame_image = None
         self.timeline_images = []
@@ -61,8 +64,13 @@ class LumiereCutPro:
         self.drag_start_x = 0
         self.selected_clip = None
         self.zoom_level = 1.0
-        self.is_playing = False
-        self.playback_thread = None
+        # Воспроизведение по часам: кадры декодируются в потоке плеера, рисуются в потоке Tk.
+        # Пока звучит звук клипа, часы идут по позиции аудио, иначе по time.monotonic()
+        self.audio_player = AudioPlayer()
+        self.player = VideoPlayer(self.show_playback_frame, render=self.functions.get_frame,
+                                  dispatch=lambda fn: self.root.after(0, fn),
+                                  prefetch=self.functions.prefetch_frames,
+                                  audio_position=self.audio_player.position)
 
         self.setup_ui()
         self.create_menu()
@@ -72,6 +80,8 @@ class LumiereCutPro:
         # Автосохранение
         self.setup_auto_save()
 
+        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
+
     def setup_styles(self):
         style = ttk.Style()
         style.theme_use('clam')
@@ -355,7 +365,9 @@ class LumiereCutPro:
         quality_combo.pack(fill=tk.X, pady=(0, 10))
 
         ttk.Button(export_frame, text="Export Video", command=self.export_video,
-                   style='Accent.TButton').pack(fill=tk.X, pady=10)
+                   style='Accent.TButton').pack(fill=tk.X, pady=(10, 0))
+        ttk.Button(export_frame, text="Cancel Export", command=self.cancel_export,
+                   style='Secondary.TButton').pack(fill=tk.X, pady=(5, 10))
 
         self.export_progress = ttk.Progressbar(export_frame, mode='determinate')
         self.export_progress.pack(fill=tk.X, pady=(0, 5))
@@ -427,14 +439,28 @@ class LumiereCutPro:
         self.timeline_menu.add_command(label="Properties", command=self.show_clip_properties)
 
     def setup_auto_save(self):
-        def auto_save_task():
-            while True:
-                time.sleep(300)  # 5 минут
-                if hasattr(self, 'functions') and self.functions.project.file_path:
-                    self.functions.auto_save()
+        # Каждая правка пишется в журнал сразу; после сбоя предлагаем восстановить прошлую сессию
+        def check_recovery():
+            found = self.functions.find_recovery()
+            if found and messagebox.askyesno("Recover", "The last session ended with unsaved changes. Recover them?"):
+                success, message = self.functions.recover_project(None, *found)
+                if success:
+                    self.update_project_info()
+                    self.update_timeline()
+                    return
+                messagebox.showerror("Error", message)
+            self.functions.start_journal()
+
+        self.root.after(0, check_recovery)
 
-        auto_save_thread = threading.Thread(target=auto_save_task, daemon=True)
-        auto_save_thread.start()
+    def on_closing(self):
+        # Потоки чтения кадров останавливаются до выхода интерпретатора, иначе процесс падает при выходе
+        self.player.pause()
+        self.audio_player.stop_audio()
+        if self.player.play_thread and self.player.play_thread.is_alive():
+            self.player.play_thread.join(timeout=1.0)
+        self.functions.decoders.close()
+        self.root.destroy()
 
     # Event handlers and functional methods
     def new_project(self):
@@ -485,7 +511,11 @@ class LumiereCutPro:
             filetypes=[("Lumiere Projects", "*.lumiere"), ("All files", "*.*")]
         )
         if file_path:
-            success, message = self.functions.load_project(file_path)
+            if self.functions.find_recovery(file_path) and messagebox.askyesno(
+                    "Recover", "This project has unsaved changes from a previous session. Recover them?"):
+                success, message = self.functions.recover_project(file_path)
+            else:
+                success, message = self.functions.load_project(file_path)
             if success:
                 self.update_project_info()
                 self.update_timeline()
@@ -596,6 +626,10 @@ class LumiereCutPro:
         self.timeline_canvas.create_text(time_scale_width // 2, header_height // 2,
                                          text="Time", fill=self.text_color, font=self.small_font)
 
+        # Видимая часть холста: миниатюры и волны строятся только для нее
+        visible_width = self.timeline_canvas.winfo_width()
+        self.timeline_images = []
+
         # Рисуем дорожки
         for i, track in enumerate(self.functions.tracks):
             y = header_height + i * track_height
@@ -620,11 +654,57 @@ class LumiereCutPro:
                                                       fill=self.accent_color,
                                                       outline=self.accent_dark, width=2)
 
+                # Миниатюры из кэша, сам видеофайл при этом не декодируется
+                left = max(x, time_scale_width)
+                right = min(x + clip_width, visible_width)
+                if right > left:
+                    strip = self.functions.media.filmstrip(clip.path, clip.start_frame, clip.end_frame,
+                                                           clip_width, left - x, right - left)
+                    if strip is not None:
+                        strip_image = ImageTk.PhotoImage(strip)
+                        self.timeline_images.append(strip_image)
+                        self.timeline_canvas.create_image(left, y + padding, anchor=tk.NW, image=strip_image)
+
                 # Название клипа
                 clip_name = clip.name[:15] + "..." if len(clip.name) > 15 else clip.name
                 self.timeline_canvas.create_text(x + clip_width // 2, y + track_height // 2,
                                                  text=clip_name, fill="white", font=self.small_font)
 
+        # Аудиодорожки с формой волны из кэша пиков
+        fps = self.functions.project.fps
+        for i, track in enumerate(self.functions.audio_tracks):
+            y = header_height + (len(self.functions.tracks) + i) * track_height
+
+            self.timeline_canvas.create_rectangle(0, y, time_scale_width, y + track_height,
+                                                  fill=self.audio_track_colors[i % len(self.audio_track_colors)],
+                                                  outline=self.border_color)
+            self.timeline_canvas.create_text(time_scale_width // 2, y + track_height // 2,
+                                             text=f"A{i + 1}", fill=self.text_color, font=self.small_font)
+
+            for clip in track:
+                clip_width = clip.duration * fps * self.zoom_level
+                x = time_scale_width + clip.position * self.zoom_level
+                self.timeline_canvas.create_rectangle(x, y + padding, x + clip_width, y + track_height - padding,
+                                                      fill=self.card_color, outline=self.accent_dark, width=2)
+
+                left = max(x, time_scale_width)
+                right = min(x + clip_width, visible_width)
+                if right <= left:
+                    continue
+                seconds_per_pixel = clip.duration / clip_width
+                start = clip.start_time + (left - x) * seconds_per_pixel
+                end = clip.start_time + (right - x) * seconds_per_pixel
+                peaks = self.functions.media.waveform(clip.path, start, end, int(right - left))
+                if peaks is None:
+                    continue
+                middle = y + track_height / 2
+                half = clip_height / 2 - padding / 2
+                lows, highs = peaks
+                points = [(left + px, middle - high * half) for px, high in enumerate(highs)]
+                points += [(left + px, middle - low * half) for px, low in reversed(list(enumerate(lows)))]
+                if len(points) >= 3:
+                    self.timeline_canvas.create_polygon(points, fill=self.accent_light, outline="")
+
     def on_timeline_click(self, event):
         # Обработка клика на временной шкале
         pass
@@ -657,22 +737,22 @@ class LumiereCutPro:
         self.update_timeline()
 
     def toggle_playback(self):
-        if self.is_playing:
-            self.is_playing = False
-        else:
-            self.is_playing = True
-            self.playback_thread = threading.Thread(target=self.playback_loop, daemon=True)
-            self.playback_thread.start()
-
-    def playback_loop(self):
-        while self.is_playing and self.functions.current_clip:
-            frame = self.functions.get_frame(self.functions.current_frame)
-            if frame is not None:
-                self.update_preview(frame)
-                self.functions.current_frame += 1
-                time.sleep(1 / self.functions.fps)
-            else:
-                self.is_playing = False
+        if self.player.is_playing:
+            self.player.pause()
+            self.audio_player.stop_audio()
+        elif self.functions.current_clip:
+            clip = self.functions.current_clip
+            fps = clip.fps or self.functions.project.fps
+            self.audio_player.play_audio(clip.path, offset=self.functions.current_frame / fps)
+            self.player.play(self.functions.current_frame, clip.total_frames, fps)
+
+    def show_playback_frame(self, frame_num, frame):
+        if frame is None:
+            self.player.pause()
+            self.audio_player.stop_audio()
+            return
+        self.functions.current_frame = frame_num
+        self.update_preview(frame)
 
     def update_preview(self, frame):
         # Конвертация кадра для отображения в Tkinter
@@ -714,7 +794,12 @@ class LumiereCutPro:
         if self.functions.current_clip:
             frame_num = int(float(value) * self.functions.current_clip.total_frames / 100)
             self.functions.current_frame = frame_num
-            self.update_preview_from_current_frame()
+            if self.player.is_playing:
+                clip = self.functions.current_clip
+                self.audio_player.play_audio(clip.path, offset=frame_num / (clip.fps or self.functions.project.fps))
+                self.player.seek(frame_num)
+            else:
+                self.update_preview_from_current_frame()
 
     def split_clip(self):
         if self.selected_clip:
@@ -799,26 +884,32 @@ class LumiereCutPro:
             defaultextension=".mp4",
             filetypes=[("MP4 files", "*.mp4"), ("AVI files", "*.avi"), ("All files", "*.*")]
         )
-        if output_path:
+        if output_path and not self.export_manager.is_exporting:
             format_type = self.format_var.get().lower()
             quality = self.quality_var.get()
 
-            def export_thread():
-                try:
-                    success, message = self.functions.export_video(output_path, format_type, quality)
+            def on_progress(done, total):
+                value = 100 * done / total if total else 100
+                self.root.after(0, lambda: self.export_progress.config(value=value))
+
+            def on_done(success, message):
+                def report():
                     if success:
                         self.export_status.config(text="Export completed!")
                         messagebox.showinfo("Success", message)
                     else:
                         self.export_status.config(text="Export failed!")
                         messagebox.showerror("Error", message)
-                except Exception as e:
-                    self.export_status.config(text=f"Error: {str(e)}")
-                    messagebox.showerror("Error", f"Export failed: {str(e)}")
+                self.root.after(0, report)
 
-            threading.Thread(target=export_thread, daemon=True).start()
+            self.export_manager.start_export(output_path, on_progress, format_type, quality, on_done)
             self.export_status.config(text="Exporting...")
 
+    def cancel_export(self):
+        if self.export_manager.is_exporting:
+            self.export_manager.cancel_export()
+            self.export_status.config(text="Cancelling...")
+
     def undo(self):
         success, message = self.functions.undo()
         if success:
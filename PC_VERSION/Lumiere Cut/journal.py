@@ -0,0 +1,202 @@
+# journal.py
+import glob
+import json
+import os
+import queue
+import tempfile
+import threading
+
+COMPACT_RECORDS = 1000  # Journal records after which the snapshot is rewritten
+COMPACT_INTERVAL = 300  # Seconds of quiet after which pending records are folded into the snapshot
+
+
+def autosave_paths(project_path=None, name="Untitled Project"):
+    # (snapshot, journal) next to the project file, or in the temp directory for unsaved projects
+    if project_path:
+        base = os.path.splitext(project_path)[0] + "_autosave"
+    else:
+        base = os.path.join(tempfile.gettempdir(), f"autosave_{name}")
+    return base + ".lumiere", base + ".journal"
+
+
+def write_atomic(path, data, indent=None):
+    # The snapshot is replaced in one rename, a crash leaves either the old or the new file, never half of one
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, "w") as f:
+            json.dump(data, f, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def apply_record(data, record):
+    # Replays one edit on the saved-project dict: clips are addressed by track and position in the track
+    op = record["op"]
+    if op == "video":
+        data["video_clips"].append(record["clip"])
+        return
+    if op == "audio":
+        data["audio_clips"].append(record["clip"])
+        return
+    tracks = data.setdefault("tracks", [])
+    while len(tracks) <= record["track"]:
+        tracks.append([])
+    track = tracks[record["track"]]
+    index = record["index"]
+    if op == "add":
+        track.insert(index, record["clip"])
+    elif op == "remove":
+        del track[index]
+    elif op == "set":
+        track[index].update(record["fields"])
+    elif op == "append":
+        track[index].setdefault(record["attribute"], []).append(record["item"])
+    elif op == "pop":
+        track[index][record["attribute"]].pop()
+
+
+def read_journal(journal_path, data):
+    # Applies the records the snapshot does not contain yet; a torn last line from a crash is ignored
+    applied = 0
+    if not os.path.exists(journal_path):
+        return applied
+    first = data.get("journal_seq", 0)
+    with open(journal_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if record["seq"] > first:
+                apply_record(data, record)
+                data["journal_seq"] = record["seq"]
+                applied += 1
+    return applied
+
+
+def snapshot_seq(snapshot_path):
+    try:
+        with open(snapshot_path) as f:
+            return json.load(f).get("journal_seq", 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def find_recovery(project_path=None):
+    # Autosave snapshot of a session that ended without saving, None when there is nothing to recover
+    if project_path:
+        candidates = [autosave_paths(project_path)]
+    else:
+        snapshots = glob.glob(os.path.join(tempfile.gettempdir(), "autosave_*.lumiere"))
+        candidates = [(path, path[:-len(".lumiere")] + ".journal") for path in snapshots]
+    saved = os.path.getmtime(project_path) if project_path and os.path.exists(project_path) else 0
+    found = None
+    for snapshot_path, journal_path in candidates:
+        pending = os.path.exists(journal_path) and os.path.getsize(journal_path) > 0
+        # A snapshot taken when the project was opened holds no edits, only compacted ones count
+        compacted = (os.path.exists(snapshot_path) and os.path.getmtime(snapshot_path) > saved
+                     and snapshot_seq(snapshot_path) > 0)
+        if (pending or compacted) and (os.path.exists(snapshot_path) or project_path):
+            mtime = max(os.path.getmtime(path) for path in (snapshot_path, journal_path) if os.path.exists(path))
+            if found is None or mtime > found[0]:
+                found = (mtime, snapshot_path, journal_path)
+    return found and found[1:]
+
+
+def recover(project_path=None, snapshot_path=None, journal_path=None):
+    # Project dict rebuilt from the autosave snapshot (or the project file) plus the journal after it
+    if snapshot_path is None:
+        snapshot_path, journal_path = autosave_paths(project_path)
+    source = snapshot_path if os.path.exists(snapshot_path) else project_path
+    with open(source) as f:
+        data = json.load(f)
+    applied = read_journal(journal_path, data)
+    return data, applied
+
+
+# Writes every edit as one appended line and now and then folds the journal into a snapshot. The writer
+# thread keeps its own copy of the project as plain data, so the editing thread only pays for encoding
+# the edit itself and never waits on the disk, whatever the size of the project.
+class ProjectJournal:
+    def __init__(self):
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._write_thread, daemon=True)
+        self.worker.start()
+
+    def start(self, data_text, snapshot_path, journal_path, write_snapshot=True):
+        # data_text is the project as JSON; without a snapshot the journal applies on top of the project file
+        self.requests.put(("start", (data_text, snapshot_path, journal_path, write_snapshot)))
+
+    def record(self, records):
+        if records:
+            self.requests.put(("records", [json.dumps(record) for record in records]))
+
+    def checkpoint(self):
+        self.requests.put(("compact", None))
+
+    def flush(self):
+        # Blocks until everything queued so far is on disk
+        done = threading.Event()
+        self.requests.put(("flush", done))
+        done.wait()
+
+    def _write_thread(self):
+        data = None
+        journal = None
+        snapshot_path = None
+        seq = 0
+        pending = 0
+        while True:
+            try:
+                kind, payload = self.requests.get(timeout=COMPACT_INTERVAL)
+            except queue.Empty:
+                kind, payload = "compact", None
+            try:
+                if kind == "start":
+                    if journal:
+                        journal.close()
+                    data_text, snapshot_path, journal_path, write_snapshot = payload
+                    data = json.loads(data_text)
+                    seq = data.get("journal_seq", 0)
+                    pending = 0
+                    os.makedirs(os.path.dirname(os.path.abspath(journal_path)), exist_ok=True)
+                    if seq:
+                        # Recovered data continues the old journal: the snapshot skips its records by seq,
+                        # so it is written before the journal is cleared
+                        write_atomic(snapshot_path, data)
+                        journal = open(journal_path, "w")
+                    else:
+                        # A fresh start clears the old journal first, a leftover snapshot alone is still whole
+                        journal = open(journal_path, "w")
+                        if write_snapshot:
+                            write_atomic(snapshot_path, data)
+                        elif os.path.exists(snapshot_path):
+                            os.remove(snapshot_path)
+                elif kind == "records" and journal:
+                    for line in payload:
+                        record = json.loads(line)
+                        seq += 1
+                        record["seq"] = seq
+                        journal.write(json.dumps(record) + "\n")
+                        apply_record(data, record)
+                    journal.flush()
+                    pending += len(payload)
+                    if pending >= COMPACT_RECORDS:
+                        kind = "compact"
+                elif kind == "flush":
+                    payload.set()
+                if kind == "compact" and journal and pending:
+                    data["journal_seq"] = seq
+                    write_atomic(snapshot_path, data)
+                    journal.seek(0)
+                    journal.truncate()
+                    pending = 0
+            except Exception as e:
+                print(f"Error writing autosave: {str(e)}")
+                if kind == "flush":
+                    payload.set()
@@ -0,0 +1,303 @@
+# media_cache.py
+import hashlib
+import json
+import math
+import os
+import queue
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import wave
+import cv2
+import numpy as np
+from PIL import Image
+
+THUMB_HEIGHT = 40
+SHEET_COLUMNS = 64  # Thumbnails per row of a sheet, keeps JPEG sheets well under the 65535 px limit
+MAX_THUMBS = 4096  # The finest filmstrip level never holds more thumbnails than this
+LEVEL_FACTOR = 4  # Every coarser filmstrip or peak level keeps one entry out of this many
+PEAK_RATE = 48000
+PEAK_BLOCK = 256  # Samples per min/max pair in the finest peak level
+
+
+def cache_key(path):
+    # Any change to the file's size or modification time gives it a new key, so stale entries are never read
+    stat = os.stat(path)
+    return hashlib.sha1(f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}".encode()).hexdigest()
+
+
+def probe_duration(path):
+    # Reads the duration from the file header instead of decoding the whole file; None when it is unknown
+    try:
+        if path.lower().endswith(".wav"):
+            with wave.open(path, "rb") as f:
+                return f.getnframes() / f.getframerate()
+        ffmpeg = shutil.which("ffmpeg")
+        if ffmpeg:
+            result = subprocess.run([ffmpeg, "-hide_banner", "-i", path], capture_output=True, text=True)
+            match = re.search(r"Duration: (\d+):(\d+):(\d+\.\d+)", result.stderr)
+            if match:
+                hours, minutes, seconds = match.groups()
+                return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except (OSError, wave.Error, EOFError):
+        pass
+    return None
+
+
+def audio_chunks(path):
+    # Mono int16 samples at PEAK_RATE, through ffmpeg when it is available or straight from 16-bit WAV files
+    ffmpeg = shutil.which("ffmpeg")
+    chunk = PEAK_RATE * PEAK_BLOCK // 64
+    if ffmpeg:
+        command = [ffmpeg, "-loglevel", "error", "-i", path, "-vn", "-f", "s16le", "-ac", "1",
+                   "-ar", str(PEAK_RATE), "pipe:1"]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            while True:
+                data = process.stdout.read(chunk * 2)
+                if not data:
+                    break
+                yield np.frombuffer(data[:len(data) & ~1], dtype=np.int16), PEAK_RATE
+        finally:
+            process.stdout.close()
+            process.wait()
+    elif path.lower().endswith(".wav"):
+        with wave.open(path, "rb") as f:
+            if f.getsampwidth() != 2:
+                return
+            channels = f.getnchannels()
+            while True:
+                data = f.readframes(chunk)
+                if not data:
+                    break
+                samples = np.frombuffer(data, dtype=np.int16).reshape(-1, channels)
+                yield samples.mean(axis=1).astype(np.int16), f.getframerate()
+
+
+def reduce_peaks(peaks, factor):
+    # Merges every `factor` min/max pairs into one
+    count = len(peaks) // factor * factor
+    if count == 0:
+        return peaks[:0]
+    grouped = peaks[:count].reshape(-1, factor, 2)
+    reduced = np.empty((len(grouped), 2), dtype=peaks.dtype)
+    reduced[:, 0] = grouped[:, :, 0].min(axis=1)
+    reduced[:, 1] = grouped[:, :, 1].max(axis=1)
+    if count < len(peaks):
+        tail = peaks[count:]
+        reduced = np.vstack([reduced, [[tail[:, 0].min(), tail[:, 1].max()]]])
+    return reduced
+
+
+# Filmstrip thumbnails and audio peak files built once per media file in the background. Timeline drawing
+# only reads from here and never touches the media itself.
+class MediaCache:
+    def __init__(self, cache_dir=None, on_ready=None):
+        self.cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), "lumiere_cache", "media")
+        self.on_ready = on_ready
+        self.entries = {}  # path -> (key, info) of the finished cache entries
+        self.sheets = {}  # (key, level) -> PIL sheet image
+        self.peaks = {}  # key -> list of (min, max) arrays, finest level first
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._build_thread, daemon=True)
+        self.worker.start()
+
+    def set_cache_dir(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def entry_path(self, key, suffix):
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def build(self, path, kind="video"):
+        with self.lock:
+            if path in self.queued:
+                return
+            self.queued.add(path)
+        self.requests.put((path, kind))
+
+    def _build_thread(self):
+        while True:
+            path, kind = self.requests.get()
+            try:
+                key = cache_key(path)
+                info = self.load_info(key)
+                if info is None:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    info = self.build_filmstrip(path, key) if kind == "video" else self.build_peaks(path, key)
+                    with open(self.entry_path(key, ".json"), "w") as f:
+                        json.dump(info, f)
+                with self.lock:
+                    self.entries[path] = (key, info)
+                if self.on_ready:
+                    self.on_ready(path)
+            except Exception as e:
+                print(f"Error building media cache: {str(e)}")
+            finally:
+                with self.lock:
+                    self.queued.discard(path)
+
+    def load_info(self, key):
+        try:
+            with open(self.entry_path(key, ".json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def lookup(self, path):
+        # Entries built in another session are picked up here as long as the file has not changed
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is not None:
+            return entry
+        if not os.path.exists(path):
+            return None
+        key = cache_key(path)
+        info = self.load_info(key)
+        if info is None:
+            return None
+        with self.lock:
+            self.entries[path] = (key, info)
+        return key, info
+
+    # Filmstrips
+
+    def build_filmstrip(self, path, key):
+        capture = cv2.VideoCapture(path)
+        try:
+            total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            thumb_size = (max(1, round(width * THUMB_HEIGHT / max(1, height))), THUMB_HEIGHT)
+            step = max(1, math.ceil(total / MAX_THUMBS))
+            # One sequential pass: frames between thumbnails are only grabbed, not converted
+            thumbs = []
+            frame_num = 0
+            while capture.grab():
+                if frame_num % step == 0:
+                    ret, frame = capture.retrieve()
+                    if not ret:
+                        break
+                    thumbs.append(cv2.resize(frame, thumb_size, interpolation=cv2.INTER_AREA))
+                frame_num += 1
+        finally:
+            capture.release()
+        steps = []
+        level = 0
+        while thumbs:
+            self.write_sheet(key, level, thumbs, thumb_size)
+            steps.append(step)
+            if len(thumbs) == 1:
+                break
+            thumbs = thumbs[::LEVEL_FACTOR]
+            step *= LEVEL_FACTOR
+            level += 1
+        return {"type": "video", "frames": frame_num, "thumb_size": thumb_size, "steps": steps}
+
+    def write_sheet(self, key, level, thumbs, thumb_size):
+        columns = min(SHEET_COLUMNS, len(thumbs))
+        rows = math.ceil(len(thumbs) / columns)
+        sheet = np.zeros((rows * thumb_size[1], columns * thumb_size[0], 3), dtype=np.uint8)
+        for index, thumb in enumerate(thumbs):
+            y, x = divmod(index, columns)
+            sheet[y * thumb_size[1]:(y + 1) * thumb_size[1], x * thumb_size[0]:(x + 1) * thumb_size[0]] = thumb
+        cv2.imwrite(self.entry_path(key, f"_strip{level}.jpg"), sheet, [cv2.IMWRITE_JPEG_QUALITY, 85])
+
+    def sheet(self, key, level):
+        image = self.sheets.get((key, level))
+        if image is None:
+            with Image.open(self.entry_path(key, f"_strip{level}.jpg")) as f:
+                image = f.convert("RGB")
+            self.sheets[(key, level)] = image
+        return image
+
+    def filmstrip(self, path, start_frame, end_frame, width, offset=0, visible=None):
+        # Thumbnails tiled along a clip drawn `width` pixels wide for source frames start_frame..end_frame.
+        # offset and visible restrict the result to the part of the clip that is on screen.
+        # Returns None until the cache entry for the file exists.
+        entry = self.lookup(path)
+        if entry is None or width <= 0:
+            return None
+        key, info = entry
+        thumb_width, thumb_height = info["thumb_size"]
+        frames_per_pixel = (end_frame - start_frame) / width
+        # The coarsest level that still has a thumbnail for every slot drawn on screen
+        level = 0
+        while level + 1 < len(info["steps"]) and info["steps"][level + 1] <= thumb_width * frames_per_pixel:
+            level += 1
+        step = info["steps"][level]
+        sheet = self.sheet(key, level)
+        columns = sheet.width // thumb_width
+        count = columns * (sheet.height // thumb_height)
+        visible = width - offset if visible is None else visible
+        strip = Image.new("RGB", (max(1, int(visible)), thumb_height))
+        first_slot = int(offset // thumb_width)
+        for slot in range(first_slot, int((offset + visible) // thumb_width) + 1):
+            frame_num = start_frame + slot * thumb_width * frames_per_pixel
+            index = min(count - 1, max(0, int(frame_num // step)))
+            y, x = divmod(index, columns)
+            thumb = sheet.crop((x * thumb_width, y * thumb_height, (x + 1) * thumb_width, (y + 1) * thumb_height))
+            strip.paste(thumb, (int(slot * thumb_width - offset), 0))
+        return strip
+
+    # Audio peaks
+
+    def build_peaks(self, path, key):
+        # Min/max pairs per PEAK_BLOCK samples, then coarser levels of LEVEL_FACTOR blocks each
+        blocks = []
+        rest = np.zeros(0, dtype=np.int16)
+        rate = PEAK_RATE
+        samples_total = 0
+        for samples, rate in audio_chunks(path):
+            samples_total += len(samples)
+            samples = np.concatenate([rest, samples])
+            count = len(samples) // PEAK_BLOCK * PEAK_BLOCK
+            grouped = samples[:count].reshape(-1, PEAK_BLOCK)
+            blocks.append(np.stack([grouped.min(axis=1), grouped.max(axis=1)], axis=1))
+            rest = samples[count:]
+        if len(rest):
+            blocks.append(np.array([[rest.min(), rest.max()]], dtype=np.int16))
+        peaks = np.concatenate(blocks) if blocks else np.zeros((0, 2), dtype=np.int16)
+        levels = {}
+        level = 0
+        while True:
+            levels[f"level{level}"] = peaks
+            if len(peaks) <= 1:
+                break
+            peaks = reduce_peaks(peaks, LEVEL_FACTOR)
+            level += 1
+        np.savez(self.entry_path(key, "_peaks.npz"), **levels)
+        return {"type": "audio", "rate": rate, "samples": samples_total, "duration": samples_total / rate,
+                "block": PEAK_BLOCK, "levels": len(levels)}
+
+    def waveform(self, path, start_time, end_time, width):
+        # Min/max per pixel as floats in -1..1 for a clip drawn `width` pixels wide, None until it is built
+        entry = self.lookup(path)
+        if entry is None or width <= 0:
+            return None
+        key, info = entry
+        levels = self.peaks.get(key)
+        if levels is None:
+            with np.load(self.entry_path(key, "_peaks.npz")) as data:
+                levels = [data[f"level{level}"] for level in range(info["levels"])]
+            self.peaks[key] = levels
+        samples_per_pixel = (end_time - start_time) * info["rate"] / width
+        level = 0
+        block = info["block"]
+        while level + 1 < len(levels) and block * LEVEL_FACTOR <= samples_per_pixel:
+            level += 1
+            block *= LEVEL_FACTOR
+        peaks = levels[level]
+        first = int(start_time * info["rate"] / block)
+        last = max(first + 1, int(math.ceil(end_time * info["rate"] / block)))
+        peaks = peaks[first:last]
+        if len(peaks) == 0:
+            return None
+        bounds = np.linspace(0, len(peaks), int(width) + 1).astype(np.int64)[:-1]
+        bounds = np.minimum(bounds, len(peaks) - 1)
+        lows = np.minimum.reduceat(peaks[:, 0], bounds)
+        highs = np.maximum.reduceat(peaks[:, 1], bounds)
+        return lows / 32768.0, highs / 32768.0
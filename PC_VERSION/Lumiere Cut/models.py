@@ -23,6 +23,7 @@ class VideoClip:
         self.total_frames = 0
         self.fps = 0
         self.duration = 0
+        self.opacity = 1.0
         self.effects = []
         self.transitions = []
 
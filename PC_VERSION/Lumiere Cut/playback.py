@@ -0,0 +1,153 @@
+# playback.py
+import threading
+import time
+
+READ_AHEAD = 15  # Displayed frames decoded ahead of the playhead
+
+
+# Where the playhead should be right now. Follows the audio output while it is playing at 1x and
+# time.monotonic() otherwise, so decode time and sleep() jitter never add up to drift.
+class PlaybackClock:
+    def __init__(self, fps, speed=1.0, audio_position=None):
+        self.fps = fps
+        self.speed = speed
+        self.audio_position = audio_position  # Callable returning timeline seconds or None
+        self.start(0)
+
+    def start(self, frame_num):
+        self.origin_frame = frame_num
+        self.origin_time = time.monotonic()
+
+    def frame(self):
+        # Fractional timeline frame that is due on screen now
+        if self.audio_position is not None and self.speed == 1.0:
+            seconds = self.audio_position()
+            if seconds is not None:
+                return seconds * self.fps
+        return self.origin_frame + (time.monotonic() - self.origin_time) * self.fps * self.speed
+
+    def wait_time(self, frame_num):
+        # Seconds until frame_num is due, negative once it is late
+        return (frame_num - self.frame()) / (self.fps * self.speed)
+
+
+# Playback loop shared by the players. Each tick shows the frame the clock is at: frames that became late
+# while decoding, or while the UI was still drawing the previous one, are dropped instead of queued.
+class ClockedPlayer:
+    def __init__(self, update_callback, render=None, dispatch=None, prefetch=None, audio_position=None):
+        self.is_playing = False
+        self.update_callback = update_callback  # callback(frame_num), or callback(frame_num, frame) with render
+        self.render = render  # frame_num -> frame, runs on the playback thread
+        self.dispatch = dispatch  # Runs a function on the UI thread, e.g. lambda fn: root.after(0, fn)
+        self.prefetch = prefetch  # (frame_num, count) -> starts decoding frames ahead of the playhead
+        self.audio_position = audio_position
+        self.play_thread = None
+        self.current_frame = 0
+        self.end_frame = 0
+        self.fps = 30
+        self.playback_speed = 1.0
+        self.clock = None
+        self.restart_frame = None
+        self.wake = threading.Event()
+        self.idle = threading.Event()  # Cleared while a dispatched frame waits for the UI thread
+        self.idle.set()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.shown_frames = 0
+        self.dropped_frames = 0
+        self.latency = 0.0  # Seconds between the last frame's due time and handing it to the UI
+        self.max_latency = 0.0
+
+    def stats(self):
+        return {"shown": self.shown_frames, "dropped": self.dropped_frames,
+                "latency": self.latency, "max_latency": self.max_latency}
+
+    def start(self, current_frame, end_frame, fps, speed=1.0):
+        if self.is_playing:
+            return
+        self.is_playing = True
+        self.current_frame = current_frame
+        self.end_frame = end_frame
+        self.fps = fps
+        self.playback_speed = speed
+        self.reset_stats()
+        self.clock = PlaybackClock(fps, speed, self.audio_position)
+        self.clock.start(current_frame)
+        self.restart_frame = None
+        self.wake.clear()
+        self.idle.set()
+        self.play_thread = threading.Thread(target=self._play_thread)
+        self.play_thread.daemon = True
+        self.play_thread.start()
+
+    def _play_thread(self):
+        clock = self.clock
+        # Never more frames per second than the project rate, faster speeds step over frames instead
+        step = max(1, round(self.playback_speed))
+        last = int(self.end_frame) - 1
+        due = int(self.current_frame) + step
+        # A restarted player gets a new clock, which ends a thread still sleeping from before the pause
+        while self.is_playing and self.clock is clock and self.current_frame < last:
+            if self.restart_frame is not None:
+                due = self.restart_frame + step
+                self.restart_frame = None
+            wait = clock.wait_time(due)
+            if wait > 0:
+                self.wake.wait(wait)
+                self.wake.clear()
+                continue
+            frame_num = min(last, max(due, int(clock.frame())))
+            self.dropped_frames += (frame_num - due) // step
+            if self.prefetch:
+                self.prefetch(frame_num + step, READ_AHEAD * step)
+            frame = self.render(frame_num) if self.render else None
+            if not self.is_playing or self.clock is not clock or self.restart_frame is not None:
+                continue
+            if self.show(frame_num, frame, frame_num == last):
+                self.shown_frames += 1
+            else:
+                self.dropped_frames += 1
+            self.latency = max(0.0, -clock.wait_time(frame_num))
+            self.max_latency = max(self.max_latency, self.latency)
+            self.current_frame = frame_num
+            due = frame_num + step
+        if self.clock is clock:
+            self.is_playing = False
+
+    def show(self, frame_num, frame, final=False):
+        if self.dispatch is None:
+            self.deliver(frame_num, frame)
+            return True
+        # The last frame waits for the UI so playback always ends on it
+        if not self.idle.wait(1.0 if final else 0):
+            return False
+        self.idle.clear()
+        self.dispatch(lambda: self.deliver(frame_num, frame))
+        return True
+
+    def deliver(self, frame_num, frame):
+        try:
+            if self.update_callback:
+                if self.render:
+                    self.update_callback(frame_num, frame)
+                else:
+                    self.update_callback(frame_num)
+        finally:
+            self.idle.set()
+
+    def pause(self):
+        self.is_playing = False
+        self.wake.set()
+
+    def stop(self):
+        self.pause()
+        self.current_frame = 0
+
+    def seek(self, frame_num):
+        self.current_frame = frame_num
+        if self.is_playing:
+            self.clock.start(frame_num)
+            self.restart_frame = frame_num
+            self.wake.set()
+        self.deliver(int(frame_num), self.render(int(frame_num)) if self.render else None)
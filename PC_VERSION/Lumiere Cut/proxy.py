@@ -0,0 +1,100 @@
+# proxy.py
+import hashlib
+import os
+import queue
+import tempfile
+import threading
+import cv2
+
+PROXY_HEIGHT = 540
+PROXY_QUALITY = 80  # MJPEG quality, every frame is a keyframe so seeking never decodes a GOP
+HASH_SAMPLE = 4 * 1024 * 1024  # Bytes hashed from each end of a file
+
+
+def content_hash(path):
+    # Size plus the head and tail of the file: unique enough for media and fast even for huge 4K files
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size).encode())
+    with open(path, "rb") as f:
+        digest.update(f.read(HASH_SAMPLE))
+        if size > 2 * HASH_SAMPLE:
+            f.seek(size - HASH_SAMPLE)
+            digest.update(f.read(HASH_SAMPLE))
+    return digest.hexdigest()
+
+
+# Transcodes imported clips to small MJPEG proxies on a background thread. Previews read the proxy
+# once it is ready, export always reads the original.
+class ProxyManager:
+    def __init__(self, cache_dir=None, on_ready=None):
+        self.cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), "lumiere_cache", "proxies")
+        self.on_ready = on_ready
+        self.proxies = {}  # original path -> proxy path, or None when the original is small enough
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._generate_thread, daemon=True)
+        self.worker.start()
+
+    def set_cache_dir(self, cache_dir):
+        # Proxies that are already done keep their location, new ones go to the project's cache
+        self.cache_dir = cache_dir
+
+    def generate(self, path):
+        with self.lock:
+            if path in self.proxies or path in self.queued:
+                return
+            self.queued.add(path)
+        self.requests.put(path)
+
+    def proxy_for(self, path):
+        return self.proxies.get(path)
+
+    def preview_path(self, path):
+        return self.proxies.get(path) or path
+
+    def _generate_thread(self):
+        while True:
+            path = self.requests.get()
+            try:
+                proxy = self.build_proxy(path)
+            except Exception as e:
+                print(f"Error creating proxy: {str(e)}")
+                proxy = None
+            with self.lock:
+                self.queued.discard(path)
+                self.proxies[path] = proxy
+            if proxy and self.on_ready:
+                self.on_ready(path, proxy)
+
+    def build_proxy(self, path):
+        capture = cv2.VideoCapture(path)
+        try:
+            if not capture.isOpened():
+                return None
+            width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            if height <= PROXY_HEIGHT:
+                return None
+            os.makedirs(self.cache_dir, exist_ok=True)
+            proxy = os.path.join(self.cache_dir, content_hash(path) + ".avi")
+            if os.path.exists(proxy):
+                return proxy
+            size = (max(2, round(width * PROXY_HEIGHT / height)) & ~1, PROXY_HEIGHT)
+            fps = capture.get(cv2.CAP_PROP_FPS) or 30
+            # Written under a temporary name so a cancelled transcode never looks like a finished proxy
+            partial = proxy[:-len(".avi")] + ".part.avi"
+            writer = cv2.VideoWriter(partial, cv2.VideoWriter_fourcc(*"MJPG"), fps, size)
+            writer.set(cv2.VIDEOWRITER_PROP_QUALITY, PROXY_QUALITY)
+            try:
+                while True:
+                    ret, frame = capture.read()
+                    if not ret:
+                        break
+                    writer.write(cv2.resize(frame, size, interpolation=cv2.INTER_AREA))
+            finally:
+                writer.release()
+            os.replace(partial, proxy)
+            return proxy
+        finally:
+            capture.release()
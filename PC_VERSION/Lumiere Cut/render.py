@@ -0,0 +1,652 @@
+# render.py
+import bisect
+import functools
+import math
+import multiprocessing
+import os
+import queue
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+import cv2
+import numpy as np
+from decoder import SourceDecoder
+from effects import compile_effects
+from timeline import clip_interval
+
+SAMPLE_RATE = 48000
+CHANNELS = 2
+READ_AHEAD = 8  # Decoded frames buffered per source
+PREROLL = 30  # Open a source this many frames before the plan first needs it
+MIN_SEGMENT = 60  # Frames, shorter segments cost more in encoder start-up than they gain
+
+
+# Output codec as ffmpeg names it when probing a source, for the formats whose segments can be stream-copied
+COPY_CODECS = {"libx264": "h264"}
+
+
+class ExportCancelled(Exception):
+    pass
+
+# Export format -> (ffmpeg video codec, ffmpeg audio codec, OpenCV fourcc when ffmpeg is missing)
+FORMATS = {
+    "mp4": ("libx264", "aac", "mp4v"),
+    "mov": ("libx264", "aac", "mp4v"),
+    "avi": ("mpeg4", "pcm_s16le", "XVID"),
+    "wmv": ("wmv2", "wmav2", "WMV2"),
+}
+# Quality -> (x264 crf, qscale for the older codecs)
+QUALITY = {"Low": (28, 8), "Medium": (23, 5), "High": (20, 3), "Ultra": (17, 2)}
+
+
+# One clip placed on the timeline and the source frames the export reads from it, in timeline order
+class ClipSource:
+    def __init__(self, clip, start, length, fps):
+        self.clip = clip
+        self.start = start
+        self.end = start + length
+        self.rate = (clip.fps or fps) / fps
+        self.last = max(clip.total_frames, clip.end_frame) - 1
+        self.frames = []
+        self.first = None
+        self.reader = None
+
+    def source_frame(self, frame_num):
+        # Frames before the start or after the end are only asked for by transitions and hold the edge
+        frame = self.clip.start_frame + int((frame_num - self.start) * self.rate)
+        return min(max(frame, 0), self.last)
+
+    def need(self, frame_num):
+        if self.first is None:
+            self.first = frame_num
+        self.frames.append(self.source_frame(frame_num))
+
+
+# A track's contribution to one output frame: a single clip, or two clips mixed by a transition
+class PlanLayer:
+    def __init__(self, sources, opacity=1.0, kind=None, progress=0.0):
+        self.sources = sources
+        self.opacity = opacity
+        self.kind = kind
+        self.progress = progress
+
+    def is_opaque(self):
+        return self.opacity >= 1 and self.kind is None
+
+
+def build_plan(tracks, fps, total_frames, first_frame=0, last_frame=None):
+    # Per output frame in first_frame..last_frame, the layers to composite from bottom to top.
+    # The first track is drawn on top.
+    last_frame = total_frames if last_frame is None else last_frame
+    plan = [[] for _ in range(total_frames)]
+    sources = []
+    for track in reversed(tracks):
+        track_sources = []
+        for clip in track:
+            start, end = clip_interval(clip, fps)
+            if end > start:
+                track_sources.append(ClipSource(clip, start, end - start, fps))
+        track_sources.sort(key=lambda source: source.start)
+        layers = {}
+        for source in track_sources:
+            for frame_num in range(max(0, source.start), min(total_frames, source.end)):
+                layers[frame_num] = PlanLayer((source,), getattr(source.clip, "opacity", 1.0))
+        for index, source in enumerate(track_sources[:-1]):
+            incoming = track_sources[index + 1]
+            for transition in getattr(source.clip, "transitions", []):
+                # Centred on the cut, the outgoing clip holds on past its end and the incoming one pre-rolls
+                duration = max(1, int(transition.get("duration", fps)))
+                first = source.end - duration // 2
+                for step in range(duration):
+                    frame_num = first + step
+                    if 0 <= frame_num < total_frames:
+                        progress = (step + 1) / (duration + 1)
+                        opacity = (getattr(source.clip, "opacity", 1.0) * (1 - progress) +
+                                   getattr(incoming.clip, "opacity", 1.0) * progress)
+                        layers[frame_num] = PlanLayer((source, incoming), opacity, transition["type"], progress)
+        for frame_num, layer in layers.items():
+            plan[frame_num].append(layer)
+        sources += track_sources
+
+    # Layers under an opaque full-frame clip are never seen, so they are not decoded at all
+    plan = plan[first_frame:last_frame]
+    for frame_num, layers in enumerate(plan, first_frame):
+        for index in range(len(layers) - 1, 0, -1):
+            if layers[index].is_opaque():
+                del layers[:index]
+                break
+        for layer in layers:
+            for source in layer.sources:
+                source.need(frame_num)
+    return plan, [source for source in sources if source.frames]
+
+
+def split_points(tracks, fps, total_frames, segments):
+    # Frames where the export is cut into segments: the clip boundary nearest to each even split,
+    # or the even split itself when no boundary is close enough
+    if segments <= 1 or total_frames <= 1:
+        return [0, total_frames]
+    boundaries = sorted({frame for track in tracks for clip in track for frame in clip_interval(clip, fps)
+                         if 0 < frame < total_frames})
+    length = total_frames / segments
+    points = [0]
+    for index in range(1, segments):
+        target = round(index * length)
+        position = bisect.bisect_left(boundaries, target)
+        nearby = [boundaries[i] for i in (position - 1, position) if 0 <= i < len(boundaries)]
+        best = min(nearby, key=lambda frame: abs(frame - target), default=target)
+        point = best if abs(best - target) <= length / 4 else target
+        if point > points[-1]:
+            points.append(point)
+    if points[-1] < total_frames:
+        points.append(total_frames)
+    return points
+
+
+def prepare_frame(clip, frame, resolution):
+    # Scaling to the project resolution and clip effects, applied to every decoded frame
+    effects = tuple((effect['type'], effect['value']) for effect in getattr(clip, 'effects', []))
+    return compile_effects(effects, tuple(resolution)).apply(frame)
+
+
+def transition_frame(kind, outgoing, incoming, progress):
+    if outgoing is None or incoming is None:
+        return incoming if outgoing is None else outgoing
+    height, width = outgoing.shape[:2]
+    kind = kind.lower()
+    if kind == "slide":
+        # The incoming clip pushes the outgoing one out to the left
+        shift = int(round(width * progress))
+        frame = np.empty_like(outgoing)
+        frame[:, :width - shift] = outgoing[:, shift:]
+        frame[:, width - shift:] = incoming[:, :shift]
+        return frame
+    if kind == "wipe":
+        edge = int(round(width * progress))
+        frame = outgoing.copy()
+        frame[:, :edge] = incoming[:, :edge]
+        return frame
+    if kind in ("zoom", "rotate"):
+        # The incoming clip grows out of the centre, turning a half circle for rotate
+        angle = (1 - progress) * 180 if kind == "rotate" else 0
+        matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, progress)
+        frame = outgoing.copy()
+        cv2.warpAffine(incoming, matrix, (width, height), dst=frame, borderMode=cv2.BORDER_TRANSPARENT)
+        return frame
+    return cv2.addWeighted(incoming, progress, outgoing, 1 - progress, 0)
+
+
+def composite(layers, width, height):
+    # layers is a list of (PlanLayer, decoded frames of its sources), bottom to top
+    frame = None
+    for layer, frames in layers:
+        image = frames[0] if layer.kind is None else transition_frame(layer.kind, frames[0], frames[1],
+                                                                      layer.progress)
+        if image is None:
+            continue
+        if layer.opacity >= 1:
+            frame = image
+        else:
+            if frame is None:
+                frame = np.zeros((height, width, 3), dtype=np.uint8)
+            frame = cv2.addWeighted(image, layer.opacity, frame, 1 - layer.opacity, 0)
+    return frame if frame is not None else np.zeros((height, width, 3), dtype=np.uint8)
+
+
+# Decodes the frames one source needs on its own thread, keeping its capture open and reading forward
+class ClipReader(threading.Thread):
+    def __init__(self, source, process):
+        super().__init__(daemon=True)
+        self.source = source
+        self.process = process
+        self.frames = queue.Queue(READ_AHEAD)
+        self.stopped = False
+        self.error = None
+
+    def run(self):
+        decoder = SourceDecoder(self.source.clip.path)
+        previous_num, previous = None, None
+        try:
+            for frame_num in self.source.frames:
+                if frame_num != previous_num:
+                    frame = decoder.read(frame_num)
+                    previous = self.process(self.source.clip, frame) if frame is not None else None
+                    previous_num = frame_num
+                while not self.stopped:
+                    try:
+                        self.frames.put(previous, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if self.stopped:
+                    break
+        except Exception as e:
+            self.error = e
+            self.frames.put(None)
+        finally:
+            decoder.release()
+
+    def next_frame(self):
+        frame = self.frames.get()
+        if self.error is not None:
+            raise self.error
+        return frame
+
+    def stop(self):
+        self.stopped = True
+        self.join()
+
+
+# Writes frames to an ffmpeg process through a pipe, or to cv2.VideoWriter without audio when ffmpeg is missing
+class Encoder:
+    def __init__(self, output_path, format_type, quality, resolution, fps, audio_path=None):
+        video_codec, audio_codec, fourcc = FORMATS.get(format_type, FORMATS["mp4"])
+        crf, qscale = QUALITY.get(quality, QUALITY["High"])
+        self.ffmpeg = shutil.which("ffmpeg")
+        self.writer = None
+        self.process = None
+        self.closed = False
+        if self.ffmpeg is None:
+            self.writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*fourcc), fps, resolution)
+            if not self.writer.isOpened():
+                raise RuntimeError(f"Cannot open video writer for {output_path}")
+            return
+        command = [self.ffmpeg, "-y", "-loglevel", "error",
+                   "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{resolution[0]}x{resolution[1]}",
+                   "-r", str(fps), "-i", "pipe:0"]
+        if audio_path:
+            command += ["-f", "f32le", "-ar", str(SAMPLE_RATE), "-ac", str(CHANNELS), "-i", audio_path]
+        command += ["-c:v", video_codec]
+        if video_codec == "libx264":
+            command += ["-preset", "fast", "-crf", str(crf)]
+        else:
+            command += ["-q:v", str(qscale)]
+        command += ["-pix_fmt", "yuv420p"]
+        if audio_path:
+            command += ["-c:a", audio_codec]
+        command.append(output_path)
+        self.log = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=self.log)
+
+    def write(self, frame):
+        if self.writer is not None:
+            self.writer.write(frame)
+            return
+        try:
+            self.process.stdin.write(memoryview(np.ascontiguousarray(frame)))
+        except BrokenPipeError:
+            self.close()
+
+    def abort(self, output_path):
+        # Stops without finishing the file and removes whatever was written
+        self.closed = True
+        if self.writer is not None:
+            self.writer.release()
+        else:
+            self.process.kill()
+            self.process.wait()
+            self.log.close()
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.writer is not None:
+            self.writer.release()
+            return
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        if self.process.wait() != 0:
+            self.log.seek(0)
+            message = self.log.read().decode("utf-8", "replace").strip()
+            raise RuntimeError(f"ffmpeg failed: {message}")
+        self.log.close()
+
+
+def decode_audio(ffmpeg, clip):
+    # Streams the trimmed clip as interleaved float32 stereo, one second per chunk
+    command = [ffmpeg, "-loglevel", "error", "-ss", str(clip.start_time), "-t", str(clip.duration),
+               "-i", clip.path, "-f", "f32le", "-ac", str(CHANNELS), "-ar", str(SAMPLE_RATE), "pipe:1"]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        chunk_size = SAMPLE_RATE * CHANNELS * 4
+        while True:
+            data = process.stdout.read(chunk_size)
+            if not data:
+                break
+            usable = len(data) - len(data) % (CHANNELS * 4)
+            yield np.frombuffer(data[:usable], dtype=np.float32).reshape(-1, CHANNELS)
+    finally:
+        process.stdout.close()
+        process.wait()
+
+
+def mix_audio(audio_tracks, duration, path):
+    # Sums all audio clips with their volume and fades into a raw float32 file of the timeline's length.
+    # Returns False when there is nothing to mix or no ffmpeg to decode with.
+    ffmpeg = shutil.which("ffmpeg")
+    clips = [clip for track in audio_tracks for clip in track if clip.duration > 0]
+    total = int(round(duration * SAMPLE_RATE))
+    if ffmpeg is None or not clips or total <= 0:
+        return False
+    mix = np.memmap(path, dtype=np.float32, mode="w+", shape=(total, CHANNELS))
+    for clip in clips:
+        offset = int(round(clip.position * SAMPLE_RATE))
+        length = int(round(clip.duration * SAMPLE_RATE))
+        fade_in = max(1, int(clip.fade_in * SAMPLE_RATE))
+        fade_out = max(1, int(clip.fade_out * SAMPLE_RATE))
+        done = 0
+        for samples in decode_audio(ffmpeg, clip):
+            start = offset + done
+            if start >= total:
+                break
+            samples = samples[:total - start]
+            index = np.arange(done, done + len(samples), dtype=np.float32)
+            gain = np.minimum(np.minimum(index / fade_in, (length - index) / fade_out), 1.0)
+            np.clip(gain, 0.0, 1.0, out=gain)
+            gain *= clip.volume
+            if start < 0:
+                samples, gain, start = samples[-start:], gain[-start:], 0
+            mix[start:start + len(samples)] += samples * gain[:, None]
+            done += len(samples)
+    np.clip(mix, -1.0, 1.0, out=mix)
+    mix.flush()
+    del mix
+    return True
+
+
+def probe_video(ffmpeg, path):
+    # Codec, pixel format, size, frame rate and start time of the first video stream, None if unreadable
+    result = subprocess.run([ffmpeg, "-hide_banner", "-i", path], capture_output=True, text=True)
+    stream = re.search(r"Stream #\S+.*?: Video: (\w+).*?, (\w+)(?:\(.*?\))?, (\d+)x(\d+).*?, ([\d.]+) fps",
+                       result.stderr)
+    if stream is None:
+        return None
+    start = re.search(r"start: (-?[\d.]+)", result.stderr)
+    codec, pix_fmt, width, height, fps = stream.groups()
+    return {"codec": codec, "pix_fmt": pix_fmt, "size": (int(width), int(height)), "fps": float(fps),
+            "start": float(start.group(1)) if start else 0.0}
+
+
+def probe_keyframes(ffmpeg, path, info):
+    # Frame numbers of the keyframes; only keyframes are decoded, so this is quick even for long files
+    command = [ffmpeg, "-hide_banner", "-skip_frame", "nokey", "-i", path, "-map", "0:v:0", "-an",
+               "-vf", "showinfo", "-f", "null", "-"]
+    result = subprocess.run(command, capture_output=True, text=True)
+    times = re.findall(r"pts_time:\s*(-?[\d.]+)", result.stderr)
+    return sorted({round((float(t) - info["start"]) * info["fps"]) for t in times})
+
+
+def smart_jobs(plan, project, format_type):
+    # Splits the timeline into ("copy", ...) jobs for runs of a single untouched clip whose source already
+    # matches the output, starting at a source keyframe, and ("render", first, last) jobs for the rest.
+    # Returns None when nothing can be copied.
+    ffmpeg = shutil.which("ffmpeg")
+    video_codec = FORMATS.get(format_type, FORMATS["mp4"])[0]
+    if ffmpeg is None or video_codec not in COPY_CODECS:
+        return None
+    probes = {}
+
+    def probe(path):
+        if path not in probes:
+            info = probe_video(ffmpeg, path)
+            compatible = (info is not None and info["codec"] == COPY_CODECS[video_codec] and
+                          info["pix_fmt"] == "yuv420p" and info["size"] == tuple(project.resolution) and
+                          abs(info["fps"] - project.fps) < 0.01)
+            probes[path] = (info, probe_keyframes(ffmpeg, path, info)) if compatible else None
+        return probes[path]
+
+    # Runs of frames showing one plain clip at full opacity, reading consecutive source frames
+    runs = []
+    for frame_num, layers in enumerate(plan):
+        layer = layers[0] if len(layers) == 1 else None
+        plain = (layer is not None and layer.kind is None and layer.opacity >= 1 and
+                 not getattr(layer.sources[0].clip, "effects", None) and layer.sources[0].rate == 1)
+        source = layer.sources[0] if plain else None
+        if (runs and source is not None and runs[-1][0] is source and
+                source.source_frame(frame_num) == runs[-1][3] + (frame_num - runs[-1][1])):
+            runs[-1][2] = frame_num + 1
+        else:
+            runs.append([source, frame_num, frame_num + 1, source.source_frame(frame_num) if source else None])
+
+    jobs = []
+
+    def render(first, last):
+        if last <= first:
+            return
+        if jobs and jobs[-1][0] == "render" and jobs[-1][2] == first:
+            jobs[-1] = ("render", jobs[-1][1], last)
+        else:
+            jobs.append(("render", first, last))
+
+    for source, first, last, source_first in runs:
+        probed = probe(source.clip.path) if source is not None and last - first >= MIN_SEGMENT else None
+        copy_from = copy_to = last
+        if probed is not None:
+            # Copy whole GOPs only: from the first keyframe inside the run to the last one, or to the end of
+            # the file. The frames around them are re-encoded.
+            info, keyframes = probed
+            source_last = source_first + last - first
+            start = bisect.bisect_left(keyframes, source_first)
+            stop = bisect.bisect_right(keyframes, source_last) - 1
+            if start < len(keyframes):
+                end = source_last if source_last > source.last else keyframes[stop] if stop >= 0 else 0
+                if end - keyframes[start] >= MIN_SEGMENT // 2:
+                    copy_from = first + keyframes[start] - source_first
+                    copy_to = first + end - source_first
+        render(first, copy_from)
+        if copy_from < copy_to:
+            source_start = (source_first + copy_from - first) / project.fps + info["start"]
+            jobs.append(("copy", source.clip.path, source_start, copy_to - copy_from))
+        render(copy_to, last)
+    if not any(job[0] == "copy" for job in jobs):
+        return None
+    return jobs
+
+
+def split_render_jobs(jobs, max_frames):
+    # Long render jobs are cut so the process pool stays busy
+    result = []
+    for job in jobs:
+        if job[0] != "render" or job[2] - job[1] <= max_frames:
+            result.append(job)
+            continue
+        count = math.ceil((job[2] - job[1]) / max_frames)
+        points = [job[1] + round(i * (job[2] - job[1]) / count) for i in range(count + 1)]
+        result += [("render", a, b) for a, b in zip(points, points[1:])]
+    return result
+
+
+def concat_segments(segment_paths, output_path, format_type, audio_path=None):
+    # Joins the segments without re-encoding and muxes the audio mix in
+    ffmpeg = shutil.which("ffmpeg")
+    _, audio_codec, _ = FORMATS.get(format_type, FORMATS["mp4"])
+    list_path = os.path.join(os.path.dirname(segment_paths[0]), "segments.txt")
+    with open(list_path, "w") as f:
+        for path in segment_paths:
+            f.write("file '%s'\n" % path.replace("'", "'\\''"))
+    command = [ffmpeg, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path]
+    if audio_path:
+        command += ["-f", "f32le", "-ar", str(SAMPLE_RATE), "-ac", str(CHANNELS), "-i", audio_path,
+                    "-map", "0:v", "-map", "1:a", "-c:a", audio_codec]
+    command += ["-c:v", "copy", output_path]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.strip()}")
+
+
+# Shared with the worker processes through the pool initializer
+_cancel_event = None
+_segment_progress = None
+
+
+def _init_segment_worker(cancel_event, segment_progress):
+    global _cancel_event, _segment_progress
+    _cancel_event = cancel_event
+    _segment_progress = segment_progress
+
+
+def render_segment(index, tracks, project, first_frame, last_frame, total_frames, path, format_type, quality):
+    # Runs in a worker process with its own decoders and encoder
+    def progress(done, total):
+        _segment_progress[index] = done
+
+    renderer = TimelineRenderer(tracks, [], project, functools.partial(prepare_frame,
+                                                                       resolution=project.resolution))
+    encoder = Encoder(path, format_type, quality, tuple(project.resolution), project.fps)
+    renderer.render_range(encoder, path, total_frames, first_frame, last_frame, progress, _cancel_event)
+    return path
+
+
+def copy_segment(index, source_path, source_start, frames, fps, path):
+    # Remuxes a stretch of an untouched source starting at one of its keyframes, without re-encoding
+    if _cancel_event.is_set():
+        raise ExportCancelled()
+    command = [shutil.which("ffmpeg"), "-y", "-loglevel", "error", "-ss", f"{source_start:.6f}",
+               "-i", source_path, "-frames:v", str(frames), "-map", "0:v:0", "-c", "copy", path]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.strip()}")
+    _segment_progress[index] = frames
+    return path
+
+
+# Renders the timeline: readers decode each clip on its own thread, a thread pool composites
+# the layers of every frame and the results are written to the encoder in order
+class TimelineRenderer:
+    def __init__(self, tracks, audio_tracks, project, process):
+        self.tracks = tracks
+        self.audio_tracks = audio_tracks
+        self.project = project
+        self.process = process
+
+    def duration(self):
+        ends = [clip.position + clip.duration for track in self.tracks for clip in track]
+        ends += [clip.position + clip.duration for track in self.audio_tracks for clip in track]
+        return max(ends, default=0)
+
+    def export(self, output_path, format_type, quality, progress_callback=None, cancel=None, workers=1,
+               smart=True):
+        # With ffmpeg, untouched cuts are stream-copied (smart) and the rest is rendered in segments by
+        # `workers` processes; otherwise everything goes through a single pipeline
+        duration = self.duration()
+        total_frames = int(math.ceil(duration * self.project.fps))
+        audio_file = tempfile.NamedTemporaryFile(prefix="lumiere_mix_", suffix=".f32", delete=False)
+        audio_file.close()
+        try:
+            audio_path = audio_file.name if mix_audio(self.audio_tracks, duration, audio_file.name) else None
+            if cancel is not None and cancel.is_set():
+                raise ExportCancelled()
+            jobs = None
+            if smart:
+                plan, _ = build_plan(self.tracks, self.project.fps, total_frames)
+                jobs = smart_jobs(plan, self.project, format_type)
+            segments = min(workers * 2, total_frames // MIN_SEGMENT)
+            if jobs is None and workers > 1 and segments > 1 and shutil.which("ffmpeg"):
+                points = split_points(self.tracks, self.project.fps, total_frames, segments)
+                jobs = [("render", first, last) for first, last in zip(points, points[1:])]
+            if jobs is not None:
+                jobs = split_render_jobs(jobs, max(MIN_SEGMENT, total_frames // max(1, workers * 2)))
+                self.export_segments(output_path, format_type, quality, total_frames, jobs, workers,
+                                     audio_path, progress_callback, cancel)
+            else:
+                encoder = Encoder(output_path, format_type, quality, tuple(self.project.resolution),
+                                  self.project.fps, audio_path)
+                self.render_range(encoder, output_path, total_frames, 0, total_frames, progress_callback, cancel)
+            if progress_callback:
+                progress_callback(total_frames, total_frames)
+        finally:
+            os.remove(audio_file.name)
+
+    def export_segments(self, output_path, format_type, quality, total_frames, jobs, workers,
+                        audio_path, progress_callback, cancel):
+        temp_dir = tempfile.mkdtemp(prefix="lumiere_segments_")
+        # Matroska takes every codec used here, and the concat demuxer joins the pieces losslessly,
+        # passing on the changed parameter sets where a copied source meets a re-encoded segment
+        paths = [os.path.join(temp_dir, f"segment_{index:04d}.mkv") for index in range(len(jobs))]
+        cancel_event = multiprocessing.Event()
+        progress = multiprocessing.Array("q", len(paths), lock=False)
+        try:
+            with ProcessPoolExecutor(max_workers=max(1, workers), initializer=_init_segment_worker,
+                                     initargs=(cancel_event, progress)) as pool:
+                pending = set()
+                for index, (job, path) in enumerate(zip(jobs, paths)):
+                    if job[0] == "copy":
+                        _, source_path, source_start, frames = job
+                        pending.add(pool.submit(copy_segment, index, source_path, source_start, frames,
+                                                self.project.fps, path))
+                    else:
+                        pending.add(pool.submit(render_segment, index, self.tracks, self.project, job[1], job[2],
+                                                total_frames, path, format_type, quality))
+                try:
+                    while pending:
+                        done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                        if cancel is not None and cancel.is_set():
+                            raise ExportCancelled()
+                        if progress_callback:
+                            progress_callback(sum(progress), total_frames)
+                except BaseException:
+                    cancel_event.set()
+                    for future in pending:
+                        future.cancel()
+                    raise
+            concat_segments(paths, output_path, format_type, audio_path)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def render_range(self, encoder, output_path, total_frames, first_frame, last_frame,
+                     progress_callback=None, cancel=None):
+        # Writes frames first_frame..last_frame of the timeline and closes the encoder
+        fps = self.project.fps
+        width, height = self.project.resolution
+        plan, sources = build_plan(self.tracks, fps, total_frames, first_frame, last_frame)
+        pending = deque(sorted(sources, key=lambda source: source.first))
+        remaining = {id(source): len(source.frames) for source in sources}
+        workers = max(2, (os.cpu_count() or 2) // 2)
+        readers = []
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = deque()
+                for frame_num, layers in enumerate(plan, first_frame):
+                    if cancel is not None and cancel.is_set():
+                        raise ExportCancelled()
+                    while pending and pending[0].first <= frame_num + PREROLL:
+                        source = pending.popleft()
+                        source.reader = ClipReader(source, self.process)
+                        source.reader.start()
+                        readers.append(source.reader)
+                    inputs = []
+                    for layer in layers:
+                        frames = []
+                        for source in layer.sources:
+                            frames.append(source.reader.next_frame())
+                            remaining[id(source)] -= 1
+                            if remaining[id(source)] == 0:
+                                source.reader.stop()
+                        inputs.append((layer, frames))
+                    futures.append(pool.submit(composite, inputs, width, height))
+                    while futures and (futures[0].done() or len(futures) > workers * 2):
+                        encoder.write(futures.popleft().result())
+                    if progress_callback and frame_num % 10 == 0:
+                        progress_callback(frame_num - first_frame, total_frames)
+                while futures:
+                    encoder.write(futures.popleft().result())
+            encoder.close()
+            if progress_callback:
+                progress_callback(last_frame - first_frame, total_frames)
+        except BaseException:
+            encoder.abort(output_path)
+            raise
+        finally:
+            for reader in readers:
+                reader.stop()
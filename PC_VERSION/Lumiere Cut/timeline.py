@@ -0,0 +1,109 @@
+# timeline.py
+import bisect
+import itertools
+
+
+def clip_interval(clip, fps):
+    # Timeline frames [start, end) covered by a clip; positions are in seconds, lengths in source frames
+    start = round(clip.position * fps)
+    return start, start + round((clip.end_frame - clip.start_frame) * fps / (clip.fps or fps))
+
+
+# Clips of one track sorted by start frame. ends_max[i] is the latest end among the first i + 1 clips,
+# so a lookup can stop walking back as soon as no earlier clip can still be running.
+class TrackIndex:
+    def __init__(self):
+        self.entries = []  # (start, end, seq, clip)
+        self.starts = []
+        self.ends_max = None
+
+    def insert(self, entry):
+        index = bisect.bisect_right(self.entries, entry[:3], key=lambda item: item[:3])
+        self.entries.insert(index, entry)
+        self.starts.insert(index, entry[0])
+        self.ends_max = None
+
+    def remove(self, entry):
+        index = bisect.bisect_left(self.entries, entry[:3], key=lambda item: item[:3])
+        del self.entries[index]
+        del self.starts[index]
+        self.ends_max = None
+
+    def active(self, frame_num):
+        if self.ends_max is None:
+            self.ends_max = list(itertools.accumulate((entry[1] for entry in self.entries), max))
+        clips = []
+        index = bisect.bisect_right(self.starts, frame_num) - 1
+        while index >= 0 and self.ends_max[index] > frame_num:
+            start, end, _, clip = self.entries[index]
+            if end > frame_num:
+                clips.append(clip)
+            index -= 1
+        clips.reverse()
+        return clips
+
+
+# Answers "which clips are active at frame N" and "what changes after frame N" with binary searches
+# instead of scanning every clip. Edits update only the clips they touch.
+class TimelineIndex:
+    def __init__(self, tracks=(), fps=30.0):
+        self.rebuild(tracks, fps)
+
+    def rebuild(self, tracks, fps):
+        self.fps = fps
+        self.tracks = []
+        self.entries = {}  # id(clip) -> (track index, entry)
+        self.boundaries = []  # sorted (frame, seq, kind, track index, clip) for every start and end
+        self.seq = itertools.count()
+        for track_idx, track in enumerate(tracks):
+            for clip in track:
+                self.add(track_idx, clip)
+
+    def add(self, track_idx, clip):
+        while len(self.tracks) <= track_idx:
+            self.tracks.append(TrackIndex())
+        start, end = clip_interval(clip, self.fps)
+        entry = (start, end, next(self.seq), clip)
+        self.tracks[track_idx].insert(entry)
+        self.entries[id(clip)] = (track_idx, entry)
+        for frame_num, kind in ((start, "start"), (end, "end")):
+            bisect.insort(self.boundaries, (frame_num, entry[2], kind, track_idx, clip),
+                          key=lambda item: item[:2])
+
+    def remove(self, clip):
+        found = self.entries.pop(id(clip), None)
+        if found is None:
+            return
+        track_idx, entry = found
+        self.tracks[track_idx].remove(entry)
+        for frame_num in (entry[0], entry[1]):
+            index = bisect.bisect_left(self.boundaries, (frame_num, entry[2]), key=lambda item: item[:2])
+            del self.boundaries[index]
+
+    def update(self, clip):
+        # Call after changing a clip's position or trim points
+        found = self.entries.get(id(clip))
+        if found is not None:
+            self.remove(clip)
+            self.add(found[0], clip)
+
+    def active(self, frame_num):
+        # List of (track index, clip) covering frame_num, in track order
+        return [(track_idx, clip) for track_idx, track in enumerate(self.tracks)
+                for clip in track.active(frame_num)]
+
+    def changes(self, frame_num):
+        # (started, ended) clips between frame_num and frame_num + 1 as lists of (track index, clip)
+        lo = bisect.bisect_left(self.boundaries, frame_num + 1, key=lambda item: item[0])
+        hi = bisect.bisect_right(self.boundaries, frame_num + 1, key=lambda item: item[0])
+        started = [(item[3], item[4]) for item in self.boundaries[lo:hi] if item[2] == "start"]
+        ended = [(item[3], item[4]) for item in self.boundaries[lo:hi] if item[2] == "end"]
+        return started, ended
+
+    def next_change(self, frame_num):
+        # First frame after frame_num where a clip starts or ends, None past the last clip
+        index = bisect.bisect_right(self.boundaries, frame_num, key=lambda item: item[0])
+        return self.boundaries[index][0] if index < len(self.boundaries) else None
+
+    def end_frame(self):
+        return max((entry[1] for _, entry in self.entries.values()), default=0)
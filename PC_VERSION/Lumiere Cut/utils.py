@@ -7,6 +7,13 @@ import time
 import pygame
 import tempfile
 import os
+import shutil
+import subprocess
+from media_cache import cache_key
+from playback import ClockedPlayer
+
+MIXER_BUFFER = 1024  # Samples per mixer callback; mixed audio waits about this long in the device before it is heard
+PLAYABLE_AUDIO = (".wav", ".ogg", ".mp3")  # Read by the mixer directly, anything else is converted with ffmpeg
 
 
 def format_time(seconds):
@@ -48,151 +55,136 @@ def apply_effect(frame, effect_type, effect_value):
     return frame
 
 
-class VideoPlayer:
-    def __init__(self, update_callback):
-        self.is_playing = False
-        self.update_callback = update_callback
-        self.play_thread = None
-        self.current_frame = 0
+class VideoPlayer(ClockedPlayer):
+    def __init__(self, update_callback, render=None, dispatch=None, prefetch=None, audio_position=None):
+        super().__init__(update_callback, render, dispatch, prefetch, audio_position)
         self.total_frames = 0
-        self.fps = 30
-        self.playback_speed = 1.0
 
     def play(self, current_frame, total_frames, fps, speed=1.0):
         if not self.is_playing:
-            self.is_playing = True
-            self.current_frame = current_frame
             self.total_frames = total_frames
-            self.fps = fps
-            self.playback_speed = speed
-            self.play_thread = threading.Thread(target=self._play_thread)
-            self.play_thread.daemon = True
-            self.play_thread.start()
-
-    def _play_thread(self):
-        while self.is_playing and self.current_frame < self.total_frames - 1:
-            self.current_frame += self.playback_speed
-            if self.current_frame >= self.total_frames:
-                self.current_frame = self.total_frames - 1
-                self.is_playing = False
-
-            if self.update_callback:
-                self.update_callback(int(self.current_frame))
-
-            time.sleep(1 / (self.fps * self.playback_speed))
-
-    def pause(self):
-        self.is_playing = False
-
-    def stop(self):
-        self.is_playing = False
-        self.current_frame = 0
+            self.start(current_frame, total_frames, fps, speed)
 
-    def seek(self, frame_num):
-        self.current_frame = frame_num
-        if self.update_callback:
-            self.update_callback(int(frame_num))
 
-
-class PreviewPlayer:
-    def __init__(self, update_callback, functions):
-        self.is_playing = False
-        self.update_callback = update_callback
+class PreviewPlayer(ClockedPlayer):
+    # Plays the timeline; the source frames ahead of the playhead are decoded in the background
+    def __init__(self, update_callback, functions, render=None, dispatch=None, audio_position=None):
+        super().__init__(update_callback, render, dispatch, functions.prefetch_timeline, audio_position)
         self.functions = functions
-        self.play_thread = None
-        self.current_frame = 0
         self.max_duration = 0
-        self.fps = 30
-        self.playback_speed = 1.0
 
     def play(self, current_frame, max_duration, fps, speed=1.0):
         if not self.is_playing:
-            self.is_playing = True
-            self.current_frame = current_frame
             self.max_duration = max_duration
-            self.fps = fps
-            self.playback_speed = speed
-            self.play_thread = threading.Thread(target=self._play_thread)
-            self.play_thread.daemon = True
-            self.play_thread.start()
-
-    def _play_thread(self):
-        while self.is_playing and self.current_frame < self.max_duration - 1:
-            self.current_frame += self.playback_speed
-            if self.current_frame >= self.max_duration:
-                self.current_frame = self.max_duration - 1
-                self.is_playing = False
-
-            if self.update_callback:
-                self.update_callback(int(self.current_frame))
-
-            time.sleep(1 / (self.fps * self.playback_speed))
-
-    def pause(self):
-        self.is_playing = False
-
-    def stop(self):
-        self.is_playing = False
-        self.current_frame = 0
-
-    def seek(self, frame_num):
-        self.current_frame = frame_num
-        if self.update_callback:
-            self.update_callback(int(frame_num))
+            self.start(current_frame, max_duration, fps, speed)
 
 
+# Plays the sound of a clip through pygame.mixer.music, whose position comes from the samples the mixer has
+# handed to the sound card, so the playback clock can follow what is actually heard.
 class AudioPlayer:
-    def __init__(self):
-        pygame.mixer.init()
-        self.current_sound = None
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), "lumiere_cache", "audio")
+        self.sources = {}  # media path -> file the mixer can play, None when it has no sound
         self.is_playing = False
-
-    def play_audio(self, file_path, volume=1.0):
+        self.offset = 0.0
+        try:
+            pygame.mixer.init(buffer=MIXER_BUFFER)
+        except pygame.error as e:
+            print(f"Audio output unavailable: {str(e)}")
+
+    def source(self, file_path):
+        # Video files and other formats are converted once to a WAV file in the cache
+        if file_path.lower().endswith(PLAYABLE_AUDIO):
+            return file_path
+        if file_path not in self.sources:
+            ffmpeg = shutil.which("ffmpeg")
+            wav_path = os.path.join(self.cache_dir, cache_key(file_path) + ".wav")
+            if not os.path.exists(wav_path) and ffmpeg:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                partial = wav_path + ".part"
+                result = subprocess.run([ffmpeg, "-loglevel", "error", "-y", "-i", file_path, "-vn", "-f", "wav",
+                                         partial], stdin=subprocess.DEVNULL, capture_output=True)
+                if result.returncode == 0:
+                    os.replace(partial, wav_path)
+                elif os.path.exists(partial):
+                    os.remove(partial)
+            self.sources[file_path] = wav_path if os.path.exists(wav_path) else None
+        return self.sources[file_path]
+
+    def play_audio(self, file_path, volume=1.0, offset=0.0):
+        # offset is the second of the file playback starts at, position() counts from there
         try:
             if self.is_playing:
                 self.stop_audio()
-
-            self.current_sound = pygame.mixer.Sound(file_path)
-            self.current_sound.set_volume(volume)
-            self.current_sound.play()
+            if not pygame.mixer.get_init():
+                return False
+            source = self.source(file_path)
+            if source is None:
+                return False
+            pygame.mixer.music.load(source)
+            pygame.mixer.music.set_volume(volume)
+            pygame.mixer.music.play(start=offset)
+            self.offset = offset
             self.is_playing = True
             return True
-        except:
+        except (pygame.error, NotImplementedError, OSError) as e:
+            print(f"Error playing audio: {str(e)}")
             return False
 
     def stop_audio(self):
-        if self.is_playing and self.current_sound:
-            self.current_sound.stop()
+        if self.is_playing:
+            pygame.mixer.music.stop()
             self.is_playing = False
 
+    def position(self):
+        # Seconds of the file being heard, None when nothing plays so the playback clock falls back to its own.
+        # get_pos() is the audio mixed so far plus the time since the last mixer callback; what was mixed last
+        # is still in the device buffer.
+        if not self.is_playing or not pygame.mixer.music.get_busy():
+            return None
+        mixed = pygame.mixer.music.get_pos()
+        if mixed < 0:
+            return None
+        latency = MIXER_BUFFER / pygame.mixer.get_init()[0]
+        return self.offset + max(0.0, mixed / 1000 - latency)
+
     def set_volume(self, volume):
-        if self.current_sound:
-            self.current_sound.set_volume(volume)
+        if pygame.mixer.get_init():
+            pygame.mixer.music.set_volume(volume)
 
 
 class ExportManager:
-    def __init__(self, functions):
+    def __init__(self, functions, workers=None):
         self.functions = functions
+        self.workers = workers or os.cpu_count() or 1
         self.is_exporting = False
         self.export_thread = None
+        self.cancel_event = threading.Event()
 
-    def start_export(self, file_path, progress_callback=None):
+    def start_export(self, file_path, progress_callback=None, format_type="mp4", quality="High",
+                     done_callback=None):
         if not self.is_exporting:
             self.is_exporting = True
+            self.cancel_event.clear()
             self.export_thread = threading.Thread(
                 target=self._export_thread,
-                args=(file_path, progress_callback)
+                args=(file_path, progress_callback, format_type, quality, done_callback)
             )
             self.export_thread.daemon = True
             self.export_thread.start()
 
-    def _export_thread(self, file_path, progress_callback):
-        success, message = self.functions.export_video(file_path, progress_callback)
+    def _export_thread(self, file_path, progress_callback, format_type, quality, done_callback):
+        # Segments of the timeline are rendered in parallel processes, one per core
+        success, message = self.functions.export_video(file_path, format_type, quality, progress_callback,
+                                                       self.cancel_event, self.workers)
         self.is_exporting = False
+        if done_callback:
+            done_callback(success, message)
         return success, message
 
     def cancel_export(self):
-        self.is_exporting = False
+        # Workers check the event every frame, stop their encoders and delete the partial files
+        self.cancel_event.set()
 
 
 class AutoSaveManager:
@@ -219,8 +211,6 @@ class AutoSaveManager:
 
     def _auto_save(self):
         if self.is_running:
-            # Создаем временный файл для автосохранения
-            temp_dir = tempfile.gettempdir()
-            auto_save_path = os.path.join(temp_dir, f"autosave_{self.functions.project.name}.json")
-            self.functions.save_project(auto_save_path)
+            # Правки уже в журнале, здесь они только сворачиваются в снимок в фоновом потоке
+            self.functions.auto_save()
             self._schedule_next()
\ No newline at end of file
@@ -0,0 +1,179 @@
+import math
+import numpy as np
+
+# All buffers here are float32 HxWx4 arrays with premultiplied alpha in the 0..1 range.
+
+LUMA = (0.299, 0.587, 0.114)
+
+
+def premultiply(rgba):
+    buf = np.asarray(rgba, dtype=np.float32) * np.float32(1 / 255)
+    buf[..., :3] *= buf[..., 3:4]
+    return buf
+
+
+def unpremultiply(color, alpha):
+    return np.divide(color, alpha, out=np.zeros_like(color), where=alpha > 0)
+
+
+def mean_luma(buf):
+    # Mean grey of the straight colour, rounded to a level like ImageEnhance.Contrast does
+    luma = unpremultiply(buf[..., :3] @ np.asarray(LUMA, dtype=np.float32), buf[..., 3])
+    return int(float(luma.mean()) * 255 + 0.5) / 255
+
+
+def to_rgba(buf):
+    out = np.empty(buf.shape, dtype=np.float32)
+    out[..., :3] = unpremultiply(buf[..., :3], buf[..., 3:4])
+    out[..., 3] = buf[..., 3]
+    out *= 255
+    out += 0.5
+    np.clip(out, 0, 255, out=out)
+    return out.astype(np.uint8)
+
+
+def to_rgb(buf, bg):
+    # Flattening premultiplied colour over an opaque background is a single multiply-add
+    out = np.multiply(1.0 - buf[..., 3:4], np.asarray(bg, dtype=np.float32) / 255)
+    out += buf[..., :3]
+    out *= 255
+    out += 0.5
+    np.clip(out, 0, 255, out=out)
+    return out.astype(np.uint8)
+
+
+def _multiply(cb, cs):
+    return cb * cs
+
+
+def _screen(cb, cs):
+    return cb + cs - cb * cs
+
+
+def _overlay(cb, cs):
+    return _hard_light(cs, cb)
+
+
+def _darken(cb, cs):
+    return np.minimum(cb, cs)
+
+
+def _lighten(cb, cs):
+    return np.maximum(cb, cs)
+
+
+def _color_dodge(cb, cs):
+    out = np.divide(cb, 1.0 - cs, out=np.ones_like(cb), where=cs < 1.0)
+    np.minimum(out, 1.0, out=out)
+    out[cb <= 0.0] = 0.0
+    return out
+
+
+def _color_burn(cb, cs):
+    out = np.divide(1.0 - cb, cs, out=np.ones_like(cb), where=cs > 0.0)
+    np.minimum(out, 1.0, out=out)
+    np.subtract(1.0, out, out=out)
+    out[cb >= 1.0] = 1.0
+    return out
+
+
+def _hard_light(cb, cs):
+    doubled = cs * 2.0
+    return np.where(cs <= 0.5, cb * doubled, _screen(cb, doubled - 1.0))
+
+
+def _soft_light(cb, cs):
+    d = np.where(cb <= 0.25, ((16.0 * cb - 12.0) * cb + 4.0) * cb, np.sqrt(cb))
+    return np.where(cs <= 0.5,
+                    cb - (1.0 - 2.0 * cs) * cb * (1.0 - cb),
+                    cb + (2.0 * cs - 1.0) * (d - cb))
+
+
+def _difference(cb, cs):
+    return np.abs(cb - cs)
+
+
+def _exclusion(cb, cs):
+    return cb + cs - 2.0 * cb * cs
+
+
+BLEND_FUNCTIONS = {
+    "multiply": _multiply,
+    "screen": _screen,
+    "overlay": _overlay,
+    "darken": _darken,
+    "lighten": _lighten,
+    "color_dodge": _color_dodge,
+    "color_burn": _color_burn,
+    "soft_light": _soft_light,
+    "hard_light": _hard_light,
+    "difference": _difference,
+    "exclusion": _exclusion,
+}
+
+BLEND_MODES = ["normal"] + list(BLEND_FUNCTIONS)
+
+
+def blend(dst, src, mode="normal", opacity=1.0, mask=None):
+    # Composites src over dst in place (W3C separable blend modes)
+    if opacity < 1.0 or mask is not None:
+        coverage = opacity if mask is None else mask[..., None] * np.float32(opacity)
+        src = src * coverage
+    src_a = src[..., 3:4]
+    function = BLEND_FUNCTIONS.get(mode)
+    if function is None:
+        dst *= 1.0 - src_a
+        dst += src
+        return dst
+    dst_a = dst[..., 3:4].copy()
+    mixed = function(unpremultiply(dst[..., :3], dst_a), unpremultiply(src[..., :3], src_a))
+    mixed *= src_a * dst_a
+    dst[..., :3] *= 1.0 - src_a
+    dst[..., :3] += src[..., :3] * (1.0 - dst_a)
+    dst[..., :3] += mixed
+    dst[..., 3:4] += src_a * (1.0 - dst_a)
+    return dst
+
+
+def adjustment_matrix(adjustment_type, params, pivot=0.5):
+    # Returns (3x3 colour matrix, per-channel offset scaled by alpha), or None for unknown types.
+    # Contrast scales the distance from pivot, the mean grey of the image under the adjustment
+    strength = params.get("strength", 1.0)
+    if adjustment_type == "brightness":
+        return np.eye(3) * strength, np.zeros(3)
+    if adjustment_type == "contrast":
+        return np.eye(3) * strength, np.full(3, pivot * (1.0 - strength))
+    if adjustment_type == "saturation":
+        gray = np.tile(LUMA, (3, 1))
+        return np.eye(3) * strength + gray * (1.0 - strength), np.zeros(3)
+    if adjustment_type == "hue":
+        angle = math.radians(params.get("hue", 0))
+        c, s = math.cos(angle), math.sin(angle)
+        matrix = np.array([
+            [0.213 + c * 0.787 - s * 0.213, 0.715 - c * 0.715 - s * 0.715, 0.072 - c * 0.072 + s * 0.928],
+            [0.213 - c * 0.213 + s * 0.143, 0.715 + c * 0.285 + s * 0.140, 0.072 - c * 0.072 - s * 0.283],
+            [0.213 - c * 0.213 - s * 0.787, 0.715 - c * 0.715 + s * 0.715, 0.072 + c * 0.928 + s * 0.072],
+        ])
+        return matrix, np.zeros(3)
+    return None
+
+
+def adjust(buf, adjustment_type, params, opacity=1.0, mask=None, pivot=0.5):
+    # Every adjustment is affine in RGB, so it can be applied to premultiplied colour directly
+    transform = adjustment_matrix(adjustment_type, params, pivot)
+    if transform is None:
+        return buf
+    matrix, offset = transform
+    color = buf[..., :3]
+    alpha = buf[..., 3:4]
+    adjusted = color @ matrix.T.astype(np.float32)
+    adjusted += alpha * offset.astype(np.float32)
+    np.clip(adjusted, 0.0, alpha, out=adjusted)
+    if opacity < 1.0 or mask is not None:
+        coverage = opacity if mask is None else mask[..., None] * np.float32(opacity)
+        adjusted -= color
+        adjusted *= coverage
+        color += adjusted
+    else:
+        color[...] = adjusted
+    return buf
@@ -0,0 +1,243 @@
+import math
+import numpy as np
+from PIL import Image, ImageColor
+import blending
+
+TILE_SIZE = 128
+PREMULTIPLIED_BUDGET = 512 * 1024 * 1024  # Bytes of premultiplied layer buffers kept between renders
+
+
+def background_rgb(color):
+    return ImageColor.getrgb(color)[:3] if isinstance(color, str) else tuple(color[:3])
+
+
+class TileCompositor:
+    def __init__(self, functions, tile_size=TILE_SIZE):
+        self.functions = functions
+        self.tile_size = tile_size
+        self.size = None
+        self.layers_ref = None
+        self.layer_count = 0
+        self.active_index = None
+        self.below = None  # Premultiplied composite of the layers under the active layer
+        self.above = None  # Premultiplied composite of the layers over the active layer, None if it can't be cached
+        self.bg_rgb = (255, 255, 255)
+        self.transformed = {}
+        self.premultiplied = {}  # id(layer) -> premultiplied buffer of the whole layer, see cached_layer()
+        self.redrawn = set()  # id() of the layers read again for every dirty tile
+        self.pivots = {}  # id(layer) -> mean grey under a contrast adjustment, see adjustment_pivot()
+        self.dirty_tiles = set()
+        self.composite_rgba = None
+        self.composite_image = None
+
+    def invalidate(self):
+        self.size = None
+        self.below = None
+        self.above = None
+        self.transformed = {}
+        self.premultiplied = {}
+        self.redrawn = set()
+        self.pivots = {}
+        self.dirty_tiles = set()
+
+    def is_valid(self):
+        f = self.functions
+        return (self.below is not None
+                and self.size == (f.canvas_width, f.canvas_height)
+                and self.layers_ref is f.layers
+                and self.layer_count == len(f.layers)
+                and self.active_index == f.current_layer_index)
+
+    def tiles_for_box(self, box):
+        width, height = self.size
+        x0, y0 = max(0, int(box[0])), max(0, int(box[1]))
+        x1, y1 = min(width, math.ceil(box[2])), min(height, math.ceil(box[3]))
+        if x1 <= x0 or y1 <= y0:
+            return set()
+        ts = self.tile_size
+        return {(tx, ty) for tx in range(x0 // ts, (x1 - 1) // ts + 1)
+                for ty in range(y0 // ts, (y1 - 1) // ts + 1)}
+
+    def tile_count(self):
+        width, height = self.size
+        ts = self.tile_size
+        return math.ceil(width / ts) * math.ceil(height / ts)
+
+    def all_tiles(self):
+        width, height = self.size
+        return self.tiles_for_box((0, 0, width, height))
+
+    def tile_box(self, tile):
+        width, height = self.size
+        ts = self.tile_size
+        x0, y0 = tile[0] * ts, tile[1] * ts
+        return (x0, y0, min(width, x0 + ts), min(height, y0 + ts))
+
+    def mark_dirty(self, box=None):
+        if not self.is_valid():
+            self.rebuild()
+        elif box is None:
+            self.dirty_tiles = self.all_tiles()
+        else:
+            self.dirty_tiles |= self.tiles_for_box(box)
+
+    def refresh(self, box=None, temp_layer_image=None):
+        # Without a temporary image, a box means the active layer itself was edited inside it
+        if box is None:
+            self.invalidate()
+        self.mark_dirty(box)
+        if box is not None and temp_layer_image is None:
+            self.layer_changed(box)
+        self.flush(temp_layer_image)
+
+    def layer_changed(self, box):
+        f = self.functions
+        if not 0 <= self.active_index < len(f.layers):
+            return
+        layer = f.layers[self.active_index]
+        if layer.transform_mode:
+            # In-place edits keep the same image object, so the cached transform has to be dropped here; the
+            # transform moves the pixels, so the change can show anywhere on the canvas
+            self.transformed.pop(id(layer), None)
+            self.dirty_tiles = self.all_tiles()
+            return
+        buffer = self.premultiplied.get(id(layer))
+        if buffer is not None:
+            width, height = self.size
+            x0, y0 = max(0, int(box[0])), max(0, int(box[1]))
+            x1, y1 = min(width, math.ceil(box[2])), min(height, math.ceil(box[3]))
+            if x0 < x1 and y0 < y1:
+                buffer[y0:y1, x0:x1] = self.premultiply_region(layer.image, (x0, y0, x1, y1))
+
+    def flush(self, temp_layer_image=None):
+        if not self.dirty_tiles:
+            return
+        if len(self.dirty_tiles) == self.tile_count():
+            width, height = self.size
+            self.render_box((0, 0, width, height), temp_layer_image)
+        else:
+            for tile in self.dirty_tiles:
+                self.render_box(self.tile_box(tile), temp_layer_image)
+        self.dirty_tiles = set()
+
+    def rebuild(self):
+        f = self.functions
+        self.size = (f.canvas_width, f.canvas_height)
+        self.layers_ref = f.layers
+        self.layer_count = len(f.layers)
+        self.active_index = f.current_layer_index
+        self.bg_rgb = background_rgb(f.bg_color)
+        self.transformed = {}
+        self.premultiplied = {}
+        full = (0, 0, f.canvas_width, f.canvas_height)
+        active = self.active_index if 0 <= self.active_index < len(f.layers) else len(f.layers)
+        self.below = self.composite_stack(f.layers[:active], full)
+        above_layers = f.layers[active + 1:]
+        if all(self.is_stackable(layer) for layer in above_layers):
+            self.above = self.composite_stack(above_layers, full)
+            self.redrawn = {id(layer) for layer in f.layers[active:active + 1]}
+        else:
+            self.above = None
+            self.redrawn = {id(layer) for layer in f.layers[active:]}
+        self.composite_rgba = Image.new("RGBA", self.size, (0, 0, 0, 0))
+        self.composite_image = Image.new("RGB", self.size, f.bg_color)
+        self.dirty_tiles = self.all_tiles()
+
+    def is_stackable(self, layer):
+        # "normal" alpha compositing is associative, so such layers can be flattened ahead of time
+        if not layer.visible or layer.opacity <= 0:
+            return True
+        return layer.blend_mode == "normal" and not layer.is_adjustment
+
+    def composite_stack(self, layers, box, base=None):
+        if base is None:
+            base = np.zeros((box[3] - box[1], box[2] - box[0], 4), dtype=np.float32)
+        for layer in layers:
+            self.apply_layer(base, layer, box)
+        return base
+
+    def render_box(self, box, temp_layer_image=None):
+        f = self.functions
+        x0, y0, x1, y1 = box
+        tile = self.below[y0:y1, x0:x1].copy()
+        if 0 <= self.active_index < len(f.layers):
+            self.apply_layer(tile, f.layers[self.active_index], box, temp_layer_image)
+            if self.above is not None:
+                blending.blend(tile, self.above[y0:y1, x0:x1])
+            else:
+                self.composite_stack(f.layers[self.active_index + 1:], box, tile)
+        self.composite_rgba.paste(Image.fromarray(blending.to_rgba(tile), "RGBA"), (x0, y0))
+        self.composite_image.paste(Image.fromarray(blending.to_rgb(tile, self.bg_rgb), "RGB"), (x0, y0))
+
+    def render(self, temp_layer_image=None):
+        # Uncached full render, for callers that need a one-off composite
+        f = self.functions
+        full = (0, 0, f.canvas_width, f.canvas_height)
+        composite = np.zeros((f.canvas_height, f.canvas_width, 4), dtype=np.float32)
+        for i, layer in enumerate(f.layers):
+            source = temp_layer_image if i == f.current_layer_index else None
+            self.apply_layer(composite, layer, full, source)
+        return Image.fromarray(blending.to_rgb(composite, background_rgb(f.bg_color)), "RGB")
+
+    def layer_region(self, layer, box, source=None):
+        # Read only: the result may be a view of the cached layer buffer
+        if source is not None and not layer.is_adjustment:
+            image = source
+        elif layer.transform_mode:
+            image = self.transformed_image(layer)
+        else:
+            buffer = self.cached_layer(layer)
+            if buffer is not None:
+                return buffer[box[1]:box[3], box[0]:box[2]]
+            image = layer.image
+        return self.premultiply_region(image, box)
+
+    @staticmethod
+    def premultiply_region(image, box):
+        region = image.crop(box) if box != (0, 0) + image.size else image
+        if region.mode != "RGBA":
+            region = region.convert("RGBA")
+        return blending.premultiply(region)
+
+    def cached_layer(self, layer):
+        # Layers redrawn tile by tile (the active one and those over it that can't be flattened) are converted
+        # once and then kept up to date by layer_changed(); None when the layer is not cached
+        buffer = self.premultiplied.get(id(layer))
+        if buffer is None and id(layer) in self.redrawn and layer.image.size == self.size:
+            width, height = self.size
+            used = sum(cached.nbytes for cached in self.premultiplied.values())
+            if used + width * height * 16 <= PREMULTIPLIED_BUDGET:
+                buffer = self.premultiply_region(layer.image, (0, 0, width, height))
+                self.premultiplied[id(layer)] = buffer
+        return buffer
+
+    def layer_mask(self, layer, box):
+        if layer.mask is None:
+            return None
+        return np.asarray(layer.mask.crop(box), dtype=np.float32) * np.float32(1 / 255)
+
+    def transformed_image(self, layer):
+        cached = self.transformed.get(id(layer))
+        if cached is None or cached[0] is not layer.image:
+            cached = (layer.image, layer.apply_transform().convert("RGBA"))
+            self.transformed[id(layer)] = cached
+        return cached[1]
+
+    def adjustment_pivot(self, layer, composite, box):
+        # Contrast pivots on the mean grey of the whole image under the layer, which a tile doesn't see. It is
+        # measured whenever the layer is composited over the full canvas (every rebuild and full render) and
+        # kept for the tiles redrawn after that.
+        if layer.adjustment_type != "contrast":
+            return 0.5
+        f = self.functions
+        if box == (0, 0, f.canvas_width, f.canvas_height):
+            self.pivots[id(layer)] = blending.mean_luma(composite)
+        return self.pivots.get(id(layer), 0.5)
+
+    def apply_layer(self, composite, layer, box, source=None):
+        if not layer.visible or layer.opacity <= 0:
+            return composite
+        mask = self.layer_mask(layer, box)
+        if layer.is_adjustment:
+            return layer.apply_adjustment(composite, mask, self.adjustment_pivot(layer, composite, box))
+        return layer.apply_blend_mode(composite, self.layer_region(layer, box, source), mask)
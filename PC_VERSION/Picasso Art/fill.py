@@ -0,0 +1,164 @@
+import math
+import numpy as np
+from PIL import Image, ImageChops, ImageColor, ImageFilter
+
+LUT_SIZE = 1024
+
+
+def gradient_lut(colors, alpha):
+    # Evenly spaced colour stops sampled into a LUT_SIZE x 4 table
+    stops = np.array([ImageColor.getrgb(color)[:3] for color in colors], dtype=np.float32)
+    positions = np.linspace(0.0, 1.0, len(stops))
+    samples = np.linspace(0.0, 1.0, LUT_SIZE)
+    lut = np.empty((LUT_SIZE, 4), dtype=np.uint8)
+    for channel in range(3):
+        lut[:, channel] = np.round(np.interp(samples, positions, stops[:, channel]))
+    lut[:, 3] = alpha
+    return lut
+
+
+def gradient_axis(width, height, start, end, direction):
+    # Start point and vector of the gradient for the linear-style types
+    (sx, sy), (ex, ey) = start, end
+    if direction == "horizontal":
+        axis = (sx, 0), (ex - sx, 0)
+        fallback = (0, 0), (width, 0)
+    elif direction == "vertical":
+        axis = (0, sy), (0, ey - sy)
+        fallback = (0, 0), (0, height)
+    elif direction == "diagonal":
+        length = ((ex - sx) + (ey - sy)) / 2
+        axis = (sx, sy), (length, length)
+        fallback = (0, 0), (width, height)
+    else:
+        axis = (sx, sy), (ex - sx, ey - sy)
+        fallback = (0, 0), (width, 0)
+    return axis if axis[1] != (0, 0) else fallback
+
+
+def gradient_positions(width, height, start, end, gradient_type, direction):
+    # Position 0..1 along the gradient for every pixel, built from a row and a column vector
+    xs = np.arange(width, dtype=np.float32)[None, :] + 0.5
+    ys = np.arange(height, dtype=np.float32)[:, None] + 0.5
+    if gradient_type in ("linear", "reflected"):
+        (ax, ay), (dx, dy) = gradient_axis(width, height, start, end, direction)
+        norm = dx * dx + dy * dy
+        t = (xs - ax) * np.float32(dx / norm) + (ys - ay) * np.float32(dy / norm)
+        if gradient_type == "reflected":
+            np.abs(t, out=t)
+        return np.clip(t, 0.0, 1.0, out=t)
+    cx, cy = start
+    dx, dy = end[0] - cx, end[1] - cy
+    radius = math.hypot(dx, dy)
+    if radius == 0:
+        cx, cy, radius = width / 2, height / 2, math.hypot(width, height) / 2
+        dx, dy = radius, 0
+    xs -= cx
+    ys -= cy
+    if gradient_type == "radial":
+        t = np.sqrt(xs * xs + ys * ys) * np.float32(1 / radius)
+    elif gradient_type == "diamond":
+        # Manhattan distance in the frame rotated onto the drag direction
+        cos, sin = dx / radius, dy / radius
+        t = np.abs(xs * np.float32(cos) + ys * np.float32(sin))
+        t += np.abs(ys * np.float32(cos) - xs * np.float32(sin))
+        t *= np.float32(1 / radius)
+    else:
+        t = np.arctan2(ys, xs) - np.float32(math.atan2(dy, dx))
+        t *= np.float32(1 / (2 * math.pi))
+        t %= 1.0
+    return np.clip(t, 0.0, 1.0, out=t)
+
+
+def render_gradient(width, height, start, end, gradient_type, direction, colors, alpha=255):
+    t = gradient_positions(width, height, start, end, gradient_type, direction)
+    t *= LUT_SIZE - 1
+    t += 0.5
+    indices = np.empty(t.shape, dtype=np.uint16)
+    np.copyto(indices, t, casting="unsafe")
+    # Gathering whole RGBA pixels as uint32 is several times faster than indexing a (N, 4) table
+    lut = gradient_lut(colors, alpha).view(np.uint32).ravel()
+    return Image.fromarray(lut[indices].view(np.uint8).reshape(height, width, 4), "RGBA")
+
+
+def row_runs(similar):
+    # Start and end (exclusive) columns of every horizontal run of True pixels, row-major
+    height, width = similar.shape
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = similar
+    edges = np.diff(padded, axis=1)
+    # Rising and falling edges alternate along a row, so one scan yields both in order
+    flat = np.flatnonzero(edges)
+    rows = flat[::2] // (width + 1)
+    starts = flat[::2] % (width + 1)
+    ends = flat[1::2] % (width + 1)
+    offsets = np.searchsorted(rows, np.arange(height + 1))
+    return rows, starts, ends, offsets
+
+
+def connected_region(similar, x, y):
+    # Scanline fill over whole runs: each run is visited once and linked to the overlapping
+    # runs of the rows above and below, so the Python loop only sees runs, not pixels.
+    # Returns the bounding box of the region and its boolean mask inside that box.
+    height, width = similar.shape
+    rows, starts, ends, offsets = row_runs(similar)
+    lo, hi = offsets[y], offsets[y + 1]
+    seed = lo + np.searchsorted(starts[lo:hi], x, side="right") - 1
+    if seed < lo or ends[seed] <= x:
+        return None
+    visited = np.zeros(len(starts), dtype=bool)
+    visited[seed] = True
+    stack = [seed]
+    while stack:
+        run = stack.pop()
+        row, start, end = rows[run], starts[run], ends[run]
+        for neighbour in (row - 1, row + 1):
+            if not 0 <= neighbour < height:
+                continue
+            lo, hi = offsets[neighbour], offsets[neighbour + 1]
+            first = lo + np.searchsorted(ends[lo:hi], start, side="right")
+            last = lo + np.searchsorted(starts[lo:hi], end, side="left")
+            for other in range(first, last):
+                if not visited[other]:
+                    visited[other] = True
+                    stack.append(other)
+    rows, starts, ends = rows[visited], starts[visited], ends[visited]
+    box = (int(starts.min()), int(rows.min()), int(ends.max()), int(rows.max()) + 1)
+    marks = np.zeros((box[3] - box[1], box[2] - box[0] + 1), dtype=np.int8)
+    marks[rows - box[1], starts - box[0]] = 1
+    marks[rows - box[1], ends - box[0]] = -1
+    return box, np.cumsum(marks, axis=1, dtype=np.int8)[:, :-1] > 0
+
+
+def fill_mask(image, x, y, tolerance=0, antialias=False, selection=None):
+    # Returns (box, "L" mask) of the area to fill, or None when nothing would change
+    pixels = np.asarray(image)
+    if tolerance <= 0:
+        packed = pixels.view(np.uint32)[..., 0]
+        similar = packed == packed[y, x]
+    else:
+        similar = np.ones(pixels.shape[:2], dtype=bool)
+        for channel, value in enumerate(pixels[y, x].tolist()):
+            plane = pixels[..., channel]
+            similar &= plane >= max(0, value - tolerance)
+            similar &= plane <= min(255, value + tolerance)
+    if selection is not None:
+        inside = np.asarray(selection) > 0
+        if not inside[y, x]:
+            return None
+        similar &= inside
+    found = connected_region(similar, x, y)
+    if found is None:
+        return None
+    box, region = found
+    mask = Image.fromarray(region.astype(np.uint8) * 255, "L")
+    if antialias:
+        # Soften only the outside of the edge, the filled area itself keeps full coverage
+        pad = (min(1, box[0]), min(1, box[1]), min(1, image.width - box[2]), min(1, image.height - box[3]))
+        box = (box[0] - pad[0], box[1] - pad[1], box[2] + pad[2], box[3] + pad[3])
+        padded = Image.new("L", (box[2] - box[0], box[3] - box[1]), 0)
+        padded.paste(mask, pad[:2])
+        mask = Image.fromarray(np.maximum(np.asarray(padded.filter(ImageFilter.BoxBlur(1))), np.asarray(padded)), "L")
+    if selection is not None:
+        mask = ImageChops.multiply(mask, selection.crop(box))
+    return box, mask
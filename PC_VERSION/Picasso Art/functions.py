@@ -1,5 +1,6 @@
 import math
 import collections
+import itertools
 import numpy as np
 from PIL import Image, ImageDraw, ImageTk, ImageColor, ImageFilter, ImageEnhance, ImageOps, ImageChops, ImageFont
 from tkinter import messagebox, simpledialog
@@ -9,9 +10,18 @@ import os
 import base64
 from io import BytesIO
 import colorsys
+import blending
+import fill
+from compositor import TileCompositor
+from history import UndoHistory
+from project import ProjectFile
+from viewport import DisplayPyramid
 
 class Layer:
-    def __init__(self, name, width, height, bg_color="transparent", is_adjustment=False, adjustment_type=None):
+    uids = itertools.count()
+
+    def __init__(self, name, width, height, bg_color="transparent", is_adjustment=False, adjustment_type=None, loader=None):
+        self.uid = next(Layer.uids)  # Stable identity for the undo history and the project file
         self.name = name
         self.visible = True
         self.opacity = 100
@@ -20,15 +30,43 @@ class Layer:
         self.is_adjustment = is_adjustment
         self.adjustment_type = adjustment_type
         self.adjustment_params = {}
-        self.image = Image.new("RGBA", (width, height), (0, 0, 0, 0) if bg_color == "transparent" else bg_color)
-        self.draw = ImageDraw.Draw(self.image)
         self.thumbnail = None
         self.mask = None
         self.transform_mode = False  # For transform mode
         self.rotation = 0  # Rotation angle (90, 180, 270 degrees)
         self.scale = 1.0  # Scale factor
         self.position = (0, 0)  # Position offset
-        self.update_thumbnail()
+        if loader is not None:
+            # Pixels are decoded from the project file the first time the image is accessed
+            self._image = None
+            self._draw = None
+            self.loader = loader
+        else:
+            self.image = Image.new("RGBA", (width, height), (0, 0, 0, 0) if bg_color == "transparent" else bg_color)
+            self.update_thumbnail()
+
+    @property
+    def image(self):
+        if self.loader is not None:
+            loader, self.loader = self.loader, None
+            self._image = loader(self)
+        return self._image
+
+    @image.setter
+    def image(self, value):
+        self.loader = None
+        self._image = value
+        self._draw = None
+
+    @property
+    def draw(self):
+        if self._draw is None:
+            self._draw = ImageDraw.Draw(self.image)
+        return self._draw
+
+    @draw.setter
+    def draw(self, value):
+        self._draw = value
 
     def update_thumbnail(self):
         if self.image:
@@ -63,81 +101,14 @@ class Layer:
             return img
         return self.image.copy()
 
-    def apply_blend_mode(self, base, top):
-        base = base.convert("RGBA")
-        top = top.convert("RGBA")
-        if self.blend_mode == "normal":
-            return top
-        elif self.blend_mode == "multiply":
-            return ImageChops.multiply(base, top)
-        elif self.blend_mode == "screen":
-            return ImageChops.screen(base, top)
-        elif self.blend_mode == "overlay":
-            return ImageChops.overlay(base, top)
-        elif self.blend_mode == "darken":
-            return ImageChops.darker(base, top)
-        elif self.blend_mode == "lighten":
-            return ImageChops.lighter(base, top)
-        elif self.blend_mode == "color_dodge":
-            return self.blend_color_dodge(base, top)
-        elif self.blend_mode == "color_burn":
-            return self.blend_color_burn(base, top)
-        elif self.blend_mode == "soft_light":
-            return self.blend_soft_light(base, top)
-        elif self.blend_mode == "hard_light":
-            return ImageChops.hard_light(base, top)
-        elif self.blend_mode == "difference":
-            return ImageChops.difference(base, top)
-        elif self.blend_mode == "exclusion":
-            return self.blend_exclusion(base, top)
-        return top
-
-    def blend_color_dodge(self, base, top):
-        base_arr = np.array(base.convert("RGB")).astype(float)
-        top_arr = np.array(top.convert("RGB")).astype(float)
-        result_arr = np.clip(base_arr / (1 - top_arr / 255 + 1e-10), 0, 255)
-        return Image.fromarray(result_arr.astype('uint8'), 'RGB').convert("RGBA")
-
-    def blend_color_burn(self, base, top):
-        base_arr = np.array(base.convert("RGB")).astype(float)
-        top_arr = np.array(top.convert("RGB")).astype(float)
-        result_arr = np.clip(1 - (1 - base_arr / 255) / (top_arr / 255 + 1e-10) * 255, 0, 255)
-        return Image.fromarray(result_arr.astype('uint8'), 'RGB').convert("RGBA")
-
-    def blend_soft_light(self, base, top):
-        base_arr = np.array(base.convert("RGB")).astype(float) / 255
-        top_arr = np.array(top.convert("RGB")).astype(float) / 255
-        result_arr = np.where(top_arr <= 0.5,
-                              2 * base_arr * top_arr + base_arr ** 2 * (1 - 2 * top_arr),
-                              np.sqrt(base_arr) * (2 * top_arr - 1) + 2 * base_arr * (1 - top_arr))
-        result_arr = np.clip(result_arr * 255, 0, 255)
-        return Image.fromarray(result_arr.astype('uint8'), 'RGB').convert("RGBA")
-
-    def blend_exclusion(self, base, top):
-        base_arr = np.array(base.convert("RGB")).astype(float) / 255
-        top_arr = np.array(top.convert("RGB")).astype(float) / 255
-        result_arr = base_arr + top_arr - 2 * base_arr * top_arr
-        result_arr = np.clip(result_arr * 255, 0, 255)
-        return Image.fromarray(result_arr.astype('uint8'), 'RGB').convert("RGBA")
-
-    def apply_adjustment(self, image):
+    def apply_blend_mode(self, base, top, mask=None):
+        # base and top are premultiplied float32 buffers, base is updated in place
+        return blending.blend(base, top, self.blend_mode, self.opacity / 100, mask)
+
+    def apply_adjustment(self, buffer, mask=None, pivot=0.5):
         if not self.is_adjustment:
-            return image
-        img = image.convert("RGB")
-        if self.adjustment_type == "brightness":
-            enhancer = ImageEnhance.Brightness(img)
-            return enhancer.enhance(self.adjustment_params.get("strength", 1.0)).convert("RGBA")
-        elif self.adjustment_type == "contrast":
-            enhancer = ImageEnhance.Contrast(img)
-            return enhancer.enhance(self.adjustment_params.get("strength", 1.0)).convert("RGBA")
-        elif self.adjustment_type == "hue":
-            hsv = np.array(img.convert("HSV")).astype(float)
-            hsv[:, :, 0] = (hsv[:, :, 0] + self.adjustment_params.get("hue", 0)) % 360
-            return Image.fromarray(hsv.astype('uint8'), 'HSV').convert("RGBA")
-        elif self.adjustment_type == "saturation":
-            enhancer = ImageEnhance.Color(img)
-            return enhancer.enhance(self.adjustment_params.get("strength", 1.0)).convert("RGBA")
-        return image
+            return buffer
+        return blending.adjust(buffer, self.adjustment_type, self.adjustment_params, self.opacity / 100, mask, pivot)
 
 class Selection:
     def __init__(self, width, height):
@@ -165,6 +136,7 @@ class PaintFunctions:
         self.last_x, self.last_y = None, None
         self.temp_image = None
         self.temp_draw = None
+        self.stroke_box = None
         self.canvas_offset_x = 0
         self.canvas_offset_y = 0
         self.scale_factor = 1.0
@@ -177,25 +149,30 @@ class PaintFunctions:
         self.cmyk_values = [0, 0, 0, 0]
         self.lab_values = [50, 0, 0]
         self.hsb_values = [0, 0, 100]
-        self.history = []
-        self.redo_stack = []
         self.actions = []
         self.current_action = None
         self.max_history = 50
+        self.history = UndoHistory(self.max_history)
+        self.project = ProjectFile()
         self.layers = []
         self.current_layer_index = 0
         self.selection = Selection(self.canvas_width, self.canvas_height)
         self.has_selection = False
+        self.compositor = TileCompositor(self)
+        self.pyramid = DisplayPyramid()
+        self.view_width = None  # Size of the on-screen view, None shows the whole canvas
+        self.view_height = None
+        self.view_origin = (0, 0)  # Where the rendered part of the canvas goes in the view
         self.create_new_layer("Фон", self.bg_color)
         self.paths = []
         self.current_path = None
-        self.composite_image = Image.new("RGB", (self.canvas_width, self.canvas_height), self.bg_color)
-        self.composite_rgba = Image.new("RGBA", (self.canvas_width, self.canvas_height), (0, 0, 0, 0))
         self.preview_image = None
         self.tk_image = None
         self.gradient_type = "linear"
         self.gradient_colors = ["#ff0000", "#0000ff"]
         self.gradient_direction = "horizontal"
+        self.fill_tolerance = 0
+        self.fill_antialias = False
         self.swatches = []
         self.brush_presets = [
             {"name": "Мягкая круглая", "size": 10, "hardness": 50, "shape": "circle"},
@@ -316,39 +293,27 @@ class PaintFunctions:
             self.save_state(action="Переключение режима трансформации")
 
     def get_display_image(self, temp_layer_image=None):
-        composite = Image.new("RGBA", (self.canvas_width, self.canvas_height), (0, 0, 0, 0))
-        for i, layer in enumerate(self.layers):
-            if layer.visible and layer.opacity > 0:
-                layer_img = layer.apply_transform() if layer.transform_mode else layer.get_image_with_opacity()
-                if temp_layer_image is not None and i == self.current_layer_index and not layer.is_adjustment:
-                    layer_img = temp_layer_image.convert("RGBA")
-                    alpha = layer_img.split()[3].point(lambda p: int(p * layer.opacity / 100))
-                    layer_img.putalpha(alpha)
-                if layer.is_adjustment:
-                    layer_img = layer.apply_adjustment(composite)
-                if layer.blend_mode != "normal":
-                    temp_composite = composite.copy()
-                    composite = layer.apply_blend_mode(temp_composite, layer_img)
-                else:
-                    composite = Image.alpha_composite(composite, layer_img)
-        display_base = Image.new("RGB", (self.canvas_width, self.canvas_height), self.bg_color)
-        display_base.paste(composite, (0, 0), composite)
-        return display_base
-
-    def update_composite_image(self):
-        self.composite_image = self.get_display_image()
-        composite = Image.new("RGBA", (self.canvas_width, self.canvas_height), (0, 0, 0, 0))
-        for layer in self.layers:
-            if layer.visible and layer.opacity > 0:
-                layer_img = layer.apply_transform() if layer.transform_mode else layer.get_image_with_opacity()
-                if layer.is_adjustment:
-                    layer_img = layer.apply_adjustment(composite)
-                if layer.blend_mode != "normal":
-                    temp_composite = composite.copy()
-                    composite = layer.apply_blend_mode(temp_composite, layer_img)
-                else:
-                    composite = Image.alpha_composite(composite, layer_img)
-        self.composite_rgba = composite
+        return self.compositor.render(temp_layer_image)
+
+    def update_composite_image(self, box=None, temp_layer_image=None):
+        # box=None recomposites everything; otherwise only the tiles touched by box are redrawn
+        self.compositor.refresh(box, temp_layer_image)
+        self.composite_image = self.compositor.composite_image
+        self.composite_rgba = self.compositor.composite_rgba
+        self.pyramid.update(self.composite_image, box)
+
+    def get_stroke_box(self, points, width):
+        pad = width / 2 + 2
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        return (min(xs) - pad, min(ys) - pad, max(xs) + pad + 1, max(ys) + pad + 1)
+
+    def extend_stroke_box(self, box):
+        if self.stroke_box is None:
+            self.stroke_box = box
+        else:
+            self.stroke_box = (min(self.stroke_box[0], box[0]), min(self.stroke_box[1], box[1]),
+                               max(self.stroke_box[2], box[2]), max(self.stroke_box[3], box[3]))
 
     def get_current_layer(self):
         if self.layers and 0 <= self.current_layer_index < len(self.layers):
@@ -511,11 +476,10 @@ class PaintFunctions:
         self.current_layer_index = 0
         self.selection = Selection(width, height)
         self.has_selection = False
+        self.project = ProjectFile()
         self.create_new_layer("Фон", bg_color)
         self.paths = []
         self.current_path = None
-        self.composite_image = Image.new("RGB", (width, height), bg_color)
-        self.composite_rgba = Image.new("RGBA", (width, height), (0, 0, 0, 0))
         self.save_state(action="Создание нового изображения")
 
     def open_image(self, file_path):
@@ -530,6 +494,7 @@ class PaintFunctions:
             layer.draw = ImageDraw.Draw(layer.image)
             layer.update_thumbnail()
             self.layers.append(layer)
+            self.project = ProjectFile()
             self.selection = Selection(self.canvas_width, self.canvas_height)
             self.has_selection = False
             self.paths = []
@@ -557,13 +522,13 @@ class PaintFunctions:
             "width": self.canvas_width,
             "height": self.canvas_height,
             "bg_color": self.bg_color,
-            "layers": [],
             "current_layer_index": self.current_layer_index,
             "swatches": self.swatches,
             "brush_presets": self.brush_presets,
             "filter_presets": self.filter_presets,
             "actions": self.actions
         }
+        layers = []
         for layer in self.layers:
             layer_data = {
                 "name": layer.name,
@@ -574,23 +539,23 @@ class PaintFunctions:
                 "is_adjustment": layer.is_adjustment,
                 "adjustment_type": layer.adjustment_type,
                 "adjustment_params": layer.adjustment_params,
-                "image": None,
                 "rotation": layer.rotation,
                 "scale": layer.scale,
                 "position": layer.position
             }
-            if not layer.is_adjustment:
-                buffered = BytesIO()
-                layer.image.save(buffered, format="PNG")
-                layer_data["image"] = base64.b64encode(buffered.getvalue()).decode('utf-8')
-            project["layers"].append(layer_data)
-        with open(file_path, 'w') as f:
-            json.dump(project, f, indent=2)
+            layers.append((layer, layer_data))
+        self.project.save(file_path, project, layers)
 
     def load_project(self, file_path):
         try:
-            with open(file_path, 'r') as f:
-                project = json.load(f)
+            if ProjectFile.is_project(file_path):
+                project_file = ProjectFile()
+                project = project_file.load(file_path)
+            else:
+                # Projects saved before the chunked format: one JSON file with base64 PNG layers
+                project_file = None
+                with open(file_path, 'r') as f:
+                    project = json.load(f)
             self.canvas_width = project["width"]
             self.canvas_height = project["height"]
             self.bg_color = project["bg_color"]
@@ -601,12 +566,14 @@ class PaintFunctions:
             self.actions = project.get("actions", [])
             self.layers = []
             for layer_data in project["layers"]:
+                lazy = project_file is not None and layer_data["tiles"] and not layer_data["visible"]
                 layer = Layer(
                     name=layer_data["name"],
                     width=self.canvas_width,
                     height=self.canvas_height,
                     is_adjustment=layer_data["is_adjustment"],
-                    adjustment_type=layer_data["adjustment_type"]
+                    adjustment_type=layer_data["adjustment_type"],
+                    loader=self.layer_loader(project_file) if lazy else None
                 )
                 layer.visible = layer_data["visible"]
                 layer.opacity = layer_data["opacity"]
@@ -615,13 +582,19 @@ class PaintFunctions:
                 layer.adjustment_params = layer_data.get("adjustment_params", {})
                 layer.rotation = layer_data.get("rotation", 0)
                 layer.scale = layer_data.get("scale", 1.0)
-                layer.position = layer_data.get("position", (0, 0))
-                if layer_data["image"]:
+                layer.position = tuple(layer_data.get("position", (0, 0)))
+                if project_file is not None:
+                    project_file.bind(layer.uid, layer_data)
+                    if layer_data["tiles"] and not lazy:
+                        layer.image = project_file.read_layer(layer.uid)
+                    layer.thumbnail = project_file.read_thumbnail(layer.uid)
+                elif layer_data["image"]:
                     img_data = base64.b64decode(layer_data["image"])
                     layer.image = Image.open(BytesIO(img_data)).convert("RGBA")
-                    layer.draw = ImageDraw.Draw(layer.image)
-                layer.update_thumbnail()
+                if layer.thumbnail is None:
+                    layer.update_thumbnail()
                 self.layers.append(layer)
+            self.project = project_file or ProjectFile()
             self.selection = Selection(self.canvas_width, self.canvas_height)
             self.has_selection = False
             self.paths = []
@@ -633,6 +606,13 @@ class PaintFunctions:
             messagebox.showerror("Ошибка", f"Не удалось загрузить проект: {str(e)}")
             return False
 
+    def layer_loader(self, project_file):
+        def load(layer):
+            image = project_file.read_layer(layer.uid)
+            self.history.adopt(layer.uid, image)
+            return image
+        return load
+
     def apply_drawing(self):
         layer = self.get_current_layer()
         if layer and not layer.locked and not layer.is_adjustment:
@@ -642,25 +622,30 @@ class PaintFunctions:
             else:
                 color = self.get_color_with_alpha(self.draw_color)
             if self.temp_image:
-                layer.image = self.temp_image.copy()
+                layer.image = self.temp_image
                 layer.draw = ImageDraw.Draw(layer.image)
                 self.temp_image = None
                 self.temp_draw = None
                 layer.update_thumbnail()
-                self.update_composite_image()
-                self.save_state(action="Рисование")
+                box = self.stroke_box
+                if box is not None:
+                    self.update_composite_image(box)
+                    self.stroke_box = None
+                self.save_state(action="Рисование", box=box)
 
     def start_drawing(self, x, y):
         layer = self.get_current_layer()
         if layer and not layer.locked and not layer.is_adjustment:
             self.temp_image = layer.image.copy()
             self.temp_draw = ImageDraw.Draw(self.temp_image)
+            self.stroke_box = None
             self.last_x, self.last_y = x, y
 
     def draw_on_image(self, last_x, last_y, x, y):
         layer = self.get_current_layer()
         if layer and not layer.locked and not layer.is_adjustment and self.temp_draw:
             color = (0, 0, 0, 0) if self.current_tool == "eraser" else self.get_color_with_alpha(self.draw_color)
+            points = [(last_x, last_y), (x, y)]
             if self.brush_shape == "circle":
                 self.temp_draw.line((last_x, last_y, x, y), fill=color, width=self.line_width)
             elif self.brush_shape == "square":
@@ -669,7 +654,9 @@ class PaintFunctions:
                 points = [(last_x - dx, last_y - dy), (last_x + dx, last_y + dy),
                           (x + dx, y + dy), (x - dx, y - dy)]
                 self.temp_draw.polygon(points, fill=color)
-            self.update_composite_image()
+            box = self.get_stroke_box(points, self.line_width)
+            self.extend_stroke_box(box)
+            self.update_composite_image(box, self.temp_image)
 
     def draw_shape_final(self, start_x, start_y, end_x, end_y):
         layer = self.get_current_layer()
@@ -704,27 +691,13 @@ class PaintFunctions:
     def create_gradient(self, start_x, start_y, end_x, end_y):
         layer = self.get_current_layer()
         if layer and not layer.locked and not layer.is_adjustment:
-            self.temp_image = layer.image.copy()
-            self.temp_draw = ImageDraw.Draw(self.temp_image)
-            start_color = ImageColor.getrgb(self.gradient_colors[0])
-            end_color = ImageColor.getrgb(self.gradient_colors[1])
-            width, height = self.canvas_width, self.canvas_height
-            gradient = Image.new("RGBA", (width, height), (0, 0, 0, 0))
-            draw = ImageDraw.Draw(gradient)
-            if self.gradient_type == "linear":
-                for i in range(width if self.gradient_direction == "horizontal" else height):
-                    ratio = i / (width if self.gradient_direction == "horizontal" else height)
-                    r = int(start_color[0] + (end_color[0] - start_color[0]) * ratio)
-                    g = int(start_color[1] + (end_color[1] - start_color[1]) * ratio)
-                    b = int(start_color[2] + (end_color[2] - start_color[2]) * ratio)
-                    if self.gradient_direction == "horizontal":
-                        draw.line((i, 0, i, height), fill=(r, g, b, self.alpha))
-                    else:
-                        draw.line((0, i, width, i), fill=(r, g, b, self.alpha))
-            layer.image = Image.alpha_composite(self.temp_image, gradient)
+            gradient = fill.render_gradient(self.canvas_width, self.canvas_height, (start_x, start_y), (end_x, end_y),
+                                            self.gradient_type, self.gradient_direction, self.gradient_colors, self.alpha)
+            if self.has_selection:
+                alpha = ImageChops.multiply(gradient.getchannel("A"), self.selection.mask)
+                gradient.putalpha(alpha)
+            layer.image = Image.alpha_composite(layer.image, gradient)
             layer.draw = ImageDraw.Draw(layer.image)
-            self.temp_image = None
-            self.temp_draw = None
             layer.update_thumbnail()
             self.update_composite_image()
             self.save_state(action="Создание градиента")
@@ -733,11 +706,15 @@ class PaintFunctions:
         layer = self.get_current_layer()
         if layer and not layer.locked and not layer.is_adjustment:
             color = self.get_color_with_alpha(self.draw_color)
-            ImageDraw.floodfill(layer.image, (int(x), int(y)), color)
-            layer.draw = ImageDraw.Draw(layer.image)
+            selection = self.selection.mask if self.has_selection else None
+            region = fill.fill_mask(layer.image, int(x), int(y), self.fill_tolerance, self.fill_antialias, selection)
+            if region is None:
+                return
+            box, mask = region
+            layer.image.paste(color, box, mask)
             layer.update_thumbnail()
-            self.update_composite_image()
-            self.save_state(action="Заливка")
+            self.update_composite_image(box)
+            self.save_state(action="Заливка", box=box)
 
     def add_text_to_image(self, x, y, text):
         layer = self.get_current_layer()
@@ -854,7 +831,7 @@ class PaintFunctions:
                         self.set_layer_blend_mode(step["index"], step["blend_mode"])
             self.save_state(action=f"Воспроизведение действия: {action['name']}")
 
-    def save_state(self, action="Изменение"):
+    def save_state(self, action="Изменение", box=None):
         if self.current_action:
             self.current_action["steps"].append({
                 "type": "draw" if self.current_tool in ["pencil", "brush", "eraser"] else
@@ -883,108 +860,19 @@ class PaintFunctions:
                 "opacity": self.get_current_layer().opacity if self.get_current_layer() else 100,
                 "blend_mode": self.get_current_layer().blend_mode if self.get_current_layer() else "normal"
             })
-        state = {
-            "action": action,
-            "layers": [
-                {
-                    "name": layer.name,
-                    "visible": layer.visible,
-                    "opacity": layer.opacity,
-                    "locked": layer.locked,
-                    "blend_mode": layer.blend_mode,
-                    "is_adjustment": layer.is_adjustment,
-                    "adjustment_type": layer.adjustment_type,
-                    "adjustment_params": layer.adjustment_params,
-                    "image": layer.image.copy() if not layer.is_adjustment else None,
-                    "rotation": layer.rotation,
-                    "scale": layer.scale,
-                    "position": layer.position
-                } for layer in self.layers
-            ],
-            "current_layer_index": self.current_layer_index,
-            "selection": {
-                "mask": self.selection.mask.copy(),
-                "points": self.selection.points[:],
-                "mode": self.selection.mode
-            }
-        }
-        self.history.append(state)
-        if len(self.history) > self.max_history:
-            self.history.pop(0)
-        self.redo_stack = []
+        self.history.record(self, action, box)
 
     def undo(self):
-        if self.history:
-            self.redo_stack.append(self.get_current_state())
-            state = self.history.pop()
-            self.restore_state_from_data(state)
-            return True
-        return False
+        done, box = self.history.undo(self)
+        if done:
+            self.update_composite_image(box)
+        return done
 
     def redo(self):
-        if self.redo_stack:
-            self.history.append(self.get_current_state())
-            state = self.redo_stack.pop()
-            self.restore_state_from_data(state)
-            return True
-        return False
-
-    def restore_state_from_data(self, state):
-        self.layers = []
-        for layer_data in state["layers"]:
-            layer = Layer(
-                name=layer_data["name"],
-                width=self.canvas_width,
-                height=self.canvas_height,
-                is_adjustment=layer_data["is_adjustment"],
-                adjustment_type=layer_data["adjustment_type"]
-            )
-            layer.visible = layer_data["visible"]
-            layer.opacity = layer_data["opacity"]
-            layer.locked = layer_data["locked"]
-            layer.blend_mode = layer_data["blend_mode"]
-            layer.adjustment_params = layer_data.get("adjustment_params", {})
-            layer.rotation = layer_data.get("rotation", 0)
-            layer.scale = layer_data.get("scale", 1.0)
-            layer.position = layer_data.get("position", (0, 0))
-            if layer_data["image"]:
-                layer.image = layer_data["image"].copy()
-                layer.draw = ImageDraw.Draw(layer.image)
-            layer.update_thumbnail()
-            self.layers.append(layer)
-        self.current_layer_index = state["current_layer_index"]
-        self.selection.mask = state["selection"]["mask"].copy()
-        self.selection.points = state["selection"]["points"][:]
-        self.selection.mode = state["selection"]["mode"]
-        self.has_selection = bool(self.selection.points or self.selection.mask.getbbox())
-        self.update_composite_image()
-
-    def get_current_state(self):
-        return {
-            "action": "Текущее состояние",
-            "layers": [
-                {
-                    "name": layer.name,
-                    "visible": layer.visible,
-                    "opacity": layer.opacity,
-                    "locked": layer.locked,
-                    "blend_mode": layer.blend_mode,
-                    "is_adjustment": layer.is_adjustment,
-                    "adjustment_type": layer.adjustment_type,
-                    "adjustment_params": layer.adjustment_params,
-                    "image": layer.image.copy() if not layer.is_adjustment else None,
-                    "rotation": layer.rotation,
-                    "scale": layer.scale,
-                    "position": layer.position
-                } for layer in self.layers
-            ],
-            "current_layer_index": self.current_layer_index,
-            "selection": {
-                "mask": self.selection.mask.copy(),
-                "points": self.selection.points[:],
-                "mode": self.selection.mode
-            }
-        }
+        done, box = self.history.redo(self)
+        if done:
+            self.update_composite_image(box)
+        return done
 
     def rotate_canvas(self, angle):
         for layer in self.layers:
@@ -996,13 +884,20 @@ class PaintFunctions:
         self.save_state(action=f"Поворот холста на {angle} градусов")
 
     def get_photo_image(self):
-        display_image = self.preview_image if self.preview_image else self.composite_image
-        resized = display_image.resize((int(self.canvas_width * self.scale_factor), int(self.canvas_height * self.scale_factor)), Image.LANCZOS)
-        self.tk_image = ImageTk.PhotoImage(resized)
+        # Only the part of the canvas inside the view is scaled and converted for Tk
+        view_width = self.view_width or math.ceil(self.canvas_width * self.scale_factor)
+        view_height = self.view_height or math.ceil(self.canvas_height * self.scale_factor)
+        image, self.view_origin = self.pyramid.render(self.scale_factor, self.canvas_offset_x, self.canvas_offset_y,
+                                                      view_width, view_height, self.preview_image)
+        if image is None:
+            image = Image.new("RGB", (1, 1), self.bg_color)
+            self.view_origin = (-1, -1)
+        if self.tk_image is not None and (self.tk_image.width(), self.tk_image.height()) == image.size:
+            self.tk_image.paste(image)
+        else:
+            self.tk_image = ImageTk.PhotoImage(image)
         return self.tk_image
 
     def get_temp_photo_image(self):
-        temp_image = self.get_display_image(self.temp_image)
-        resized = temp_image.resize((int(self.canvas_width * self.scale_factor), int(self.canvas_height * self.scale_factor)), Image.LANCZOS)
-        self.tk_image = ImageTk.PhotoImage(resized)
-        return self.tk_image
\ No newline at end of file
+        # draw_on_image already recomposited the stroke's tiles with the temp image
+        return self.get_photo_image()
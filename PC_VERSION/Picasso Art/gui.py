@@ -407,6 +407,15 @@ class PaintApp:
         self.alpha_slider.set(self.functions.alpha)
         self.alpha_slider.pack(fill="x", pady=5)
 
+        ttk.Label(options_card, text="Допуск заливки:", style="TLabel").pack(anchor="w", pady=(10, 0))
+        self.fill_tolerance = tk.Scale(options_card, from_=0, to=255, orient="horizontal", bg=self.card_color,
+                                       fg=self.text_color, highlightthickness=0, command=self.update_fill_tolerance)
+        self.fill_tolerance.set(self.functions.fill_tolerance)
+        self.fill_tolerance.pack(fill="x", pady=5)
+        self.fill_antialias = tk.BooleanVar(value=self.functions.fill_antialias)
+        ttk.Checkbutton(options_card, text="Сглаживание заливки", variable=self.fill_antialias,
+                        command=self.update_fill_antialias).pack(anchor="w", pady=5)
+
     def create_filters_panel(self, parent):
         filter_card = ttk.Frame(parent, style="Card.TFrame", padding=10)
         filter_card.pack(fill="x", pady=(0, 10))
@@ -549,6 +558,10 @@ class PaintApp:
         self.canvas.bind("<MouseWheel>", self.zoom)
         self.canvas.bind("<Button-4>", self.zoom)
         self.canvas.bind("<Button-5>", self.zoom)
+        self.canvas.bind("<ButtonPress-2>", self.pan_start)
+        self.canvas.bind("<B2-Motion>", self.pan_drag)
+        self.canvas.bind("<ButtonRelease-2>", self.pan_end)
+        self.canvas.bind("<Configure>", self.resize_view)
         self.root.bind("<Control-z>", self.undo)
         self.root.bind("<Control-y>", self.redo)
         self.root.bind("<Control-n>", self.new_file)
@@ -656,6 +669,12 @@ class PaintApp:
         self.functions.alpha = int(float(value))
         self.update_status()
 
+    def update_fill_tolerance(self, value):
+        self.functions.fill_tolerance = int(float(value))
+
+    def update_fill_antialias(self):
+        self.functions.fill_antialias = self.fill_antialias.get()
+
     def preview_filter(self, event=None):
         filter_type = self.filter_type.get()
         if filter_type == "none":
@@ -902,6 +921,7 @@ class PaintApp:
             self.functions.draw_on_image(self.functions.last_x, self.functions.last_y, x, y)
             self.functions.last_x, self.functions.last_y = x, y
             self.canvas.itemconfig(self.canvas_image, image=self.functions.get_temp_photo_image())
+            self.canvas.coords(self.canvas_image, *self.functions.view_origin)
         elif self.functions.current_tool in ["line", "rectangle", "filled_rectangle", "ellipse", "filled_ellipse", "polygon", "filled_polygon", "gradient", "selection", "lasso"]:
             self.functions.selection.points.append((x, y))
             self.functions.create_selection(self.functions.current_tool, self.functions.selection.points)
@@ -938,11 +958,34 @@ class PaintApp:
 
     def zoom(self, event):
         factor = 1.1 if event.delta > 0 or event.num == 4 else 0.9
+        old_scale = self.functions.scale_factor
         self.functions.scale_factor *= factor
         self.functions.scale_factor = max(0.1, min(self.functions.scale_factor, 5.0))
+        # Keep the canvas point under the cursor in place
+        ratio = self.functions.scale_factor / old_scale
+        self.functions.canvas_offset_x = event.x - (event.x - self.functions.canvas_offset_x) * ratio
+        self.functions.canvas_offset_y = event.y - (event.y - self.functions.canvas_offset_y) * ratio
         self.zoom_text.set(f"{int(self.functions.scale_factor * 100)}%")
         self.update_canvas()
 
+    def pan_start(self, event):
+        self.functions.dragging = True
+        self.functions.drag_start_x = event.x - self.functions.canvas_offset_x
+        self.functions.drag_start_y = event.y - self.functions.canvas_offset_y
+
+    def pan_drag(self, event):
+        if self.functions.dragging:
+            self.functions.canvas_offset_x = event.x - self.functions.drag_start_x
+            self.functions.canvas_offset_y = event.y - self.functions.drag_start_y
+            self.update_canvas()
+
+    def pan_end(self, event):
+        self.functions.dragging = False
+
+    def resize_view(self, event):
+        self.functions.view_width, self.functions.view_height = event.width, event.height
+        self.update_canvas()
+
     def undo(self, event=None):
         if self.functions.undo():
             self.update_canvas()
@@ -971,6 +1014,7 @@ class PaintApp:
 
     def update_canvas(self):
         self.canvas.itemconfig(self.canvas_image, image=self.functions.get_photo_image())
+        self.canvas.coords(self.canvas_image, *self.functions.view_origin)
 
     def update_layers_list(self):
         self.layers_listbox.delete(*self.layers_listbox.get_children())
@@ -0,0 +1,296 @@
+import math
+import tempfile
+import zlib
+import numpy as np
+from PIL import Image, ImageDraw
+from compositor import TILE_SIZE
+
+MEMORY_BUDGET = 256 * 1024 * 1024  # Compressed bytes kept in RAM before the oldest entries spill to disk
+
+LAYER_FIELDS = ("name", "visible", "opacity", "locked", "blend_mode", "is_adjustment", "adjustment_type",
+                "rotation", "scale", "position")
+
+SELECTION = "selection"
+
+
+class UndoHistory:
+    # Each entry keeps the layer metadata before and after an action plus the compressed tiles whose
+    # pixels changed. The shadow copies hold the pixels of the last recorded state, so recording only
+    # compares the images an action could have touched and undo/redo only paste the stored tiles.
+    def __init__(self, max_entries=50, memory_budget=MEMORY_BUDGET, tile_size=TILE_SIZE):
+        self.max_entries = max_entries
+        self.memory_budget = memory_budget
+        self.tile_size = tile_size
+        self.undo_stack = []
+        self.redo_stack = []
+        self.shadow = None  # key -> copy of the image as of the last recorded state
+        self.sources = {}  # key -> image object seen at the last record, to spot replaced images
+        self.lazy = {}  # uid -> layer whose pixels are still in the project file
+        self.meta = None
+        self.memory = 0
+        self.spill_file = None
+        self.spilled = 0
+
+    def __iter__(self):
+        return iter(self.undo_stack)
+
+    def __len__(self):
+        return len(self.undo_stack)
+
+    def clear(self):
+        self.undo_stack = []
+        self.redo_stack = []
+        self.shadow = None
+        self.sources = {}
+        self.lazy = {}
+        self.meta = None
+        self.memory = 0
+        self.release_spill_file()
+
+    # Recording
+
+    def snapshot_meta(self, f):
+        return {
+            "canvas": (f.canvas_width, f.canvas_height, f.bg_color),
+            "layers": [dict({name: getattr(layer, name) for name in LAYER_FIELDS},
+                            uid=layer.uid, adjustment_params=dict(layer.adjustment_params))
+                       for layer in f.layers],
+            "current_layer_index": f.current_layer_index,
+            "selection": {"points": f.selection.points[:], "mode": f.selection.mode}
+        }
+
+    def images_of(self, f):
+        images = {layer.uid: layer.image for layer in f.layers
+                  if not layer.is_adjustment and layer.loader is None}
+        images[SELECTION] = f.selection.mask
+        return images
+
+    def record(self, f, action, box=None):
+        # box limits the pixel comparison of the current layer, e.g. to a brush stroke's bounds
+        uids = {layer.uid for layer in f.layers}
+        for uid, layer in list(self.lazy.items()):
+            if uid not in uids:
+                layer.image  # Loading adopts a shadow copy, so removing the layer can still be undone
+        self.lazy = {layer.uid: layer for layer in f.layers if layer.loader is not None}
+        images = self.images_of(f)
+        meta = self.snapshot_meta(f)
+        if self.shadow is None:
+            self.shadow = {key: image.copy() for key, image in images.items()}
+            self.sources = dict(images)
+            self.meta = meta
+            return
+        current = f.get_current_layer()
+        current_uid = current.uid if current else None
+        tiles = []
+        for key, image in images.items():
+            shadow = self.shadow.get(key)
+            if shadow is None or shadow.size != image.size or shadow.mode != image.mode:
+                tiles += self.diff_tiles(key, shadow, None)
+                tiles += self.diff_tiles(key, None, image)
+                self.shadow[key] = image.copy()
+            elif key == current_uid or image is not self.sources.get(key):
+                region = box if key == current_uid else None
+                tiles += self.diff_tiles(key, shadow, image, region)
+        for key in [key for key in self.shadow if key not in images]:
+            tiles += self.diff_tiles(key, self.shadow.pop(key), None)
+        self.sources = dict(images)
+        if not tiles and meta == self.meta:
+            return
+        entry = {"action": action, "before": self.meta, "after": meta, "tiles": tiles, "size": 0}
+        self.meta = meta
+        entry["size"] = sum(len(tile[3] or b"") + len(tile[4] or b"") for tile in tiles)
+        self.memory += entry["size"]
+        self.undo_stack.append(entry)
+        if len(self.undo_stack) > self.max_entries:
+            self.drop(self.undo_stack.pop(0))
+        for old in self.redo_stack:
+            self.drop(old)
+        self.redo_stack = []
+        self.enforce_budget()
+
+    def adopt(self, uid, image):
+        # Called when a lazily loaded layer is decoded, before anything can modify it
+        self.lazy.pop(uid, None)
+        if self.shadow is not None:
+            self.shadow[uid] = image.copy()
+            self.sources[uid] = image
+
+    def diff_tiles(self, key, before, after, region=None):
+        # One tile is (key, box, mode, before bytes, after bytes); None stands for "image absent"
+        reference = after if after is not None else before
+        if reference is None:
+            return []
+        width, height = reference.size
+        mode = reference.mode
+        if region is None:
+            x0, y0, x1, y1 = 0, 0, width, height
+        else:
+            x0, y0 = max(0, int(region[0])), max(0, int(region[1]))
+            x1, y1 = min(width, math.ceil(region[2])), min(height, math.ceil(region[3]))
+            if x1 <= x0 or y1 <= y0:
+                return []
+        ts = self.tile_size
+        changed = None
+        if before is not None and after is not None:
+            a = np.asarray(before.crop((x0, y0, x1, y1)))
+            b = np.asarray(after.crop((x0, y0, x1, y1)))
+            changed = a != b
+            if changed.ndim == 3:
+                changed = changed.any(axis=2)
+            if not changed.any():
+                return []
+        tiles = []
+        for ty in range(y0 // ts, (y1 - 1) // ts + 1):
+            for tx in range(x0 // ts, (x1 - 1) // ts + 1):
+                box = (tx * ts, ty * ts, min(width, tx * ts + ts), min(height, ty * ts + ts))
+                if changed is not None and not changed[max(0, box[1] - y0):box[3] - y0,
+                                                       max(0, box[0] - x0):box[2] - x0].any():
+                    continue
+                before_data = self.pack(before, box)
+                after_data = self.pack(after, box)
+                if after is not None and before is not None:
+                    self.shadow[key].paste(after.crop(box), box[:2])
+                tiles.append([key, box, mode, before_data, after_data])
+        return tiles
+
+    def pack(self, image, box):
+        if image is None:
+            return None
+        return zlib.compress(image.crop(box).tobytes(), 1)
+
+    # Memory budget
+
+    def enforce_budget(self):
+        for entry in self.undo_stack + self.redo_stack:
+            if self.memory <= self.memory_budget:
+                break
+            if not entry.get("spilled"):
+                self.spill(entry)
+
+    def spill(self, entry):
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(prefix="picasso_undo_")
+        self.spill_file.seek(0, 2)
+        for tile in entry["tiles"]:
+            for i in (3, 4):
+                if isinstance(tile[i], bytes):
+                    offset = self.spill_file.tell()
+                    self.spill_file.write(tile[i])
+                    tile[i] = (offset, len(tile[i]))
+        entry["spilled"] = True
+        self.spilled += 1
+        self.memory -= entry["size"]
+
+    def drop(self, entry):
+        if entry.get("spilled"):
+            self.spilled -= 1
+            if self.spilled == 0:
+                self.release_spill_file()
+        else:
+            self.memory -= entry["size"]
+
+    def release_spill_file(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+        self.spill_file = None
+        self.spilled = 0
+
+    def unpack(self, data, mode, box):
+        if isinstance(data, tuple):
+            self.spill_file.seek(data[0])
+            data = self.spill_file.read(data[1])
+        return Image.frombytes(mode, (box[2] - box[0], box[3] - box[1]), zlib.decompress(data))
+
+    # Undo / redo
+
+    def undo(self, f):
+        # Returns the box to recomposite, or None when the whole canvas has to be rebuilt
+        if not self.undo_stack:
+            return False, None
+        entry = self.undo_stack.pop()
+        box = self.apply(f, entry, "before")
+        self.redo_stack.append(entry)
+        return True, box
+
+    def redo(self, f):
+        if not self.redo_stack:
+            return False, None
+        entry = self.redo_stack.pop()
+        box = self.apply(f, entry, "after")
+        self.undo_stack.append(entry)
+        return True, box
+
+    def apply(self, f, entry, side):
+        from functions import Layer, Selection
+        slot = 3 if side == "before" else 4
+        meta = entry[side]
+        width, height, bg_color = meta["canvas"]
+        resized = (width, height) != (f.canvas_width, f.canvas_height)
+        f.canvas_width, f.canvas_height, f.bg_color = width, height, bg_color
+        existing = {layer.uid: layer for layer in f.layers}
+        layers = []
+        for data in meta["layers"]:
+            layer = existing.get(data["uid"])
+            if layer is None:
+                layer = Layer(data["name"], width, height, is_adjustment=data["is_adjustment"],
+                              adjustment_type=data["adjustment_type"])
+                layer.uid = data["uid"]
+            for name in LAYER_FIELDS:
+                setattr(layer, name, data[name])
+            layer.adjustment_params = dict(data["adjustment_params"])
+            layers.append(layer)
+        structural = [layer.uid for layer in layers] != [layer.uid for layer in f.layers] or resized
+        if structural:
+            f.layers = layers
+        if resized:
+            f.selection = Selection(width, height)
+        f.current_layer_index = meta["current_layer_index"]
+        f.selection.points = meta["selection"]["points"][:]
+        f.selection.mode = meta["selection"]["mode"]
+
+        targets = {layer.uid: layer for layer in f.layers}
+        touched = set()
+        box = None
+        for tile_data in entry["tiles"]:
+            key, tile_box, mode = tile_data[:3]
+            if tile_data[slot] is None:
+                continue
+            tile = self.unpack(tile_data[slot], mode, tile_box)
+            if key == SELECTION:
+                image = f.selection.mask
+                if image.size != (width, height):
+                    image = f.selection.mask = Image.new("L", (width, height), 0)
+            else:
+                layer = targets[key]
+                image = layer.image
+                if image.size != (width, height):
+                    image = layer.image = Image.new(mode, (width, height), (0, 0, 0, 0))
+                touched.add(key)
+                box = tile_box if box is None else (min(box[0], tile_box[0]), min(box[1], tile_box[1]),
+                                                    max(box[2], tile_box[2]), max(box[3], tile_box[3]))
+            image.paste(tile, tile_box[:2])
+        for key in touched:
+            targets[key].draw = ImageDraw.Draw(targets[key].image)
+            targets[key].update_thumbnail()
+        f.has_selection = bool(f.selection.points or f.selection.mask.getbbox())
+
+        # The restored document is now the recorded state, so resync the shadow copies
+        images = self.images_of(f)
+        for key in [key for key in self.shadow if key not in images]:
+            del self.shadow[key]
+        for key, image in images.items():
+            shadow = self.shadow.get(key)
+            if shadow is None or shadow.size != image.size:
+                self.shadow[key] = image.copy()
+            else:
+                for tile in entry["tiles"]:
+                    if tile[0] == key and tile[slot] is not None:
+                        shadow.paste(image.crop(tile[1]), tile[1][:2])
+        self.sources = dict(images)
+        self.meta = meta
+
+        # Pixel edits of the active layer alone can be recomposited tile by tile
+        active = f.get_current_layer()
+        if structural or entry["before"] != entry["after"] or touched - {active.uid if active else None}:
+            return None
+        return box if box is not None else (0, 0, 0, 0)
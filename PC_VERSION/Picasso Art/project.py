@@ -0,0 +1,215 @@
+import json
+import os
+import struct
+import zlib
+from io import BytesIO
+from PIL import Image
+
+MAGIC = b"PICASSO\x01"
+FOOTER = struct.Struct("<QQ8s")  # manifest offset, manifest length, footer magic
+FOOTER_MAGIC = b"PICINDEX"
+TILE_SIZE = 512
+COMPACT_RATIO = 2  # Rewrite the whole file once it is this many times larger than its live chunks
+SCAN_BLOCK = 1 << 20  # Bytes read at a time while looking for the last complete save
+
+
+class ProjectFile:
+    # Chunked container: a header, zlib-compressed 512px layer tiles and PNG thumbnails, then a JSON
+    # manifest and a fixed-size footer pointing at it. Saving to the same file appends only the tiles
+    # whose contents changed plus a new manifest, so the old chunks stay valid for layers not yet loaded.
+
+    def __init__(self):
+        self.path = None
+        self.layers = {}  # layer uid -> manifest entry of that layer in self.path
+        self.file_size = 0
+        self.live_bytes = 0
+
+    @staticmethod
+    def is_project(path):
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+
+    def load(self, path):
+        with open(path, "rb") as f:
+            f.seek(0, 2)
+            file_size, manifest = self.find_manifest(f, f.tell())
+        if manifest is None:
+            raise ValueError("файл проекта поврежден")
+        # Bytes after the footer are left by an interrupted append and are overwritten by the next save
+        self.path = path
+        self.layers = {}
+        self.file_size = file_size
+        self.live_bytes = manifest.pop("live_bytes", file_size)
+        return manifest
+
+    def find_manifest(self, f, file_size):
+        # The last footer whose manifest parses, searching back from the end of the file
+        hi = file_size
+        while hi > len(MAGIC):
+            lo = max(len(MAGIC), hi - SCAN_BLOCK)
+            f.seek(lo)
+            block = f.read(min(file_size, hi + len(FOOTER_MAGIC) - 1) - lo)
+            found = len(block)
+            while True:
+                found = block.rfind(FOOTER_MAGIC, 0, found)
+                if found < 0:
+                    break
+                end = lo + found + len(FOOTER_MAGIC)
+                manifest = self.read_manifest(f, end)
+                if manifest is not None:
+                    return end, manifest
+            hi = lo
+        return file_size, None
+
+    @staticmethod
+    def read_manifest(f, end):
+        if end < len(MAGIC) + FOOTER.size:
+            return None
+        f.seek(end - FOOTER.size)
+        offset, length, magic = FOOTER.unpack(f.read(FOOTER.size))
+        if magic != FOOTER_MAGIC or offset < len(MAGIC) or offset + length != end - FOOTER.size:
+            return None
+        f.seek(offset)
+        try:
+            manifest = json.loads(f.read(length).decode("utf-8"))
+        except ValueError:
+            return None
+        return manifest if isinstance(manifest, dict) else None
+
+    def bind(self, uid, layer_data):
+        self.layers[uid] = layer_data
+
+    def read_layer(self, uid):
+        entry = self.layers[uid]
+        image = Image.new("RGBA", tuple(entry["size"]), (0, 0, 0, 0))
+        with open(self.path, "rb") as f:
+            for x0, y0, x1, y1, offset, length, crc in entry["tiles"]:
+                f.seek(offset)
+                tile = Image.frombytes("RGBA", (x1 - x0, y1 - y0), zlib.decompress(f.read(length)))
+                image.paste(tile, (x0, y0))
+        return image
+
+    def read_thumbnail(self, uid):
+        chunk = self.layers[uid].get("thumbnail")
+        if not chunk:
+            return None
+        with open(self.path, "rb") as f:
+            f.seek(chunk[0])
+            thumbnail = Image.open(BytesIO(f.read(chunk[1])))
+            thumbnail.load()
+        return thumbnail
+
+    def save(self, path, project, layers):
+        # layers is a list of (Layer, manifest entry without pixel data)
+        same_file = path == self.path and os.path.exists(path)
+        append = same_file and self.file_size <= self.live_bytes * COMPACT_RATIO
+        source = open(self.path, "rb") if self.path and os.path.exists(self.path) and not append else None
+        if append:
+            out = open(path, "r+b")
+            out.seek(self.file_size)
+        else:
+            target = path + ".tmp"
+            out = open(target, "wb")
+            out.write(MAGIC)
+        try:
+            writer = ChunkWriter(out, source, append)
+            entries = []
+            bound = {}
+            for layer, layer_data in layers:
+                entry = dict(layer_data)
+                old = self.layers.get(layer.uid, {})
+                if layer.is_adjustment:
+                    entry["tiles"] = []
+                    entry["thumbnail"] = None
+                elif layer.loader is not None:
+                    # Never decoded since the last load or save, so its chunks can be reused as they are
+                    entry["size"] = old["size"]
+                    entry["tiles"] = [tile[:4] + writer.reuse(tile[4:6]) + tile[6:] for tile in old["tiles"]]
+                    entry["thumbnail"] = writer.reuse(old["thumbnail"]) if old.get("thumbnail") else None
+                else:
+                    entry["size"] = list(layer.image.size)
+                    old_tiles = old.get("tiles", []) if writer.can_reuse() else []
+                    entry["tiles"] = self.write_tiles(writer, layer.image, old_tiles)
+                    entry["thumbnail"] = self.write_thumbnail(writer, layer.thumbnail)
+                entries.append(entry)
+                bound[layer.uid] = entry
+            manifest = dict(project, layers=entries, live_bytes=writer.live_bytes)
+            data = json.dumps(manifest).encode("utf-8")
+            offset = out.tell()
+            out.write(data)
+            # The footer reaches the disk only after everything it points at, so until it does the
+            # previous footer stays the last complete one in the file
+            out.flush()
+            os.fsync(out.fileno())
+            out.write(FOOTER.pack(offset, len(data), FOOTER_MAGIC))
+            out.truncate()
+            file_size = out.tell()
+            out.flush()
+            os.fsync(out.fileno())
+        except Exception:
+            if append:
+                # Dropping the partial chunks brings the previous footer back to the end of the file
+                out.truncate(self.file_size)
+            out.close()
+            if not append:
+                os.remove(target)
+            raise
+        finally:
+            if source is not None:
+                source.close()
+        out.close()
+        if not append:
+            os.replace(target, path)
+        self.path = path
+        self.layers = bound
+        self.file_size = file_size
+        self.live_bytes = writer.live_bytes
+
+    def write_tiles(self, writer, image, old_tiles):
+        old = {tuple(tile[:4]): tile for tile in old_tiles}
+        width, height = image.size
+        tiles = []
+        for y0 in range(0, height, TILE_SIZE):
+            for x0 in range(0, width, TILE_SIZE):
+                box = (x0, y0, min(width, x0 + TILE_SIZE), min(height, y0 + TILE_SIZE))
+                raw = image.crop(box).tobytes()
+                crc = zlib.crc32(raw)
+                previous = old.get(box)
+                if previous is not None and previous[6] == crc:
+                    chunk = writer.reuse(previous[4:6])
+                else:
+                    chunk = writer.write(zlib.compress(raw, 1))
+                tiles.append(list(box) + chunk + [crc])
+        return tiles
+
+    def write_thumbnail(self, writer, thumbnail):
+        if thumbnail is None:
+            return None
+        buffered = BytesIO()
+        thumbnail.save(buffered, format="PNG")
+        return writer.write(buffered.getvalue())
+
+
+class ChunkWriter:
+    def __init__(self, out, source, append):
+        self.out = out
+        self.source = source
+        self.append = append
+        self.live_bytes = len(MAGIC)
+
+    def write(self, data):
+        offset = self.out.tell()
+        self.out.write(data)
+        self.live_bytes += len(data)
+        return [offset, len(data)]
+
+    def can_reuse(self):
+        return self.append or self.source is not None
+
+    def reuse(self, chunk):
+        # Appending keeps the old chunk in place, a fresh file gets a raw copy of the compressed bytes
+        if self.append:
+            self.live_bytes += chunk[1]
+            return list(chunk)
+        self.source.seek(chunk[0])
+        return self.write(self.source.read(chunk[1]))
@@ -0,0 +1,65 @@
+import math
+from PIL import Image
+
+MIN_LEVEL_SIZE = 256  # Stop halving once the smaller side of a level would drop below this
+
+
+class DisplayPyramid:
+    # levels[0] is the composite itself, every next level is half the size of the previous one.
+    # Dirty boxes are pushed down the pyramid so only the touched pixels get downsampled again.
+
+    def __init__(self):
+        self.base = None
+        self.levels = []
+
+    def rebuild(self, image):
+        self.base = image
+        self.levels = [image]
+        while min(self.levels[-1].size) // 2 >= MIN_LEVEL_SIZE:
+            self.levels.append(self.levels[-1].reduce(2))
+
+    def update(self, image, box=None):
+        if box is None or image is not self.base:
+            self.rebuild(image)
+            return
+        x0, y0 = max(0, int(box[0])), max(0, int(box[1]))
+        x1, y1 = min(image.width, math.ceil(box[2])), min(image.height, math.ceil(box[3]))
+        for level in range(1, len(self.levels)):
+            if x1 <= x0 or y1 <= y0:
+                return
+            # Align to even pixels so each 2x2 block is reduced from complete source pixels
+            x0, y0 = x0 & ~1, y0 & ~1
+            source = self.levels[level - 1]
+            x1, y1 = min(source.width, x1 + (x1 & 1)), min(source.height, y1 + (y1 & 1))
+            reduced = source.crop((x0, y0, x1, y1)).reduce(2)
+            x0, y0, x1, y1 = x0 // 2, y0 // 2, (x1 + 1) // 2, (y1 + 1) // 2
+            self.levels[level].paste(reduced, (x0, y0))
+
+    def level_for(self, scale):
+        # The coarsest level that still has at least one source pixel per screen pixel
+        level = 0
+        while level + 1 < len(self.levels) and scale * (2 ** (level + 1)) <= 1:
+            level += 1
+        return level
+
+    def render(self, scale, offset_x, offset_y, view_width, view_height, image=None):
+        # Returns (image, (x, y)) covering only the visible part of the canvas, or (None, origin)
+        # image overrides the pyramid, e.g. for a full-size filter preview
+        if image is None:
+            level = self.level_for(scale)
+            source, factor = self.levels[level], 2 ** level
+            width, height = self.base.size
+        else:
+            source, factor = image, 1
+            width, height = image.size
+        x0 = max(0, math.floor(-offset_x / scale))
+        y0 = max(0, math.floor(-offset_y / scale))
+        x1 = min(width, math.ceil((view_width - offset_x) / scale))
+        y1 = min(height, math.ceil((view_height - offset_y) / scale))
+        origin = (round(offset_x + x0 * scale), round(offset_y + y0 * scale))
+        size = (max(1, round((x1 - x0) * scale)), max(1, round((y1 - y0) * scale)))
+        if x1 <= x0 or y1 <= y0:
+            return None, origin
+        resample = Image.NEAREST if scale >= 2 else Image.BILINEAR
+        box = (x0 / factor, y0 / factor, min(source.width, x1 / factor), min(source.height, y1 / factor))
+        return source.resize(size, resample, box=box), origin
@@ -0,0 +1,111 @@
+import time
+import cv2
+import numpy as np
+
+try:
+    import mss
+except ImportError:
+    mss = None
+
+try:
+    import pyautogui
+except ImportError:
+    pyautogui = None
+
+
+# A screen source fills one reusable BGR buffer per grab. Sources are not shared between threads:
+# the recorder and the preview each open their own.
+class ScreenSource:
+    def __init__(self, region=None):
+        self.region = region  # (left, top, width, height) or None for the whole primary screen
+        self.buffer = None
+
+    def size(self):
+        raise NotImplementedError
+
+    def grab(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def output(self):
+        width, height = self.size()
+        if self.buffer is None or self.buffer.shape[:2] != (height, width):
+            self.buffer = np.empty((height, width, 3), dtype=np.uint8)
+        return self.buffer
+
+
+# mss reads the screen through X11 shared memory (XShm) on Linux, DXGI/GDI on Windows and
+# CoreGraphics on macOS; the BGRA pixels are converted straight into the buffer
+class MSSSource(ScreenSource):
+    def __init__(self, region=None):
+        super().__init__(region)
+        self.sct = mss.mss()
+        if region:
+            left, top, width, height = region
+            self.monitor = {"left": left, "top": top, "width": width, "height": height}
+        else:
+            self.monitor = self.sct.monitors[1]
+
+    def size(self):
+        return self.monitor["width"], self.monitor["height"]
+
+    def grab(self):
+        shot = self.sct.grab(self.monitor)
+        return cv2.cvtColor(np.asarray(shot), cv2.COLOR_BGRA2BGR, dst=self.output())
+
+    def close(self):
+        self.sct.close()
+
+
+# Fallback when mss is not installed: pyautogui returns a PIL image that is converted without an extra copy
+class PyAutoGUISource(ScreenSource):
+    def size(self):
+        if self.region:
+            return self.region[2], self.region[3]
+        return tuple(pyautogui.size())
+
+    def grab(self):
+        screenshot = pyautogui.screenshot(region=self.region)
+        return cv2.cvtColor(np.asarray(screenshot), cv2.COLOR_RGB2BGR, dst=self.output())
+
+
+# Moving test pattern that needs no display, for headless benchmarks of the recording pipeline
+class SyntheticSource(ScreenSource):
+    def __init__(self, region=None, fps=60):
+        super().__init__(region)
+        width, height = self.size()
+        x = np.linspace(0, 255, width, dtype=np.float32)
+        y = np.linspace(0, 255, height, dtype=np.float32)[:, np.newaxis]
+        self.pattern = np.dstack([np.broadcast_to(x, (height, width)), np.broadcast_to(y, (height, width)),
+                                  np.full((height, width), 128, dtype=np.float32)]).astype(np.uint8)
+        self.fps = fps
+        self.started = time.monotonic()
+
+    def size(self):
+        if self.region:
+            return self.region[2], self.region[3]
+        return 1920, 1080
+
+    def grab(self):
+        frame = self.output()
+        frame[:] = self.pattern
+        width = frame.shape[1]
+        bar = max(1, width // 32)
+        x = int((time.monotonic() - self.started) * self.fps * 8) % (width - bar + 1)
+        frame[:, x:x + bar] = 255
+        return frame
+
+
+def open_screen_source(backend="auto", region=None):
+    # "auto" picks mss when it is installed and pyautogui otherwise
+    if backend == "synthetic":
+        return SyntheticSource(region)
+    if backend in ("auto", "mss") and mss is not None:
+        return MSSSource(region)
+    if backend == "mss":
+        raise Exception("Модуль mss не установлен")
+    if pyautogui is None:
+        raise Exception("Нет доступного источника захвата экрана")
+    return PyAutoGUISource(region)
@@ -0,0 +1,283 @@
+import functools
+import threading
+import cv2
+import numpy as np
+
+IDENTITY = np.arange(256, dtype=np.float64)
+IDENTITY_TABLE = np.repeat(IDENTITY.astype(np.uint8)[:, np.newaxis], 3, axis=1)
+NOISE_MARGIN = 64  # Extra rows and pixels in the noise pool, every frame reads it at a random offset
+# OpenCV's HSV to BGR rounds the pixels at the end of a row, past the last full vector, slightly differently;
+# regions for a chain with it start and end on this grid so they match the whole frame
+HSV_ALIGN = 64
+
+# Order of the values in an effect settings tuple, same as the sliders in the GUI
+SETTINGS = ("brightness", "contrast", "blur", "hue", "saturation", "sharpness", "gamma", "temperature", "tint",
+            "vignette", "noise", "sepia", "grayscale", "invert", "edge", "emboss", "posterize", "solarize")
+
+# Colour matrices are 3x4 (matrix | offset) and work on BGR pixels like cv2.transform
+SEPIA = np.array([[0.272, 0.534, 0.131, 0],
+                  [0.349, 0.686, 0.168, 0],
+                  [0.393, 0.769, 0.189, 0]])
+GRAY = np.array([[0.114, 0.587, 0.299, 0]] * 3)
+EMBOSS = np.array([[-2, -1, 0], [-1, 1, 1], [0, 1, 2]], dtype=np.float32)
+
+
+def read_settings(gui):
+    return tuple(float(getattr(gui, name + "_var").get()) for name in SETTINGS)
+
+
+def affine(scale, offset=0.0):
+    matrix = np.zeros((3, 4))
+    matrix[:, :3] = np.diag(np.broadcast_to(scale, 3))
+    matrix[:, 3] = offset
+    return matrix
+
+
+def blend(matrix, amount):
+    # (1 - amount) * pixel + amount * (matrix applied to the pixel)
+    return affine(1 - amount) + amount * matrix
+
+
+def hsv_table(hue, saturation):
+    # Hue shift and saturation scale in one lookup on an HSV frame; 8-bit hue is 0..179
+    table = IDENTITY_TABLE.copy()
+    table[:180, 0] = (np.arange(180) + hue) % 180
+    table[:, 1] = np.clip(IDENTITY * saturation, 0, 255).astype(np.uint8)
+    return table.reshape(1, 256, 3)
+
+
+@functools.lru_cache(maxsize=4)
+def vignette_mask(strength, width, height):
+    # 0..255 per pixel, applied with one saturating multiply
+    x = (np.arange(width, dtype=np.float32) - width / 2) ** 2
+    y = (np.arange(height, dtype=np.float32)[:, np.newaxis] - height / 2) ** 2
+    mask = np.clip(1 - strength * (x + y) / ((width / 2) ** 2 + (height / 2) ** 2), 0, 1)
+    return cv2.cvtColor(np.rint(mask * 255).astype(np.uint8), cv2.COLOR_GRAY2BGR)
+
+
+@functools.lru_cache(maxsize=4)
+def noise_pool(strength, width, height):
+    # Gaussian noise generated once; frames take windows at random offsets instead of drawing new samples.
+    # Kept as separate positive and negative uint8 parts, two saturating passes clamp like one signed add.
+    noise = np.empty((height + NOISE_MARGIN, (width + NOISE_MARGIN) * 3), dtype=np.float32)
+    cv2.randn(noise, 0, strength * 25)
+    noise = np.rint(noise)
+    return np.clip(noise, 0, 255).astype(np.uint8), np.clip(-noise, 0, 255).astype(np.uint8)
+
+
+# The slider values compiled for one frame size. Colour effects are folded into as few passes as possible
+# without changing the result: every effect used to clamp to 0..255 on its own, so a colour matrix only
+# takes the next one in when it cannot leave that range, and per-channel changes (brightness, contrast,
+# temperature, tint, invert) become tables, which chain with the clamp in between. Sepia and emboss blend
+# the frame with their own clamped output and hue with saturation share one HSV round trip, as before.
+# Everything runs in place on the output frame.
+class EffectChain:
+    def __init__(self, settings, width, height):
+        values = dict(zip(SETTINGS, settings))
+        self.size = (width, height)
+        self.stages = []  # (kind, parameter) in the order they run
+
+        if values["contrast"] != 1.0 or values["brightness"] != 0:
+            # cv2.convertScaleAbs: |contrast * x + brightness|, saturated
+            table = np.abs(IDENTITY * values["contrast"] + values["brightness"])
+            self.add_table(np.repeat(np.clip(np.rint(table), 0, 255).astype(np.uint8)[:, np.newaxis], 3, axis=1))
+        if values["blur"] > 0:
+            kernel_size = max(3, int(values["blur"] * 2) | 1)
+            self.stages.append(("blur", (kernel_size, kernel_size)))
+        if values["hue"] != 0 or values["saturation"] != 1.0:
+            self.stages.append(("hsv", hsv_table(int(values["hue"]), values["saturation"])))
+        if values["sharpness"] > 0:
+            kernel = np.full((3, 3), -values["sharpness"], dtype=np.float32)
+            kernel[1, 1] = 1 + 8 * values["sharpness"]
+            self.stages.append(("filter", kernel))
+
+        if values["gamma"] != 1.0:
+            table = np.clip(((IDENTITY / 255.0) ** (1.0 / values["gamma"])) * 255, 0, 255).astype(np.uint8)
+            self.add_table(np.repeat(table[:, np.newaxis], 3, axis=1))
+        temperature = values["temperature"] * 0.5
+        tint = values["tint"] * 0.5
+        if temperature != 0:
+            self.add_matrix(affine(1, [-temperature / 2, 0, temperature]))
+        if tint != 0:
+            self.add_matrix(affine(1, [tint, 0, tint] if tint > 0 else [0, -tint, 0]))
+
+        if values["vignette"] > 0:
+            self.stages.append(("multiply", vignette_mask(values["vignette"], width, height)))
+        if values["noise"] > 0:
+            self.stages.append(("noise", noise_pool(values["noise"], width, height)))
+
+        if values["sepia"] >= 1:
+            self.add_matrix(SEPIA)
+        elif values["sepia"] > 0:
+            # Bright pixels go past 255 in sepia, which is clamped before the blend
+            self.stages.append(("mix", ("matrix", SEPIA, values["sepia"])))
+        if values["grayscale"] > 0:
+            self.add_matrix(blend(GRAY, values["grayscale"]))
+        if values["invert"] > 0:
+            self.add_matrix(affine(1 - 2 * values["invert"], 255 * values["invert"]))
+        if values["edge"] > 0:
+            self.stages.append(("edge", values["edge"]))
+        if values["emboss"] >= 1:
+            self.stages.append(("filter", EMBOSS))
+        elif values["emboss"] > 0:
+            self.stages.append(("mix", ("filter", EMBOSS, values["emboss"])))
+
+        table = IDENTITY
+        if values["posterize"] > 0:
+            step = 256 // (int(8 * (1 - values["posterize"])) + 2)
+            table = table // step * step
+        if values["solarize"] > 0:
+            table = np.where(table < 128 * values["solarize"], table, 255 - table)
+        if values["posterize"] > 0 or values["solarize"] > 0:
+            self.add_table(np.repeat(table.astype(np.uint8)[:, np.newaxis], 3, axis=1))
+
+        self.stages = [self.finish(kind, parameter) for kind, parameter in self.stages]
+        # Pixels around a region that the filters read, see apply_region()
+        self.halo = sum(parameter[0] // 2 if kind == "blur" else 1 for kind, parameter in self.stages
+                        if kind in ("blur", "filter", "edge") or kind == "mix" and parameter[0] == "filter")
+        # Grain changes every frame, so such a chain has to run over the whole frame even on a still screen
+        self.animated = any(kind == "noise" for kind, parameter in self.stages)
+        self.align = HSV_ALIGN if any(kind == "hsv" for kind, parameter in self.stages) else 1
+        self.scratch = threading.local()
+
+    def add_matrix(self, matrix):
+        last = self.stages[-1] if self.stages else (None, None)
+        if last[0] == "matrix" and in_range(last[1]):
+            # matrix after last: A2 (A1 x + b1) + b2, the same as two passes when the first never clamps
+            combined = matrix[:, :3] @ last[1]
+            combined[:, 3] += matrix[:, 3]
+            self.stages[-1] = ("matrix", combined)
+        elif is_diagonal(matrix):
+            self.add_table(diagonal_table(matrix, IDENTITY_TABLE))
+        else:
+            self.stages.append(("matrix", matrix))
+
+    def add_table(self, table):
+        last = self.stages[-1] if self.stages else (None, None)
+        if last[0] == "table":
+            self.stages[-1] = ("table", np.take_along_axis(table, last[1].astype(np.intp), axis=0))
+        elif last[0] == "matrix" and is_diagonal(last[1]):
+            previous = diagonal_table(last[1], IDENTITY_TABLE)
+            self.stages[-1] = ("table", np.take_along_axis(table, previous.astype(np.intp), axis=0))
+        else:
+            self.stages.append(("table", table))
+
+    @staticmethod
+    def finish(kind, parameter):
+        if kind == "matrix":
+            return kind, parameter.astype(np.float32)
+        if kind == "mix" and parameter[0] == "matrix":
+            return kind, ("matrix", parameter[1].astype(np.float32), parameter[2])
+        if kind == "table":
+            # One table for all channels is a cheaper lookup than three
+            if (parameter == parameter[:, :1]).all():
+                return kind, np.ascontiguousarray(parameter[:, 0])
+            return kind, parameter.reshape(1, 256, 3)
+        return kind, parameter
+
+    def buffer(self, name, shape):
+        # Scratch frames per thread, the recorder and the preview may run the same chain at once
+        buffer = getattr(self.scratch, name, None)
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=np.uint8)
+            setattr(self.scratch, name, buffer)
+        return buffer
+
+    def apply(self, frame, dst=None, origin=(0, 0)):
+        # The first pass reads frame and writes dst (a new frame when None), the rest work in place on dst.
+        # origin is where frame sits when it is only a part of the frame size the chain was compiled for.
+        if dst is None:
+            dst = np.empty_like(frame)
+        source = frame
+        for kind, parameter in self.stages:
+            if kind == "matrix":
+                cv2.transform(source, parameter, dst=dst)
+            elif kind == "table":
+                cv2.LUT(source, parameter, dst=dst)
+            elif kind == "blur":
+                cv2.GaussianBlur(source, parameter, 0, dst=dst)
+            elif kind == "filter":
+                cv2.filter2D(source, -1, parameter, dst=dst)
+            elif kind == "multiply":
+                x, y = origin
+                mask = parameter[y:y + dst.shape[0], x:x + dst.shape[1]]
+                cv2.multiply(source, mask, dst=dst, scale=1 / 255)
+            elif kind == "noise":
+                height, width = dst.shape[:2]
+                y = np.random.randint(NOISE_MARGIN)
+                x = np.random.randint(NOISE_MARGIN * 3)
+                rows = dst.reshape(height, -1)
+                cv2.add(source.reshape(height, -1), parameter[0][y:y + height, x:x + width * 3], dst=rows)
+                cv2.subtract(rows, parameter[1][y:y + height, x:x + width * 3], dst=rows)
+            elif kind == "edge":
+                gray = self.buffer("gray", source.shape[:2])
+                laplacian = self.buffer("laplacian", source.shape[:2])
+                edges = self.buffer("edges", source.shape)
+                cv2.cvtColor(source, cv2.COLOR_BGR2GRAY, dst=gray)
+                cv2.Laplacian(gray, cv2.CV_8U, dst=laplacian, ksize=3)
+                cv2.cvtColor(laplacian, cv2.COLOR_GRAY2BGR, dst=edges)
+                cv2.addWeighted(source, 1 - parameter, edges, parameter, 0, dst=dst)
+            elif kind == "hsv":
+                hsv = self.buffer("hsv", source.shape)
+                cv2.cvtColor(source, cv2.COLOR_BGR2HSV, dst=hsv)
+                cv2.LUT(hsv, parameter, dst=hsv)
+                cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR, dst=dst)
+            elif kind == "mix":
+                effect, effect_parameter, amount = parameter
+                mixed = self.buffer("mixed", source.shape)
+                if effect == "matrix":
+                    cv2.transform(source, effect_parameter, dst=mixed)
+                else:
+                    cv2.filter2D(source, -1, effect_parameter, dst=mixed)
+                cv2.addWeighted(source, 1 - amount, mixed, amount, 0, dst=dst)
+            source = dst
+        if source is frame:
+            dst[:] = frame
+        return dst
+
+    def apply_region(self, frame, dst, rect):
+        # Redoes dst where a change of frame inside rect shows: rect grown by the halo, since the filters spread
+        # every pixel that far. The chain runs on twice that margin and only the inside is kept, so filters near
+        # the edge read the same neighbours as on the whole frame.
+        height, width = frame.shape[:2]
+        x0, y0 = max(0, rect[0] - self.halo), max(0, rect[1] - self.halo)
+        x1, y1 = min(width, rect[2] + self.halo), min(height, rect[3] + self.halo)
+        if x0 >= x1 or y0 >= y1:
+            return
+        grown_x0, grown_y0 = max(0, x0 - self.halo), max(0, y0 - self.halo)
+        grown_x1, grown_y1 = min(width, x1 + self.halo), min(height, y1 + self.halo)
+        grown_x0 -= grown_x0 % self.align
+        grown_x1 = min(width, -(-grown_x1 // self.align) * self.align)
+        if (grown_x0, grown_y0, grown_x1, grown_y1) == (0, 0, width, height):
+            self.apply(frame, dst)
+            return
+        result = self.apply(frame[grown_y0:grown_y1, grown_x0:grown_x1], origin=(grown_x0, grown_y0))
+        dst[y0:y1, x0:x1] = result[y0 - grown_y0:y1 - grown_y0, x0 - grown_x0:x1 - grown_x0]
+
+
+def in_range(matrix):
+    # Whether the matrix keeps every pixel of 0..255 inside 0..255 (after rounding), so nothing gets clamped
+    coefficients = matrix[:, :3] * 255
+    low = matrix[:, 3] + np.minimum(coefficients, 0).sum(axis=1)
+    high = matrix[:, 3] + np.maximum(coefficients, 0).sum(axis=1)
+    return low.min() >= -0.5 and high.max() < 255.5
+
+
+def is_diagonal(matrix):
+    return not (matrix[:, :3] - np.diag(np.diag(matrix[:, :3]))).any()
+
+
+def diagonal_table(matrix, table):
+    # Per-channel linear change applied after a (256, 3) table
+    result = table * np.diag(matrix[:, :3]) + matrix[:, 3]
+    return np.clip(np.rint(result), 0, 255).astype(np.uint8)
+
+
+@functools.lru_cache(maxsize=16)
+def compile_effects(settings, width, height):
+    # settings is a tuple from read_settings, equal slider values share one chain per frame size
+    return EffectChain(settings, width, height)
+
+
+def run_effects(gui, frame, dst=None):
+    return compile_effects(read_settings(gui), frame.shape[1], frame.shape[0]).apply(frame, dst)
@@ -0,0 +1,212 @@
+import logging
+import os
+import shutil
+import subprocess
+import threading
+from collections import deque
+import cv2
+import numpy as np
+
+# CPU presets fast enough for live recording; the container and audio codec follow the video codec
+CODECS = {
+    "x264": {"container": "mp4",
+             "video": ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p"],
+             "audio": ["-c:a", "aac", "-b:a", "192k"]},
+    "x265": {"container": "mp4",
+             "video": ["-c:v", "libx265", "-preset", "ultrafast", "-pix_fmt", "yuv420p", "-tag:v", "hvc1",
+                       "-x265-params", "log-level=error"],
+             "audio": ["-c:a", "aac", "-b:a", "192k"]},
+    "vp9": {"container": "webm",
+            "video": ["-c:v", "libvpx-vp9", "-deadline", "realtime", "-cpu-used", "8", "-row-mt", "1",
+                      "-pix_fmt", "yuv420p"],
+            "audio": ["-c:a", "libopus", "-b:a", "128k"]},
+}
+
+# How long the trial encode before recording may take, it normally finishes in a fraction of a second
+CHECK_TIMEOUT = 15
+STDERR_LINES = 20  # Lines of ffmpeg's error output kept for the message shown to the user
+
+
+def output_options(resolution, fps, bitrate, codec, audio, padded):
+    # Everything after the inputs, shared by the recording and the trial encode
+    preset = CODECS[codec]
+    options = ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2"] if padded else []
+    options += preset["video"] + ["-b:v", str(bitrate), "-maxrate", str(bitrate), "-bufsize", str(bitrate * 2),
+                                  "-g", str(int(fps) * 2)]
+    if audio:
+        options += preset["audio"]
+    return options
+
+
+def check_ffmpeg(resolution, fps, bitrate, codec, audio):
+    # ffmpeg only opens the encoder once the first frame arrives, so a missing codec library or a size or
+    # bitrate the encoder rejects would only show up as a broken pipe after recording has started.
+    # A few generated frames with the same options find that beforehand; returns ffmpeg's error or None
+    width, height = resolution
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-t", "0.2",
+               "-f", "lavfi", "-i", f"color=c=black:s={width}x{height}:r={fps}"]
+    if audio:
+        rate, channels = audio
+        command += ["-t", "0.2", "-f", "lavfi", "-i", f"anullsrc=r={rate}:cl={'mono' if channels == 1 else 'stereo'}"]
+    command += output_options(resolution, fps, bitrate, codec, audio, width % 2 or height % 2)
+    command += ["-f", "null", "-"]
+    try:
+        result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                timeout=CHECK_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        return str(e)
+    if result.returncode != 0:
+        # The cause comes first, what follows is ffmpeg shutting down the other streams
+        lines = result.stderr.decode(errors="replace").strip().splitlines()[:STDERR_LINES]
+        return "\n".join(lines) or f"ffmpeg завершился с кодом {result.returncode}"
+    return None
+
+
+# One ffmpeg process that gets raw frames on stdin and 16-bit PCM on a second pipe and writes the
+# final file directly: nothing goes through a temporary file and nothing is left to merge after stop.
+# Frames are converted to I420 here, once per distinct frame: a frame marked as a duplicate resends the
+# last conversion, and the encoder turns it into skipped blocks at almost no cost.
+class FFmpegEncoder:
+    def __init__(self, path, resolution, fps, bitrate, codec="x264", audio=None):
+        self.path = path
+        self.failed = False
+        self.audio_pipe = None
+        self.audio_lock = threading.Lock()
+        width, height = resolution
+        # I420 needs even sizes, odd custom resolutions are sent as BGR and converted by ffmpeg
+        self.yuv = np.empty((height * 3 // 2, width), dtype=np.uint8) if width % 2 == height % 2 == 0 else None
+        self.converted = False
+        command = ["ffmpeg", "-y", "-loglevel", "error",
+                   "-f", "rawvideo", "-pix_fmt", "bgr24" if self.yuv is None else "yuv420p",
+                   "-video_size", f"{width}x{height}",
+                   "-framerate", str(fps), "-thread_queue_size", "64", "-i", "pipe:0"]
+        pass_fds = ()
+        if audio:
+            rate, channels = audio
+            read_fd, write_fd = os.pipe()
+            pass_fds = (read_fd,)
+            # Raw PCM needs no probing; by default ffmpeg would wait for seconds of audio before starting
+            command += ["-f", "s16le", "-ar", str(rate), "-ac", str(channels), "-analyzeduration", "0",
+                        "-probesize", "32", "-thread_queue_size", "1024", "-i", f"pipe:{read_fd}"]
+        # 4:2:0 output needs even sizes too, odd ones get a one-pixel black edge
+        command += output_options(resolution, fps, bitrate, codec, audio, self.yuv is None)
+        command.append(path)
+        try:
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE,
+                                            pass_fds=pass_fds)
+        except OSError:
+            if audio:
+                os.close(write_fd)
+            raise
+        finally:
+            if audio:
+                os.close(read_fd)
+        if audio:
+            self.audio_pipe = os.fdopen(write_fd, "wb")
+        # ffmpeg's errors are logged as they come and the last ones kept for error()
+        self.stderr = deque(maxlen=STDERR_LINES)
+        self.stderr_thread = threading.Thread(target=self.read_stderr, daemon=True)
+        self.stderr_thread.start()
+
+    def read_stderr(self):
+        for line in self.process.stderr:
+            line = line.decode(errors="replace").rstrip()
+            if line:
+                self.stderr.append(line)
+                logging.error(f"ffmpeg: {line}")
+
+    def error(self):
+        # What ffmpeg said before it exited, for the message shown when the recording broke off
+        self.stderr_thread.join(timeout=1)
+        return "\n".join(self.stderr) or f"ffmpeg завершился с кодом {self.process.poll()}"
+
+    def write(self, frame, duplicate=False):
+        # duplicate is a hint that frame is the same as the one written before
+        if self.failed:
+            return
+        try:
+            if self.yuv is None:
+                self.process.stdin.write(frame.data)
+                return
+            if not (duplicate and self.converted):
+                cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420, dst=self.yuv)
+                self.converted = True
+            self.process.stdin.write(self.yuv.data)
+        except (OSError, ValueError) as e:
+            # ffmpeg has exited; its own error is logged by read_stderr
+            self.failed = True
+            logging.error(f"Ошибка кодировщика ffmpeg: {e}")
+
+    def write_audio(self, data):
+        with self.audio_lock:
+            if self.audio_pipe:
+                self.audio_pipe.write(data)
+
+    def close_audio(self):
+        with self.audio_lock:
+            if self.audio_pipe:
+                try:
+                    self.audio_pipe.close()
+                except OSError:
+                    pass
+                self.audio_pipe = None
+
+    def release(self):
+        # Both inputs have to reach end of file before ffmpeg finishes the container;
+        # audio that still arrives afterwards is dropped
+        self.close_audio()
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            logging.error("ffmpeg не завершился, процесс остановлен")
+            self.process.kill()
+            self.process.wait()
+        self.stderr_thread.join(timeout=1)
+
+
+# Fallback when ffmpeg is not available, the same interface around cv2.VideoWriter
+class OpenCVEncoder:
+    def __init__(self, path, resolution, fps):
+        self.path = path
+        self.audio_pipe = None
+        self.failed = False
+        self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'XVID'), fps, resolution)
+        if not self.writer.isOpened():
+            raise Exception("Не удалось инициализировать видео-райтер")
+
+    def write(self, frame, duplicate=False):
+        self.writer.write(frame)
+
+    def release(self):
+        self.writer.release()
+
+
+def open_encoder(base_path, resolution, fps, bitrate, codec="x264", audio=None):
+    # (encoder, output path, error). ffmpeg through pipes when it is installed and accepts the settings,
+    # the OpenCV XVID writer otherwise, with the audio left to the WAV file; error is why ffmpeg was not
+    # used, for the user, or None. audio is (rate, channels) when it should go into the same file
+    error = None
+    if shutil.which("ffmpeg") and codec in CODECS:
+        # The audio pipe is handed over as a file descriptor, which only works on POSIX systems;
+        # elsewhere the audio is recorded to a WAV file and merged when saving
+        if os.name != "posix":
+            audio = None
+        path = f"{base_path}.{CODECS[codec]['container']}"
+        error = check_ffmpeg(resolution, fps, bitrate, codec, audio)
+        if error is None:
+            try:
+                return FFmpegEncoder(path, resolution, fps, bitrate, codec, audio), path, None
+            except OSError as e:
+                error = str(e)
+        logging.error(f"ffmpeg не может записать с этими настройками, используется OpenCV: {error}")
+    path = base_path + ".avi"
+    try:
+        return OpenCVEncoder(path, resolution, fps), path, error
+    except Exception as e:
+        if error is None:
+            raise
+        raise Exception(f"{e}\n\nffmpeg: {error}") from e
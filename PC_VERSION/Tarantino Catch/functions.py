@@ -1,17 +1,37 @@
 import cv2
 import numpy as np
-import pyautogui
 import threading
 import time
 import pyaudio
 import wave
+import queue
 import os
 import logging
 from PIL import Image
 import subprocess  # For ffmpeg merge
+import math
+from pipeline import FrameRing, StageStats, AudioAligner, Mailbox, CLOSED, FULL_FRAME, find_damage, scale_damage, union
+from capture import open_screen_source
+from effects import run_effects, read_settings, compile_effects
+from encoder import open_encoder
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
+RING_SLOTS = 4  # Frames buffered between two recording stages
+AUDIO_RATE = 44100
+AUDIO_CHANNELS = 2
+AUDIO_BLOCK = 1024  # Frames per read from the input stream
+AUDIO_QUEUE_BLOCKS = 256  # Blocks waiting for the writer, about 6 s of audio
+PREVIEW_SIZE = (960, 540)  # Box the preview frame is fitted into
+PREVIEW_MAX_INTERVAL = 1.0  # Slowest preview rate, in seconds per frame, when the recording is under load
+
+
+def fit_preview(resolution):
+    # Preview size for a frame size: fits PREVIEW_SIZE and keeps the aspect ratio
+    scale = min(PREVIEW_SIZE[0] / resolution[0], PREVIEW_SIZE[1] / resolution[1])
+    return int(resolution[0] * scale), int(resolution[1] * scale)
+
+
 class VideoRecorder:
     def __init__(self, gui, resolution, fps, bitrate):
         self.gui = gui
@@ -21,9 +41,25 @@ class VideoRecorder:
         self.recording = False
         self.cap = None
         self.out = None
+        self.output_path = None
+        self.audio_sink = None
+        self.encoder_error = None  # Why ffmpeg could not be used, the recording then goes through OpenCV
         self.lock = threading.Lock()
         self.transition_frame = None
         self.transition_start_time = 0
+        self.camera_frame = None
+        self.threads = []
+        self.start_time = 0
+        self.duplicated = 0
+        self.static = 0  # Captures identical to the one before
+        self.repeated = 0  # Frames handed to the encoder as duplicates
+        self.composited_camera = None
+        self.stage_stats = {name: StageStats(name) for name in ("capture", "effects", "encode")}
+        # Newest composed frame at preview size, see offer_preview()
+        self.preview = Mailbox()
+        self.preview_interval = 1.0 / 15  # Set by the preview to the rate it can show
+        self.next_preview = 0
+        self.seen_dropped = 0
 
     def start(self):
         try:
@@ -33,149 +69,43 @@ class VideoRecorder:
                 if not self.cap.isOpened():
                     raise Exception(f"Не удалось открыть камеру {camera_index}")
 
-            fourcc = cv2.VideoWriter_fourcc(*'XVID')
-            self.out = cv2.VideoWriter('temp_video.avi', fourcc, self.fps, self.resolution)
-            if not self.out.isOpened():
-                raise Exception("Не удалось инициализировать видео-райтер")
-
+            audio = (AUDIO_RATE, AUDIO_CHANNELS) if self.gui.audio_enabled else None
+            self.out, self.output_path, self.encoder_error = open_encoder(
+                'temp_recording', self.resolution, self.fps, self.bitrate, self.gui.codec_var.get(), audio)
+            # Set when the encoder takes the audio into the same file
+            self.audio_sink = self.out if self.out.audio_pipe else None
+
+            # Capture -> effects/composite -> encode, each stage on its own thread with a small ring of
+            # preallocated frames in between, so a slow stage costs frames at one place instead of stalling all
+            shape = (self.resolution[1], self.resolution[0], 3)
+            self.captured = FrameRing(RING_SLOTS, shape)
+            self.processed = FrameRing(RING_SLOTS, shape)
+            # The screen before and after effects, kept by the effects stage and updated only where it changed
+            self.scaled = np.zeros(shape, dtype=np.uint8)
+            self.screen = np.zeros(shape, dtype=np.uint8)
             self.recording = True
-            self.thread = threading.Thread(target=self.record, daemon=True)
-            self.thread.start()
+            self.start_time = time.monotonic()
+            self.threads = [threading.Thread(target=self.capture_loop, daemon=True),
+                            threading.Thread(target=self.effects_loop, daemon=True),
+                            threading.Thread(target=self.encode_loop, daemon=True)]
+            if self.cap:
+                self.threads.append(threading.Thread(target=self.camera_loop, daemon=True))
+            for thread in self.threads:
+                thread.start()
             logging.info("VideoRecorder запущен успешно")
         except Exception as e:
             logging.error(f"Ошибка запуска VideoRecorder: {e}")
             raise
 
-    def apply_effects(self, frame):
+    def apply_effects(self, frame, dst=None):
         try:
-            # Brightness and Contrast
-            frame = cv2.convertScaleAbs(frame, alpha=self.gui.contrast_var.get(), beta=self.gui.brightness_var.get())
-
-            # Blur
-            if self.gui.blur_var.get() > 0:
-                kernel_size = max(3, int(self.gui.blur_var.get() * 2) | 1)
-                frame = cv2.GaussianBlur(frame, (kernel_size, kernel_size), 0)
-
-            # Hue
-            if self.gui.hue_var.get() != 0:
-                hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-                hsv[:, :, 0] = (hsv[:, :, 0] + int(self.gui.hue_var.get())) % 180
-                frame = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
-
-            # Saturation
-            saturation = self.gui.saturation_var.get()
-            if saturation != 1.0:
-                hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-                hsv[:, :, 1] = np.clip(hsv[:, :, 1] * saturation, 0, 255).astype(np.uint8)
-                frame = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
-
-            # Sharpness
-            sharpness = self.gui.sharpness_var.get()
-            if sharpness > 0:
-                kernel = np.array([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]]) * sharpness
-                kernel[1, 1] = 1 + 8 * sharpness
-                frame = cv2.filter2D(frame, -1, kernel)
-
-            # Gamma
-            gamma = self.gui.gamma_var.get()
-            if gamma != 1.0:
-                inv_gamma = 1.0 / gamma
-                table = np.array([((i / 255.0) ** inv_gamma) * 255 for i in np.arange(0, 256)]).astype("uint8")
-                frame = cv2.LUT(frame, table)
-
-            # Color Temperature
-            temperature = self.gui.temperature_var.get()
-            if temperature != 0:
-                temp_val = temperature * 0.5
-                if temperature > 0:
-                    frame[:, :, 2] = np.clip(frame[:, :, 2] + temp_val, 0, 255)
-                    frame[:, :, 0] = np.clip(frame[:, :, 0] - temp_val / 2, 0, 255)
-                else:
-                    frame[:, :, 0] = np.clip(frame[:, :, 0] - temp_val / 2, 0, 255)
-                    frame[:, :, 2] = np.clip(frame[:, :, 2] + temp_val, 0, 255)
-
-            # Tint
-            tint = self.gui.tint_var.get()
-            if tint != 0:
-                tint_val = tint * 0.5
-                if tint > 0:
-                    frame[:, :, 0] = np.clip(frame[:, :, 0] + tint_val, 0, 255)
-                    frame[:, :, 2] = np.clip(frame[:, :, 2] + tint_val, 0, 255)
-                else:
-                    frame[:, :, 1] = np.clip(frame[:, :, 1] - tint_val, 0, 255)
-
-            # Vignette
-            vignette = self.gui.vignette_var.get()
-            if vignette > 0:
-                rows, cols = frame.shape[:2]
-                X, Y = np.meshgrid(np.arange(cols), np.arange(rows))
-                centerX, centerY = cols / 2, rows / 2
-                R = np.sqrt((X - centerX) ** 2 + (Y - centerY) ** 2)
-                maxR = np.sqrt(centerX ** 2 + centerY ** 2)
-                vig = 1 - vignette * (R / maxR) ** 2
-                vig = np.clip(vig, 0, 1)[:, :, np.newaxis]
-                frame = np.clip(frame * vig, 0, 255).astype(np.uint8)
-
-            # Noise
-            noise = self.gui.noise_var.get()
-            if noise > 0:
-                noise_img = np.random.normal(0, noise * 25, frame.shape)
-                frame = np.clip(frame + noise_img, 0, 255).astype(np.uint8)
-
-            # Sepia
-            sepia = self.gui.sepia_var.get()
-            if sepia > 0:
-                sepia_kernel = np.array([
-                    [0.272, 0.534, 0.131],
-                    [0.349, 0.686, 0.168],
-                    [0.393, 0.769, 0.189]
-                ])
-                sepia_frame = cv2.transform(frame, sepia_kernel)
-                frame = cv2.addWeighted(frame, 1 - sepia, sepia_frame, sepia, 0)
-
-            # Grayscale
-            grayscale = self.gui.grayscale_var.get()
-            if grayscale > 0:
-                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                gray = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
-                frame = cv2.addWeighted(frame, 1 - grayscale, gray, grayscale, 0)
-
-            # Invert
-            invert = self.gui.invert_var.get()
-            if invert > 0:
-                inverted = 255 - frame
-                frame = cv2.addWeighted(frame, 1 - invert, inverted, invert, 0)
-
-            # Edge Enhancement
-            edge = self.gui.edge_var.get()
-            if edge > 0:
-                edges = cv2.Laplacian(frame, cv2.CV_8U, ksize=3)
-                edges = cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
-                frame = cv2.addWeighted(frame, 1 - edge, edges, edge, 0)
-
-            # Emboss
-            emboss = self.gui.emboss_var.get()
-            if emboss > 0:
-                kernel = np.array([[-2, -1, 0], [-1, 1, 1], [0, 1, 2]])
-                embossed = cv2.filter2D(frame, -1, kernel)
-                frame = cv2.addWeighted(frame, 1 - emboss, embossed, emboss, 0)
-
-            # Posterize
-            posterize = self.gui.posterize_var.get()
-            if posterize > 0:
-                levels = int(8 * (1 - posterize)) + 2
-                frame = (frame // (256 // levels)) * (256 // levels)
-
-            # Solarize
-            solarize = self.gui.solarize_var.get()
-            if solarize > 0:
-                threshold = 128 * solarize
-                frame = np.where(frame < threshold, frame, 255 - frame)
-
-            return frame
+            return run_effects(self.gui, frame, dst)
         except Exception as e:
             logging.error(f"Ошибка применения эффектов: {e}")
-            return frame
+            if dst is None:
+                return frame
+            dst[:] = frame
+            return dst
 
     def apply_transition(self, old_frame, new_frame):
         if self.gui.transition_type == 'cut' or not old_frame:
@@ -193,61 +123,257 @@ class VideoRecorder:
             return result
         return new_frame
 
-    def record(self):
+    def capture_loop(self):
+        # Ticks on the monotonic clock; a tick with no free slot is dropped here and repeated by the encoder
         frame_time = 1.0 / self.fps
-        while self.recording:
-            start_time = time.time()
-            with self.lock:
-                composite_frame = np.zeros((self.resolution[1], self.resolution[0], 3), dtype=np.uint8)
-                base_frame = None
+        stats = self.stage_stats["capture"]
+        next_time = self.start_time
+        source = None
+        previous = None  # Last grab, each new one is compared against it
+        diff = None
+        try:
+            source = open_screen_source(getattr(self.gui, 'capture_backend', 'auto'),
+                                        getattr(self.gui, 'capture_region', None))
+            while self.recording:
+                wait = next_time - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                timestamp = time.monotonic()
+                next_time += frame_time
+                if next_time < timestamp:
+                    # Capture itself fell behind, skip the ticks that are already over
+                    next_time += math.ceil((timestamp - next_time) / frame_time) * frame_time
+                slot = self.captured.acquire()
+                if slot is None:
+                    stats.drop()
+                    continue
+                frame = self.captured.frames[slot]
+                damage = FULL_FRAME
                 if self.gui.screen_capture_enabled and not self.gui.only_camera_var.get():
                     try:
-                        screenshot = pyautogui.screenshot()
-                        base_frame = cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
-                        base_frame = cv2.resize(base_frame, self.resolution, interpolation=cv2.INTER_AREA)
-                        base_frame = self.apply_effects(base_frame)
-                        composite_frame = base_frame.copy()
+                        grab = source.grab()
+                        changed = None if previous is None or previous.shape != grab.shape else \
+                            find_damage(grab, previous, diff)
+                        if previous is None or previous.shape != grab.shape:
+                            previous = grab.copy()
+                            diff = np.empty_like(grab)
+                            cv2.resize(grab, self.resolution, dst=frame, interpolation=cv2.INTER_AREA)
+                        elif changed is None:
+                            # A still screen is neither resized nor processed again
+                            damage = None
+                            self.static += 1
+                        else:
+                            (gx0, gy0, gx1, gy1), damage = scale_damage(changed, (grab.shape[1], grab.shape[0]),
+                                                                        self.resolution)
+                            x0, y0, x1, y1 = damage
+                            previous[gy0:gy1, gx0:gx1] = grab[gy0:gy1, gx0:gx1]
+                            frame[y0:y1, x0:x1] = cv2.resize(grab[gy0:gy1, gx0:gx1], (x1 - x0, y1 - y0),
+                                                             interpolation=cv2.INTER_AREA)
                     except Exception as e:
                         logging.error(f"Ошибка захвата экрана: {e}")
-                if self.gui.camera_enabled:
-                    try:
-                        ret, camera_frame = self.cap.read()
-                        if ret:
-                            if self.gui.only_camera_var.get():
-                                camera_frame = cv2.resize(camera_frame, self.resolution, interpolation=cv2.INTER_LINEAR)
-                                camera_frame = self.apply_effects(camera_frame)
-                                composite_frame = camera_frame
-                            else:
-                                scale = self.gui.camera_scale
-                                position = self.gui.camera_position
-                                base_size = (160, 120)
-                                scaled_size = (int(base_size[0] * scale), int(base_size[1] * scale))
-                                camera_frame = cv2.resize(camera_frame, scaled_size, interpolation=cv2.INTER_LINEAR)
-                                camera_frame = self.apply_effects(camera_frame)
-                                h, w = camera_frame.shape[:2]
-                                pos_x, pos_y = position
-                                if pos_y + h <= self.resolution[1] and pos_x + w <= self.resolution[0]:
-                                    composite_frame[pos_y:pos_y + h, pos_x:pos_x + w] = camera_frame
-                    except Exception as e:
-                        logging.error(f"Ошибка записи камеры: {e}")
-
-                if base_frame is not None and self.transition_frame is not None and time.time() - self.transition_start_time < self.gui.transition_duration:
-                    composite_frame = self.apply_transition(self.transition_frame, composite_frame)
+                        frame[:] = 0
+                        previous = None
                 else:
-                    self.transition_frame = None
+                    frame[:] = 0
+                    previous = None
+                stats.add(timestamp)
+                self.captured.publish(slot, timestamp, damage)
+        except Exception as e:
+            logging.error(f"Ошибка захвата экрана: {e}")
+        finally:
+            if source:
+                source.close()
+            self.captured.close()
+
+    def camera_loop(self):
+        # The camera delivers at its own rate; compositing always takes the newest frame
+        while self.recording:
+            try:
+                ret, camera_frame = self.cap.read()
+                if ret:
+                    with self.lock:
+                        self.camera_frame = camera_frame
+                else:
+                    time.sleep(0.01)
+            except Exception as e:
+                logging.error(f"Ошибка записи камеры: {e}")
+                time.sleep(0.1)
 
-                self.out.write(composite_frame)
+    def effects_loop(self):
+        # Captured changes are merged into self.scaled as they arrive, even when the frame is then dropped,
+        # and the effect chain only runs over what changed since the last frame it produced
+        stats = self.stage_stats["effects"]
+        frame_time = 1.0 / self.fps
+        pending = None
+        settings = None
+        try:
+            while True:
+                slot = self.captured.take()
+                if slot is None:
+                    continue
+                if slot == CLOSED:
+                    break
+                started = time.monotonic()
+                timestamp = self.captured.timestamps[slot]
+                damage = self.captured.damage[slot]
+                if damage is not None:
+                    x0, y0, x1, y1 = damage
+                    self.scaled[y0:y1, x0:x1] = self.captured.frames[slot][y0:y1, x0:x1]
+                    pending = union(pending, damage)
+                self.captured.release(slot)
+                current = read_settings(self.gui)
+                if current != settings or compile_effects(current, *self.resolution).animated:
+                    settings = current
+                    pending = FULL_FRAME
+                # Waits at most one frame for the encoder, after that the frame is dropped
+                out_slot = self.processed.acquire(timeout=frame_time)
+                if out_slot is None:
+                    stats.drop()
+                    continue
+                changed = self.compose(pending, settings, self.processed.frames[out_slot])
+                pending = None
+                if changed:
+                    self.offer_preview(self.processed.frames[out_slot])
+                stats.add(started)
+                self.processed.publish(out_slot, timestamp, FULL_FRAME if changed else None)
+        finally:
+            self.processed.close()
+
+    def compose(self, damage, settings, composite_frame):
+        # False when the result is the frame composed before, composite_frame is then left unwritten
+        base_frame = None
+        with self.lock:
+            camera_frame = self.camera_frame
+        camera_changed = camera_frame is not self.composited_camera
+        self.composited_camera = camera_frame
+        transition = self.transition_frame is not None and \
+            time.time() - self.transition_start_time < self.gui.transition_duration
+        if self.gui.screen_capture_enabled and not self.gui.only_camera_var.get():
+            if damage is not None:
+                try:
+                    compile_effects(settings, *self.resolution).apply_region(
+                        self.scaled, self.screen, damage)
+                except Exception as e:
+                    logging.error(f"Ошибка применения эффектов: {e}")
+                    x0, y0, x1, y1 = damage
+                    self.screen[y0:y1, x0:x1] = self.scaled[y0:y1, x0:x1]
+            elif not camera_changed and not transition:
+                return False
+            composite_frame[:] = self.screen
+            base_frame = composite_frame
+        else:
+            composite_frame[:] = 0
+        if camera_frame is not None:
+            try:
+                if self.gui.only_camera_var.get():
+                    camera_frame = cv2.resize(camera_frame, self.resolution, interpolation=cv2.INTER_LINEAR)
+                    self.apply_effects(camera_frame, composite_frame)
+                else:
+                    scale = self.gui.camera_scale
+                    position = self.gui.camera_position
+                    base_size = (160, 120)
+                    scaled_size = (int(base_size[0] * scale), int(base_size[1] * scale))
+                    camera_frame = cv2.resize(camera_frame, scaled_size, interpolation=cv2.INTER_LINEAR)
+                    camera_frame = self.apply_effects(camera_frame, camera_frame)
+                    h, w = camera_frame.shape[:2]
+                    pos_x, pos_y = position
+                    if pos_y + h <= self.resolution[1] and pos_x + w <= self.resolution[0]:
+                        composite_frame[pos_y:pos_y + h, pos_x:pos_x + w] = camera_frame
+            except Exception as e:
+                logging.error(f"Ошибка записи камеры: {e}")
 
-            elapsed = time.time() - start_time
-            if elapsed < frame_time:
-                time.sleep(frame_time - elapsed)
+        if base_frame is not None and transition:
+            composite_frame[:] = self.apply_transition(self.transition_frame, composite_frame)
+        else:
+            self.transition_frame = None
+        return True
+
+    def offer_preview(self, frame):
+        # The preview shows the frames being recorded instead of capturing and processing its own. A frame is
+        # only scaled down for it when it has taken the last one, its interval is over and no captured frame
+        # is waiting, so the preview never costs the recording a frame.
+        now = time.monotonic()
+        if now < self.next_preview or not self.preview.empty() or self.captured.depth():
+            return
+        self.next_preview = now + self.preview_interval
+        self.preview.put(cv2.resize(frame, fit_preview(self.resolution), interpolation=cv2.INTER_LINEAR))
+
+    def lagging(self):
+        # True when a stage dropped a frame since the last call or frames are waiting between the stages
+        dropped = self.duplicated + sum(stage.dropped for stage in self.stage_stats.values())
+        lagging = dropped > self.seen_dropped or self.captured.depth() > 0 or self.processed.depth() > 1
+        self.seen_dropped = dropped
+        return lagging
+
+    def encode_loop(self):
+        # Every frame lands at the output index of its capture time: a gap left by dropped frames is filled
+        # by repeating the last frame and a second frame for the same index is dropped, so the file keeps
+        # a constant frame rate and stays in step with the wall clock
+        stats = self.stage_stats["encode"]
+        next_index = 0
+        last_slot = None
+        while True:
+            slot = self.processed.take()
+            if slot is None:
+                continue
+            if slot == CLOSED:
+                break
+            started = time.monotonic()
+            index = round((self.processed.timestamps[slot] - self.start_time) * self.fps)
+            if index < next_index:
+                stats.drop()
+                if self.processed.damage[slot] is None:
+                    self.processed.release(slot)
+                else:
+                    # The picture is not written, but later repeats have to show it
+                    if last_slot is not None:
+                        self.processed.release(last_slot)
+                    last_slot = slot
+                continue
+            while last_slot is not None and next_index < index:
+                self.out.write(self.processed.frames[last_slot], duplicate=True)
+                self.duplicated += 1
+                next_index += 1
+            if self.processed.damage[slot] is None and last_slot is not None:
+                # Unchanged frame: the last one is written again and this slot is not kept
+                self.out.write(self.processed.frames[last_slot], duplicate=True)
+                self.repeated += 1
+                self.processed.release(slot)
+            else:
+                self.out.write(self.processed.frames[slot])
+                if last_slot is not None:
+                    self.processed.release(last_slot)
+                last_slot = slot
+            next_index = index + 1
+            stats.add(started)
+
+    def stats(self):
+        # Per-stage frame counts and latency plus how many frames wait between the stages
+        result = {name: stage.as_dict() for name, stage in self.stage_stats.items()}
+        result["capture_queue"] = self.captured.depth() if self.threads else 0
+        result["encode_queue"] = self.processed.depth() if self.threads else 0
+        result["duplicated"] = self.duplicated
+        result["static"] = self.static
+        result["repeated"] = self.repeated
+        return result
+
+    def encoder_failed(self):
+        # ffmpeg's error when it exited during the recording, None while it runs
+        if self.out and self.out.failed:
+            return self.out.error()
+        return None
 
     def stop(self):
         self.recording = False
+        # The stages drain in order, so every captured frame is written before the file is closed
+        for thread in self.threads:
+            thread.join(timeout=5)
         if self.cap and self.cap.isOpened():
             self.cap.release()
         if self.out:
             self.out.release()
+        if self.threads:
+            logging.info(f"Статистика конвейера записи: {self.stats()}")
         logging.info("VideoRecorder остановлен")
 
 class AudioRecorder:
@@ -258,44 +384,103 @@ class AudioRecorder:
         self.noise_suppression = noise_suppression
         self.gain = gain
         self.compression = compression
-        self.frames = []
         self.audio = pyaudio.PyAudio()
         self.stream = None
         self.system_frames = []
-
-    def start(self):
+        self.wave_file = None
+        self.sink = None
+        self.aligner = None
+        self.threads = []
+        self.origin = 0
+        self.latency = 0.0
+        self.missing = 0
+        self.dropped = 0
+
+    def start(self, origin=None, sink=None):
+        # origin is the monotonic time of the first video frame, the audio is timed against the same clock.
+        # sink is an encoder that takes the audio into the video file, without one it goes to temp_audio.wav
+        self.sink = sink
         try:
-            self.recording = True
-            self.frames = []
-            self.system_frames = []
+            self.origin = time.monotonic() if origin is None else origin
+            self.blocks = queue.Queue(maxsize=AUDIO_QUEUE_BLOCKS)
+            self.missing = 0
+            self.dropped = 0
             self.stream = self.audio.open(
                 format=pyaudio.paInt16,
-                channels=2,
-                rate=44100,
+                channels=AUDIO_CHANNELS,
+                rate=AUDIO_RATE,
                 input=True,
-                frames_per_buffer=1024
+                frames_per_buffer=AUDIO_BLOCK
             )
             self.system_stream = self.stream  # Placeholder for system audio
-            self.thread = threading.Thread(target=self.record, daemon=True)
-            self.thread.start()
+            self.latency = self.stream.get_input_latency()
+            if sink is not None:
+                # A track left from an earlier recording must not be merged into this one
+                if os.path.exists('temp_audio.wav'):
+                    os.remove('temp_audio.wav')
+            else:
+                self.wave_file = wave.open('temp_audio.wav', 'wb')
+                self.wave_file.setnchannels(AUDIO_CHANNELS)
+                self.wave_file.setsampwidth(self.audio.get_sample_size(pyaudio.paInt16))
+                self.wave_file.setframerate(AUDIO_RATE)
+            self.recording = True
+            self.threads = [threading.Thread(target=self.record, daemon=True),
+                            threading.Thread(target=self.write_loop, daemon=True)]
+            for thread in self.threads:
+                thread.start()
             logging.info("AudioRecorder запущен успешно")
         except Exception as e:
             logging.error(f"Ошибка запуска AudioRecorder: {e}")
+            # The encoder would otherwise wait for audio that never comes
+            if sink:
+                sink.close_audio()
             raise
 
     def record(self):
+        # Only reads and stamps blocks, processing and the disk are on the writer thread. A block that finds
+        # the queue full is counted and written as silence, so the file keeps its length.
         while self.recording:
             try:
-                data = self.stream.read(1024, exception_on_overflow=False)
-                if self.noise_suppression:
-                    data = self.apply_noise_suppression(data)
-                data = np.frombuffer(data, dtype=np.int16).astype(np.float32)
-                gain_factor = 10 ** (self.gain / 20.0)
-                data *= gain_factor
-                data = np.clip(data / self.compression, -1.0, 1.0) * self.compression
-                data = data * self.mic_volume * self.system_volume
-                data = np.clip(data, -32768, 32767).astype(np.int16)
-                self.frames.append(data.tobytes())
+                data = self.stream.read(AUDIO_BLOCK, exception_on_overflow=False)
+                # The last sample of the block reached the input one latency before read() returned
+                timestamp = time.monotonic() - self.latency
+                try:
+                    self.blocks.put_nowait((timestamp, data, self.missing))
+                    self.missing = 0
+                except queue.Full:
+                    self.missing += len(data)
+                    self.dropped += 1
+            except Exception as e:
+                logging.error(f"Ошибка записи аудио: {e}")
+        self.blocks.put(None)
+
+    def process(self, data):
+        if self.noise_suppression:
+            data = self.apply_noise_suppression(data)
+        data = np.frombuffer(data, dtype=np.int16).astype(np.float32)
+        gain_factor = 10 ** (self.gain / 20.0)
+        data *= gain_factor
+        # The limiter works on full scale, not on raw int16 values
+        data = np.clip(data / (32768.0 * self.compression), -1.0, 1.0) * (32768.0 * self.compression)
+        data = data * self.mic_volume * self.system_volume
+        return np.clip(data, -32768, 32767).astype(np.int16).tobytes()
+
+    def write_loop(self):
+        # Blocks go out as they come, lined up with the video frames on the shared monotonic clock,
+        # so memory stays the same however long the recording is
+        self.aligner = AudioAligner(AUDIO_RATE, AUDIO_CHANNELS)
+        write = self.sink.write_audio if self.sink else self.wave_file.writeframes
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                break
+            timestamp, data, missing = block
+            try:
+                data = self.process(data)
+                if missing:
+                    data = bytes(missing) + data
+                samples = np.frombuffer(data, dtype=np.int16).reshape(-1, AUDIO_CHANNELS)
+                write(self.aligner.align(samples, timestamp - self.origin).tobytes())
             except Exception as e:
                 logging.error(f"Ошибка записи аудио: {e}")
 
@@ -306,21 +491,35 @@ class AudioRecorder:
 
     def stop(self):
         self.recording = False
+        for thread in self.threads:
+            thread.join(timeout=5)
         if self.stream:
             self.stream.stop_stream()
             self.stream.close()
-        try:
-            wf = wave.open('temp_audio.wav', 'wb')
-            wf.setnchannels(2)
-            wf.setsampwidth(self.audio.get_sample_size(pyaudio.paInt16))
-            wf.setframerate(44100)
-            wf.writeframes(b''.join(self.frames))
-            wf.close()
-            logging.info("Аудио сохранено успешно")
-        except Exception as e:
-            logging.error(f"Ошибка сохранения аудио: {e}")
+        if self.sink:
+            self.sink.close_audio()
+        if self.wave_file:
+            try:
+                self.wave_file.close()
+                logging.info("Аудио сохранено успешно")
+            except Exception as e:
+                logging.error(f"Ошибка сохранения аудио: {e}")
+        if self.aligner:
+            logging.info(f"Синхронизация аудио: растянуто {self.aligner.stretched} сэмплов, "
+                         f"пересинхронизаций {self.aligner.resyncs}, потеряно блоков {self.dropped}")
         self.audio.terminate()
 
+def merge_recording(video_path, audio_path, output_path):
+    # Muxes the fallback recording with its WAV track, or only changes the container when audio_path is None;
+    # the streams are already in sync and the video is copied as it is
+    command = ['ffmpeg', '-y', '-i', video_path]
+    if audio_path:
+        command += ['-i', audio_path, '-c:v', 'copy', '-c:a', 'aac']
+    else:
+        command += ['-c', 'copy']
+    command.append(output_path)
+    subprocess.run(command, check=True)
+
 class PreviewUpdater:
     def __init__(self, gui):
         self.gui = gui
@@ -331,9 +530,17 @@ class PreviewUpdater:
         self.screenshot_cache_duration = 0.5
         self.lock = threading.Lock()
         self.cap = None
+        self.screen = None  # Opened on the preview thread, screen sources are not shared between threads
         self.transition_frame = None
         self.transition_start_time = 0
-        self.preview_resolution = (960, 540)  # Default to higher resolution for better quality
+        self.preview_resolution = PREVIEW_SIZE
+        self.screen_frame = None  # The cached screenshot at preview size with effects applied
+        self.screen_key = None
+        # Only the newest frame waits for Tk: frames the UI had no time to draw are replaced, never queued
+        self.latest = Mailbox()
+        self.interval = 1.0 / self.preview_fps  # Adapted to what the UI and the recording can afford
+        self.build_time = 0.0
+        self.draw_time = 0.0
 
     def start(self):
         self.update_preview_resolution()
@@ -353,127 +560,20 @@ class PreviewUpdater:
 
     def update_preview_resolution(self):
         res_str = self.gui.resolution_var.get()
-        full_w, full_h = map(int, res_str.split('x'))
-        # Scale to fit within 960x540 while preserving aspect ratio
-        scale = min(960 / full_w, 540 / full_h)
-        self.preview_resolution = (int(full_w * scale), int(full_h * scale))
+        self.preview_resolution = fit_preview(tuple(map(int, res_str.split('x'))))
 
     def restart_preview(self):
         self.update_preview_resolution()
 
-    def apply_effects(self, frame):
+    def apply_effects(self, frame, dst=None):
         try:
-            frame = cv2.convertScaleAbs(frame, alpha=self.gui.contrast_var.get(), beta=self.gui.brightness_var.get())
-
-            if self.gui.blur_var.get() > 0:
-                kernel_size = max(3, int(self.gui.blur_var.get() * 2) | 1)
-                frame = cv2.GaussianBlur(frame, (kernel_size, kernel_size), 0)
-
-            if self.gui.hue_var.get() != 0:
-                hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-                hsv[:, :, 0] = (hsv[:, :, 0] + int(self.gui.hue_var.get())) % 180
-                frame = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
-
-            saturation = self.gui.saturation_var.get()
-            if saturation != 1.0:
-                hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-                hsv[:, :, 1] = np.clip(hsv[:, :, 1] * saturation, 0, 255).astype(np.uint8)
-                frame = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
-
-            sharpness = self.gui.sharpness_var.get()
-            if sharpness > 0:
-                kernel = np.array([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]]) * sharpness
-                kernel[1, 1] = 1 + 8 * sharpness
-                frame = cv2.filter2D(frame, -1, kernel)
-
-            gamma = self.gui.gamma_var.get()
-            if gamma != 1.0:
-                inv_gamma = 1.0 / gamma
-                table = np.array([((i / 255.0) ** inv_gamma) * 255 for i in np.arange(0, 256)]).astype("uint8")
-                frame = cv2.LUT(frame, table)
-
-            temperature = self.gui.temperature_var.get()
-            if temperature != 0:
-                temp_val = temperature * 0.5
-                if temperature > 0:
-                    frame[:, :, 2] = np.clip(frame[:, :, 2] + temp_val, 0, 255)
-                    frame[:, :, 0] = np.clip(frame[:, :, 0] - temp_val / 2, 0, 255)
-                else:
-                    frame[:, :, 0] = np.clip(frame[:, :, 0] - temp_val / 2, 0, 255)
-                    frame[:, :, 2] = np.clip(frame[:, :, 2] + temp_val, 0, 255)
-
-            tint = self.gui.tint_var.get()
-            if tint != 0:
-                tint_val = tint * 0.5
-                if tint > 0:
-                    frame[:, :, 0] = np.clip(frame[:, :, 0] + tint_val, 0, 255)
-                    frame[:, :, 2] = np.clip(frame[:, :, 2] + tint_val, 0, 255)
-                else:
-                    frame[:, :, 1] = np.clip(frame[:, :, 1] - tint_val, 0, 255)
-
-            vignette = self.gui.vignette_var.get()
-            if vignette > 0:
-                rows, cols = frame.shape[:2]
-                X, Y = np.meshgrid(np.arange(cols), np.arange(rows))
-                centerX, centerY = cols / 2, rows / 2
-                R = np.sqrt((X - centerX) ** 2 + (Y - centerY) ** 2)
-                maxR = np.sqrt(centerX ** 2 + centerY ** 2)
-                vig = 1 - vignette * (R / maxR) ** 2
-                vig = np.clip(vig, 0, 1)[:, :, np.newaxis]
-                frame = np.clip(frame * vig, 0, 255).astype(np.uint8)
-
-            noise = self.gui.noise_var.get()
-            if noise > 0:
-                noise_img = np.random.normal(0, noise * 25, frame.shape)
-                frame = np.clip(frame + noise_img, 0, 255).astype(np.uint8)
-
-            sepia = self.gui.sepia_var.get()
-            if sepia > 0:
-                sepia_kernel = np.array([
-                    [0.272, 0.534, 0.131],
-                    [0.349, 0.686, 0.168],
-                    [0.393, 0.769, 0.189]
-                ])
-                sepia_frame = cv2.transform(frame, sepia_kernel)
-                frame = cv2.addWeighted(frame, 1 - sepia, sepia_frame, sepia, 0)
-
-            grayscale = self.gui.grayscale_var.get()
-            if grayscale > 0:
-                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                gray = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
-                frame = cv2.addWeighted(frame, 1 - grayscale, gray, grayscale, 0)
-
-            invert = self.gui.invert_var.get()
-            if invert > 0:
-                inverted = 255 - frame
-                frame = cv2.addWeighted(frame, 1 - invert, inverted, invert, 0)
-
-            edge = self.gui.edge_var.get()
-            if edge > 0:
-                edges = cv2.Laplacian(frame, cv2.CV_8U, ksize=3)
-                edges = cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
-                frame = cv2.addWeighted(frame, 1 - edge, edges, edge, 0)
-
-            emboss = self.gui.emboss_var.get()
-            if emboss > 0:
-                kernel = np.array([[-2, -1, 0], [-1, 1, 1], [0, 1, 2]])
-                embossed = cv2.filter2D(frame, -1, kernel)
-                frame = cv2.addWeighted(frame, 1 - emboss, embossed, emboss, 0)
-
-            posterize = self.gui.posterize_var.get()
-            if posterize > 0:
-                levels = int(8 * (1 - posterize)) + 2
-                frame = (frame // (256 // levels)) * (256 // levels)
-
-            solarize = self.gui.solarize_var.get()
-            if solarize > 0:
-                threshold = 128 * solarize
-                frame = np.where(frame < threshold, frame, 255 - frame)
-
-            return frame
+            return run_effects(self.gui, frame, dst)
         except Exception as e:
             logging.error(f"Ошибка применения эффектов: {e}")
-            return frame
+            if dst is None:
+                return frame
+            dst[:] = frame
+            return dst
 
     def apply_transition(self, old_frame, new_frame):
         if not old_frame:
@@ -508,22 +608,24 @@ class PreviewUpdater:
                 current_time = time.time()
                 if (self.last_screenshot is None or
                         current_time - self.last_screenshot_time > self.screenshot_cache_duration):
-                    screenshot = pyautogui.screenshot()
-                    if screenshot is None:
-                        logging.error("Не удалось захватить скриншот")
-                        return preview_frame
-                    frame = cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
+                    if self.screen is None:
+                        self.screen = open_screen_source(getattr(self.gui, 'capture_backend', 'auto'),
+                                                         getattr(self.gui, 'capture_region', None))
+                    frame = self.screen.grab()
                     self.last_screenshot = frame
                     self.last_screenshot_time = current_time
                 else:
                     frame = self.last_screenshot
                 if frame.size == 0:
                     return preview_frame
-                # Resize to preview resolution with high-quality interpolation
-                frame = cv2.resize(frame, preview_res, interpolation=cv2.INTER_LANCZOS4)
-                frame = self.apply_effects(frame)
-                preview_frame = frame.copy()
-                base_frame = preview_frame.copy()
+                # The screenshot is scaled and processed again only when it or the effect settings changed
+                key = (self.last_screenshot_time, preview_res, read_settings(self.gui))
+                if key != self.screen_key:
+                    self.screen_frame = self.apply_effects(
+                        cv2.resize(frame, preview_res, interpolation=cv2.INTER_AREA))
+                    self.screen_key = key
+                preview_frame[:] = self.screen_frame
+                base_frame = preview_frame
             except Exception as e:
                 logging.error(f"Ошибка предпросмотра экрана: {e}")
         if self.gui.camera_enabled and self.cap and self.cap.isOpened():
@@ -531,16 +633,16 @@ class PreviewUpdater:
                 ret, frame = self.cap.read()
                 if ret:
                     if self.gui.only_camera_var.get():
-                        frame = cv2.resize(frame, preview_res, interpolation=cv2.INTER_LANCZOS4)
-                        frame = self.apply_effects(frame)
+                        frame = cv2.resize(frame, preview_res, interpolation=cv2.INTER_LINEAR)
+                        frame = self.apply_effects(frame, frame)
                         preview_frame = frame
                     else:
                         scale = self.gui.camera_scale
                         position = self.gui.camera_position
                         base_size = (160, 120)
                         scaled_size = (int(base_size[0] * scale), int(base_size[1] * scale))
-                        frame = cv2.resize(frame, scaled_size, interpolation=cv2.INTER_LANCZOS4)
-                        frame = self.apply_effects(frame)
+                        frame = cv2.resize(frame, scaled_size, interpolation=cv2.INTER_LINEAR)
+                        frame = self.apply_effects(frame, frame)
                         h, w = frame.shape[:2]
                         pos_x, pos_y = position
                         if pos_y + h <= preview_res[1] and pos_x + w <= preview_res[0]:
@@ -573,16 +675,53 @@ class PreviewUpdater:
         while self.active:
             try:
                 current_fps = int(self.gui.preview_fps_var.get()) if hasattr(self.gui, 'preview_fps_var') else 30
-                sleep_time = 1.0 / max(1, current_fps)
-                with self.lock:
-                    preview_frame = self.create_preview_frame()
+                target = 1.0 / max(1, current_fps)
+                recorder = self.gui.video_recorder if self.gui.recording else None
+                if recorder is not None and recorder.recording:
+                    # While recording the frames come from the recording pipeline, which scales one down
+                    # for the preview only when it has time to spare; a recording that falls behind
+                    # halves the preview rate each time
+                    if recorder.lagging():
+                        self.interval = min(PREVIEW_MAX_INTERVAL, self.interval * 2)
+                    else:
+                        self.adapt(target, self.draw_time)
+                    recorder.preview_interval = self.interval
+                    preview_frame = recorder.preview.take(timeout=self.interval)
+                    if preview_frame is not None:
+                        self.post(preview_frame)
+                    continue
+                started = time.monotonic()
+                # A frame the UI has not drawn yet means it is busy, building another would be wasted
+                if self.latest.empty():
+                    with self.lock:
+                        preview_frame = self.create_preview_frame()
                     if preview_frame is not None:
-                        self.gui.root.after(0, self.gui.update_preview_gui, preview_frame)
-                time.sleep(sleep_time)
+                        self.post(preview_frame)
+                    self.build_time = self.build_time * 0.9 + (time.monotonic() - started) * 0.1
+                self.adapt(target, self.build_time + self.draw_time)
+                time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
             except Exception as e:
                 logging.error(f"Ошибка обновления предпросмотра: {e}")
                 time.sleep(0.5)
 
+    def adapt(self, target, cost):
+        # Recovers gradually towards the preview FPS setting, but keeps the preview at no more than
+        # about half of one core
+        self.interval = max(target, cost * 2, self.interval * 0.8)
+
+    def post(self, frame):
+        if self.latest.put(frame):
+            self.gui.root.after(0, self.show_latest)
+
+    def show_latest(self):
+        # Runs on the Tk thread
+        frame = self.latest.take()
+        if frame is None:
+            return
+        started = time.monotonic()
+        self.gui.update_preview_gui(frame)
+        self.draw_time = self.draw_time * 0.9 + (time.monotonic() - started) * 0.1
+
     def stop(self):
         self.active = False
         if self.cap and self.cap.isOpened():
@@ -4,11 +4,11 @@ import cv2
 import numpy as np
 from PIL import Image, ImageTk
 import os
+import shutil
 import threading
 import time
 import json
-from functions import VideoRecorder, AudioRecorder, PreviewUpdater
-import subprocess  # For merging in save_video
+from functions import VideoRecorder, AudioRecorder, PreviewUpdater, merge_recording
 
 class TarantinoCatch:
     def __init__(self, root):
@@ -57,12 +57,15 @@ class TarantinoCatch:
         self.last_screenshot = None
         self.last_screenshot_time = 0
         self.screenshot_cache_duration = 0.5
+        self.capture_backend = 'auto'  # 'mss', 'pyautogui' or 'synthetic' for tests without a display
+        self.capture_region = None  # (left, top, width, height), None records the whole screen
         self.transition_type = 'cut'
         self.transition_duration = 1.0
         self.audio_filters = {'noise_suppression': False}
         self.output_profile = {'resolution': '1920x1080', 'fps': 30, 'bitrate': 15}
         self.save_dir_var = tk.StringVar(value=os.path.expanduser("~"))
         self.file_format_var = tk.StringVar(value="mp4")
+        self.codec_var = tk.StringVar(value="x264")
         self.camera_index_var = tk.StringVar(value="0")
         self.preview_fps_var = tk.StringVar(value="30")
         self.mic_volume_var = tk.DoubleVar(value=1.0)
@@ -94,6 +97,7 @@ class TarantinoCatch:
         # Recorder objects
         self.video_recorder = None
         self.audio_recorder = None
+        self.recorded_file = 'temp_video.avi'
         self.preview_updater = None
 
         self.setup_styles()
@@ -258,17 +262,21 @@ class TarantinoCatch:
         self.bitrate_var = tk.StringVar(value="15")
         ttk.Entry(settings_frame, textvariable=self.bitrate_var, width=10).grid(row=13, column=0, sticky="we", pady=(0, 15))
 
+        ttk.Label(settings_frame, text="Кодек:", style="TLabel").grid(row=14, column=0, sticky="w", pady=(0, 8))
+        ttk.Combobox(settings_frame, textvariable=self.codec_var, values=["x264", "x265", "vp9"],
+                     width=20, state="readonly").grid(row=15, column=0, sticky="we", pady=(0, 15))
+
         # Audio settings
-        ttk.Label(settings_frame, text="Настройки аудио:", style="TLabel").grid(row=14, column=0, sticky="w", pady=(15, 8))
-        ttk.Label(settings_frame, text="Громкость микрофона:", style="TLabel").grid(row=15, column=0, sticky="w", pady=(0, 5))
-        ttk.Scale(settings_frame, from_=0.0, to=2.0, variable=self.mic_volume_var, orient=tk.HORIZONTAL, length=150).grid(row=16, column=0, sticky="we", pady=(0, 10))
-        ttk.Label(settings_frame, text="Громкость системы:", style="TLabel").grid(row=17, column=0, sticky="w", pady=(0, 5))
-        ttk.Scale(settings_frame, from_=0.0, to=2.0, variable=self.system_volume_var, orient=tk.HORIZONTAL, length=150).grid(row=18, column=0, sticky="we", pady=(0, 10))
-        ttk.Label(settings_frame, text="Усиление (dB):", style="TLabel").grid(row=19, column=0, sticky="w", pady=(0, 5))
-        ttk.Scale(settings_frame, from_=-20.0, to=20.0, variable=self.audio_gain_var, orient=tk.HORIZONTAL, length=150).grid(row=20, column=0, sticky="we", pady=(0, 10))
-        ttk.Label(settings_frame, text="Компрессия:", style="TLabel").grid(row=21, column=0, sticky="w", pady=(0, 5))
-        ttk.Scale(settings_frame, from_=0.1, to=10.0, variable=self.audio_compression_var, orient=tk.HORIZONTAL, length=150).grid(row=22, column=0, sticky="we", pady=(0, 15))
-        ttk.Checkbutton(settings_frame, text="Подавление шума", variable=self.noise_suppression_var, command=self.toggle_noise_suppression).grid(row=23, column=0, sticky="w", pady=(0, 15))
+        ttk.Label(settings_frame, text="Настройки аудио:", style="TLabel").grid(row=16, column=0, sticky="w", pady=(15, 8))
+        ttk.Label(settings_frame, text="Громкость микрофона:", style="TLabel").grid(row=17, column=0, sticky="w", pady=(0, 5))
+        ttk.Scale(settings_frame, from_=0.0, to=2.0, variable=self.mic_volume_var, orient=tk.HORIZONTAL, length=150).grid(row=18, column=0, sticky="we", pady=(0, 10))
+        ttk.Label(settings_frame, text="Громкость системы:", style="TLabel").grid(row=19, column=0, sticky="w", pady=(0, 5))
+        ttk.Scale(settings_frame, from_=0.0, to=2.0, variable=self.system_volume_var, orient=tk.HORIZONTAL, length=150).grid(row=20, column=0, sticky="we", pady=(0, 10))
+        ttk.Label(settings_frame, text="Усиление (dB):", style="TLabel").grid(row=21, column=0, sticky="w", pady=(0, 5))
+        ttk.Scale(settings_frame, from_=-20.0, to=20.0, variable=self.audio_gain_var, orient=tk.HORIZONTAL, length=150).grid(row=22, column=0, sticky="we", pady=(0, 10))
+        ttk.Label(settings_frame, text="Компрессия:", style="TLabel").grid(row=23, column=0, sticky="w", pady=(0, 5))
+        ttk.Scale(settings_frame, from_=0.1, to=10.0, variable=self.audio_compression_var, orient=tk.HORIZONTAL, length=150).grid(row=24, column=0, sticky="we", pady=(0, 15))
+        ttk.Checkbutton(settings_frame, text="Подавление шума", variable=self.noise_suppression_var, command=self.toggle_noise_suppression).grid(row=25, column=0, sticky="w", pady=(0, 15))
 
         settings_frame.columnconfigure(0, weight=1)
 
@@ -464,12 +472,15 @@ class TarantinoCatch:
             print(f"Ошибка обновления предпросмотра: {e}")
 
     def update_single_canvas(self, canvas, frame):
-        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        img = Image.fromarray(frame_rgb)
+        # The canvas on the tab that is not shown is skipped, it is drawn again with the next frame
+        if not canvas.winfo_ismapped():
+            return
         canvas_width = canvas.winfo_width()
         canvas_height = canvas.winfo_height()
         if canvas_width <= 1 or canvas_height <= 1:
             return
+        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        img = Image.fromarray(frame_rgb)
         # Calculate scaling to fit image in canvas while preserving aspect ratio
         img_ratio = img.width / img.height
         canvas_ratio = canvas_width / canvas_height
@@ -479,8 +490,9 @@ class TarantinoCatch:
         else:
             new_height = canvas_height
             new_width = int(canvas_height * img_ratio)
-        # Resize image with high-quality interpolation
-        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        # Bilinear is plenty for a preview and the resize runs on the Tk thread
+        if (new_width, new_height) != img.size:
+            img = img.resize((new_width, new_height), Image.Resampling.BILINEAR)
         photo = ImageTk.PhotoImage(img)
         canvas.delete("preview")
         canvas.create_image(canvas_width // 2, canvas_height // 2,
@@ -524,13 +536,17 @@ class TarantinoCatch:
                 )
             self.video_recorder.start()
             if self.audio_enabled:
-                self.audio_recorder.start()
+                # Audio is timed from the first video frame and goes into the same file when the encoder takes it
+                self.audio_recorder.start(self.video_recorder.start_time, self.video_recorder.audio_sink)
             self.recording = True
             self.start_time = time.time()
             self.total_pause_time = 0
             self.update_timer()
             self.status_var.set("Запись...")
             self.recording_indicator.itemconfig(self.recording_circle, fill="#ef4444")
+            if self.video_recorder.encoder_error:
+                messagebox.showwarning("Предупреждение", "ffmpeg не может записать с выбранными настройками, "
+                                       f"запись идёт через OpenCV в AVI:\n\n{self.video_recorder.encoder_error}")
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось начать запись: {str(e)}")
 
@@ -555,8 +571,10 @@ class TarantinoCatch:
     def stop_recording(self):
         self.recording = False
         self.paused = False
+        # Video first: its encoder closes the audio input as well, so the audio covers every frame
         if self.video_recorder:
             self.video_recorder.stop()
+            self.recorded_file = self.video_recorder.output_path
             self.video_recorder = None
         if self.audio_recorder:
             self.audio_recorder.stop()
@@ -566,6 +584,12 @@ class TarantinoCatch:
         self.time_var.set("00:00:00")
 
     def update_timer(self):
+        if self.recording and self.video_recorder:
+            error = self.video_recorder.encoder_failed()
+            if error:
+                self.stop_recording()
+                messagebox.showerror("Ошибка", f"Кодировщик ffmpeg остановился, запись прервана:\n\n{error}")
+                return
         if self.recording and not self.paused:
             elapsed = time.time() - self.start_time - self.total_pause_time
             hours = int(elapsed // 3600)
@@ -575,23 +599,39 @@ class TarantinoCatch:
             self.root.after(1000, self.update_timer)
 
     def save_video(self):
-        if not os.path.exists('temp_video.avi'):
+        recorded = self.recorded_file
+        if not recorded or not os.path.exists(recorded):
             messagebox.showwarning("Предупреждение", "Нет записанного видео для сохранения")
             return
+        # Only the OpenCV fallback leaves a separate audio track, the ffmpeg recording is already complete.
+        # That fallback also runs when ffmpeg is missing, then the recording can only be saved as it is
+        have_ffmpeg = shutil.which('ffmpeg') is not None
+        separate_audio = self.audio_enabled and os.path.exists('temp_audio.wav')
+        merge = separate_audio and have_ffmpeg
+        recorded_extension = os.path.splitext(recorded)[1]
+        extension = f".{self.file_format_var.get()}" if merge else recorded_extension
         file_path = filedialog.asksaveasfilename(
             initialdir=self.save_dir_var.get(),
-            defaultextension=f".{self.file_format_var.get()}",
-            filetypes=[("Видео файлы", "*.mp4 *.avi *.mov"), ("Все файлы", "*.*")]
+            defaultextension=extension,
+            filetypes=[("Видео файлы", "*.mp4 *.avi *.mov *.mkv *.webm"), ("Все файлы", "*.*")]
         )
         if file_path:
+            if not have_ffmpeg:
+                file_path = os.path.splitext(file_path)[0] + recorded_extension
             try:
-                if self.audio_enabled and os.path.exists('temp_audio.wav'):
-                    subprocess.run(['ffmpeg', '-y', '-i', 'temp_video.avi', '-i', 'temp_audio.wav', '-c:v', 'copy', '-c:a', 'aac', '-shortest', file_path], check=True)
+                if merge:
+                    merge_recording(recorded, 'temp_audio.wav', file_path)
                     os.remove('temp_audio.wav')
+                    os.remove(recorded)
+                elif os.path.splitext(file_path)[1].lower() == recorded_extension.lower():
+                    # A rename on the same disk, the recording is not copied again
+                    shutil.move(recorded, file_path)
+                    if separate_audio:
+                        # Without ffmpeg the sound cannot be muxed in, it is kept next to the video
+                        shutil.move('temp_audio.wav', os.path.splitext(file_path)[0] + '.wav')
                 else:
-                    import shutil
-                    shutil.copy2('temp_video.avi', file_path)
-                os.remove('temp_video.avi')
+                    merge_recording(recorded, None, file_path)
+                    os.remove(recorded)
                 messagebox.showinfo("Успех", f"Видео сохранено как {file_path}")
             except Exception as e:
                 messagebox.showerror("Ошибка", f"Не удалось сохранить видео: {str(e)}")
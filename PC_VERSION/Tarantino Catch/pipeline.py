@@ -0,0 +1,194 @@
+import math
+import queue
+import threading
+import time
+import cv2
+import numpy as np
+
+CLOSED = -1  # Sentinel slot published when the producing stage has finished
+FULL_FRAME = (0, 0, 1 << 30, 1 << 30)  # Damage rect (x0, y0, x1, y1) that covers any frame
+
+
+# Preallocated frames passed between two pipeline stages. The producer acquires a free slot, fills it in
+# place and publishes it with its capture timestamp; the consumer releases it when done. Nothing is
+# allocated per frame and the ring never grows: a producer that finds no free slot has to drop or wait.
+# Each published slot carries the rect that changed since the previous frame, or None when nothing did;
+# only the pixels inside that rect are valid.
+class FrameRing:
+    def __init__(self, slots, shape):
+        self.frames = np.zeros((slots,) + tuple(shape), dtype=np.uint8)
+        self.timestamps = np.zeros(slots)
+        self.damage = [FULL_FRAME] * slots
+        self.free = queue.Queue()
+        self.ready = queue.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+
+    def acquire(self, timeout=0):
+        try:
+            if timeout:
+                return self.free.get(timeout=timeout)
+            return self.free.get_nowait()
+        except queue.Empty:
+            return None
+
+    def publish(self, slot, timestamp, damage=FULL_FRAME):
+        self.timestamps[slot] = timestamp
+        self.damage[slot] = damage
+        self.ready.put(slot)
+
+    def take(self, timeout=0.1):
+        try:
+            return self.ready.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def release(self, slot):
+        self.free.put(slot)
+
+    def close(self):
+        self.ready.put(CLOSED)
+
+    def depth(self):
+        return self.ready.qsize()
+
+
+def find_damage(frame, previous, diff):
+    # Bounding rect of the pixels that differ from the previous frame, None for an identical frame;
+    # the norm check alone settles the common case of a still screen
+    if cv2.norm(frame, previous, cv2.NORM_INF) == 0:
+        return None
+    cv2.absdiff(frame, previous, dst=diff)
+    # Seen as one byte per channel, the non-zero bytes give the rect in bytes, three to a pixel
+    x, y, width, height = cv2.boundingRect(diff.reshape(diff.shape[0], -1))
+    channels = diff.shape[2]
+    return x // channels, y, -(-(x + width) // channels), y + height
+
+def union(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+def scale_damage(rect, source_size, target_size):
+    # (source rect, target rect) for a damaged part of a frame that is resized. Both are grown to whole cells
+    # of the grid on which the two sizes have integer borders, plus one cell for interpolation, so resizing
+    # the part gives the pixels a resize of the whole frame would.
+    (source_w, source_h), (target_w, target_h) = source_size, target_size
+    cells_x, cells_y = math.gcd(source_w, target_w), math.gcd(source_h, target_h)
+    cell_w, cell_h = source_w // cells_x, source_h // cells_y
+    x0 = max(0, rect[0] // cell_w - 1)
+    y0 = max(0, rect[1] // cell_h - 1)
+    x1 = min(cells_x, -(-rect[2] // cell_w) + 1)
+    y1 = min(cells_y, -(-rect[3] // cell_h) + 1)
+    scale_x, scale_y = target_w // cells_x, target_h // cells_y
+    return ((x0 * cell_w, y0 * cell_h, x1 * cell_w, y1 * cell_h),
+            (x0 * scale_x, y0 * scale_y, x1 * scale_x, y1 * scale_y))
+
+
+# Holds only the newest item: a put replaces whatever the reader has not taken yet, so a slow reader
+# skips straight to the latest frame instead of working through a backlog of stale ones
+class Mailbox:
+    def __init__(self):
+        self.item = None
+        self.condition = threading.Condition()
+
+    def put(self, item):
+        # True when the box was empty, i.e. the reader has not been told about an item yet
+        with self.condition:
+            empty = self.item is None
+            self.item = item
+            self.condition.notify()
+            return empty
+
+    def take(self, timeout=0):
+        with self.condition:
+            if self.item is None and timeout:
+                self.condition.wait(timeout)
+            item, self.item = self.item, None
+            return item
+
+    def empty(self):
+        return self.item is None
+
+
+# Frame counts and processing time of one pipeline stage
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.dropped = 0
+        self.latency = 0.0  # Smoothed seconds per frame
+        self.max_latency = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, started):
+        elapsed = time.monotonic() - started
+        with self.lock:
+            self.frames += 1
+            self.latency = elapsed if self.frames == 1 else self.latency * 0.9 + elapsed * 0.1
+            self.max_latency = max(self.max_latency, elapsed)
+
+    def drop(self):
+        with self.lock:
+            self.dropped += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {"frames": self.frames, "dropped": self.dropped,
+                    "latency_ms": self.latency * 1000, "max_latency_ms": self.max_latency * 1000}
+
+
+# Places audio blocks on the video timeline. The sound card runs on its own clock, so the samples it
+# delivers slowly drift away from the monotonic clock the frames are stamped with; each block is
+# stretched or squeezed by a sample or so until the drift is gone, and a jump from lost input or a late
+# start is filled with silence or cut at once.
+class AudioAligner:
+    SMOOTHING = 100  # Blocks the timing error is averaged over, evens out scheduling jitter
+    CORRECTION = 200  # Blocks over which an averaged error is corrected
+    RESYNC = 0.25  # Seconds of sudden error that are fixed at once instead of stretched away
+
+    def __init__(self, rate, channels):
+        self.rate = rate
+        self.channels = channels
+        self.written = 0  # Samples per channel handed out so far
+        self.error = None  # Averaged samples the audio is ahead of the video
+        self.carry = 0.0
+        self.stretched = 0  # Samples added (negative: removed) by gradual correction
+        self.resyncs = 0
+
+    def align(self, samples, end_time):
+        # samples is int16 (n, channels); end_time is the time of the last one in seconds from the first frame
+        error = self.written + len(samples) - end_time * self.rate
+        if self.error is None or abs(error - self.error) > self.RESYNC * self.rate:
+            shift = int(round(error))
+            if shift < 0:
+                samples = np.concatenate([np.zeros((-shift, self.channels), dtype=samples.dtype), samples])
+            else:
+                samples = samples[shift:]
+            self.error = error - shift
+            self.carry = 0.0
+            self.resyncs += 1
+        else:
+            self.error += (error - self.error) / self.SMOOTHING
+            self.carry += self.error / self.CORRECTION
+            limit = max(1, len(samples) // 100)
+            remove = max(-limit, min(limit, int(self.carry)))
+            if remove:
+                self.carry -= remove
+                samples = resample(samples, len(samples) - remove)
+                self.stretched -= remove
+        self.written += len(samples)
+        return samples
+
+
+def resample(samples, length):
+    # Linear interpolation to a slightly different length, the change is a few samples per block at most
+    positions = np.linspace(0, len(samples) - 1, length)
+    source = np.arange(len(samples))
+    result = np.empty((length, samples.shape[1]), dtype=samples.dtype)
+    for channel in range(samples.shape[1]):
+        result[:, channel] = np.rint(np.interp(positions, source, samples[:, channel]))
+    return result
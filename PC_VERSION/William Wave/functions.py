@@ -5,6 +5,14 @@ from scipy import signal
 from dataclasses import dataclass
 from typing import Optional
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+ENVELOPE_TOLERANCE = 1e-9  # Relative gap between rect and the envelope below which either branch is accepted
+ENVELOPE_PASSES = 8  # Solves of one chunk before the rest of it is finished sample by sample
+
 @dataclass
 class AudioData:
     samples: Optional[np.ndarray] = None
@@ -198,25 +206,104 @@ def lowpass(samples: np.ndarray, sr: int, cutoff_hz: float) -> np.ndarray:
     sos = signal.butter(4, cutoff_hz, btype='lowpass', fs=sr, output='sos')
     return signal.sosfilt(sos, samples)
 
-def compress(samples: np.ndarray, threshold_db: float = -24.0, ratio: float = 4.0, attack_ms: float = 10.0, release_ms: float = 100.0, sr: int = 44100) -> np.ndarray:
-    if samples is None:
+def _follow_samples(rect, attack_coef, release_coef, env, state):
+    for i in range(rect.shape[0]):
+        x = rect[i]
+        if x > state:
+            state = attack_coef * state + (1 - attack_coef) * x
+        else:
+            state = release_coef * state + (1 - release_coef) * x
+        env[i] = state
+    return state
+
+_follow_compiled = njit(cache=True)(_follow_samples) if njit else None
+
+def follow_envelope(rect: np.ndarray, attack_coef: float, release_coef: float, chunk: int = 4096) -> np.ndarray:
+    # env[i] = c * env[i - 1] + (1 - c) * rect[i], with c = attack_coef where rect[i] > env[i - 1] and release_coef
+    # otherwise. With numba this is the sample loop compiled. Without it: with the branches known the recursion is
+    # linear and each chunk is solved in closed form (cumulative product and sum); the branches are guessed,
+    # checked against the result and the chunk is solved again from the first wrong one until they agree.
+    # Where rect and the envelope are within rounding of each other both branches give the same value, so those
+    # samples are not counted as wrong; a chunk that still does not settle is finished by the sample loop.
+    rect = np.ascontiguousarray(rect, dtype=np.float64)
+    n = rect.shape[0]
+    env = np.empty(n)
+    if _follow_compiled is not None:
+        _follow_compiled(rect, attack_coef, release_coef, env, 0.0)
+        return env
+    smallest = min(attack_coef, release_coef)
+    if smallest < 1.0:
+        # The cumulative product of a chunk must stay clear of underflow
+        chunk = max(1, min(chunk, int(600.0 / -np.log(max(smallest, 1e-300)))))
+    state = 0.0
+    for start in range(0, n, chunk):
+        end = min(start + chunk, n)
+        r = rect[start:end]
+        e = env[start:end]
+        attack = r > state
+        lo = 0
+        prev = state
+        for _ in range(ENVELOPE_PASSES):
+            a = attack[lo:]
+            c = np.where(a, attack_coef, release_coef)
+            p = np.cumprod(c)
+            u = 1 - c
+            u *= r[lo:]
+            u /= p
+            y = e[lo:]
+            np.cumsum(u, out=y)
+            y += prev
+            y *= p
+            check = r[lo + 1:] > y[:-1]
+            wrong = np.flatnonzero(check != a[1:])
+            if len(wrong):
+                gap = np.abs(r[lo + 1 + wrong] - y[wrong])
+                wrong = wrong[gap > ENVELOPE_TOLERANCE * y[wrong]]
+            if not len(wrong):
+                break
+            first = wrong[0]
+            attack[lo + 1 + first:] = check[first:]
+            lo += 1 + first
+            prev = e[lo - 1]
+        else:
+            _follow_samples(r[lo:], attack_coef, release_coef, e[lo:], prev)
+        state = e[-1]
+    return env
+
+def compress(samples: np.ndarray, threshold_db: float = -24.0, ratio: float = 4.0, attack_ms: float = 10.0, release_ms: float = 100.0, sr: int = 44100, knee_db: float = 0.0, lookahead_ms: float = 0.0, detector: str = 'peak') -> np.ndarray:
+    if samples is None or ratio <= 1.0:
         return samples
     eps = 1e-9
-    mono = samples if samples.ndim == 1 else samples.mean(axis=1)
-    env = np.zeros_like(mono)
+    if samples.ndim == 1:
+        mono = samples
+    else:
+        # Same sum as samples.mean(axis=1), which is very slow over a short last axis
+        mono = samples[:, 0].astype(np.float64)
+        for ch in range(1, samples.shape[1]):
+            mono += samples[:, ch]
+        mono /= samples.shape[1]
+    rect = np.square(mono) if detector == 'rms' else np.abs(mono)
+    lookahead = int(sr * lookahead_ms / 1000.0)
+    if lookahead > 0:
+        rect = np.concatenate([rect, np.zeros(lookahead)])
     alpha_a = np.exp(-1.0 / (0.001 * attack_ms * sr))
     alpha_r = np.exp(-1.0 / (0.001 * release_ms * sr))
-    prev = 0.0
-    for i, x in enumerate(mono):
-        rect = abs(x)
-        if rect > prev:
-            prev = alpha_a * prev + (1 - alpha_a) * rect
-        else:
-            prev = alpha_r * prev + (1 - alpha_r) * rect
-        env[i] = prev
-    env_db = 20 * np.log10(env + eps)
-    gain_db = np.minimum(0.0, -(env_db - threshold_db) * (1 - 1 / ratio))
-    gain_lin = 10 ** (gain_db / 20.0)
+    env = follow_envelope(rect, alpha_a, alpha_r)[lookahead:]
+    if detector == 'rms':
+        env += eps * eps
+        over = np.log10(env, out=env)
+        over *= 10
+    else:
+        env += eps
+        over = np.log10(env, out=env)
+        over *= 20
+    over -= threshold_db
+    slope = 1 - 1 / ratio
+    gain_db = np.minimum(over * -slope, 0.0)
+    if knee_db > 0:
+        knee = np.abs(over) <= knee_db / 2
+        gain_db[knee] = -slope * (over[knee] + knee_db / 2) ** 2 / (2 * knee_db)
+    gain_lin = np.exp(gain_db * (np.log(10) / 20.0), out=gain_db)
     if samples.ndim == 1:
         return samples * gain_lin
     else:
@@ -160,6 +160,9 @@ class AudioApp(tk.Tk):
             ('compress_ratio', 1, 20, 4, 'Компрессор отношение'),
             ('compress_attack_ms', 1, 100, 10, 'Компрессор атака (мс)'),
             ('compress_release_ms', 10, 500, 100, 'Компрессор релиз (мс)'),
+            ('compress_knee_db', 0, 24, 0, 'Компрессор колено (дБ)'),
+            ('compress_lookahead_ms', 0, 20, 0, 'Компрессор упреждение (мс)'),
+            ('compress_rms', 0, 1, 0, 'Компрессор RMS (0/1)'),
             ('normalize', 0, 1, 0, 'Нормализация (0/1)'),
             ('autogain', 0, 1, 0, 'Авто-гейн (0/1)'),
         ]
@@ -302,7 +305,7 @@ class AudioApp(tk.Tk):
         vals = {}
         for key, (var, lbl, mn, mx, _) in self.vars.items():
             v = var.get()
-            if key in ('normalize', 'autogain'):
+            if key in ('normalize', 'autogain', 'compress_rms'):
                 vals[key] = int(round(v))
             else:
                 vals[key] = float(v)
@@ -330,7 +333,9 @@ class AudioApp(tk.Tk):
         if vals.get('normalize', 0) == 1:
             s = normalize(s)
         s = compress(s, threshold_db=vals.get('compress_th', -24.0), ratio=vals.get('compress_ratio', 4.0),
-                    attack_ms=vals.get('compress_attack_ms', 10.0), release_ms=vals.get('compress_release_ms', 100.0), sr=sr)
+                    attack_ms=vals.get('compress_attack_ms', 10.0), release_ms=vals.get('compress_release_ms', 100.0), sr=sr,
+                    knee_db=vals.get('compress_knee_db', 0.0), lookahead_ms=vals.get('compress_lookahead_ms', 0.0),
+                    detector='rms' if vals.get('compress_rms', 0) == 1 else 'peak')
         reverb_sec = vals.get('reverb_ms', 0.0) / 1000.0
         reverb_mix = vals.get('reverb_mix', 0.0) / 100.0
         if reverb_sec > 0.001 and reverb_mix > 0.001: